@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+Benchmark darktable-cli startup overhead for the color step.
+
+Converts the same photos one per darktable-cli process and in batches (see photogramkit.color),
+one process at a time, and prints seconds per image for both. The difference is the startup
+cost paid for every photo without batching.
+
+    python benchmarks/bench_color.py -i ./demo/photos-organized -d darktable-cli -n 20
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from photogramkit import color
+
+
+def time_mode(darktable_dir, color_jobs, batch_size):
+    "convert color_jobs with one process at a time, return (seconds, failures)"
+    start = time.perf_counter()
+    failures = []
+    with color.DarktableWorkers() as workers:
+        for batch in color.batch_color_jobs(color_jobs, batch_size=batch_size, jobs=1):
+            failures.extend(color.convert_batch(darktable_dir, batch, workers))
+    return time.perf_counter() - start, failures
+
+
+def report(label, n_files, seconds, failures):
+    "print one result line"
+    per_image = seconds / n_files if n_files else 0.0
+    print(f"{label:<28} {n_files:>5} files  {seconds:>8.2f} s  {per_image:>7.3f} s/image  {len(failures)} failed")
+
+
+def main():
+    "run the benchmark on the first photos of a sorted folder"
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True, help="a sorted folder with colorprofiles_namelabels")
+    parser.add_argument("-d", "--darktable", required=True, help="path to darktable-cli")
+    parser.add_argument("-f", "--format", default="CR3", help="image format. Default is CR3")
+    parser.add_argument("-n", "--number", type=int, default=20, help="number of photos to convert. Default is 20")
+    parser.add_argument("--batch-size", type=int, default=color.DEFAULT_BATCH_SIZE, help="photos per process")
+    args = parser.parse_args()
+
+    output_dir = tempfile.mkdtemp(prefix="bench-color-")
+    try:
+        color_jobs = sorted(color.list_color_jobs(args.input, output_dir, args.format))[:args.number]
+        for folder in {os.path.dirname(job[1]) for job in color_jobs}:
+            os.makedirs(folder, exist_ok=True)
+
+        per_file = time_mode(args.darktable, color_jobs, batch_size=1)
+        batched = time_mode(args.darktable, color_jobs, batch_size=args.batch_size)
+        report("per file (1/process)", len(color_jobs), *per_file)
+        report(f"batched ({args.batch_size}/process)", len(color_jobs), *batched)
+        if color_jobs:
+            print(f"startup overhead saved: {(per_file[0] - batched[0]) / len(color_jobs):.3f} s/image")
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+Benchmark reading capture times for the sort step.
+
+Compares the old approach (a new exiftool process per camera folder and
+get_metadata for every photo) with the batched, tag-restricted exiftool requests
+and the built-in reader used by photogramkit.sort, and prints files per second.
+
+    python benchmarks/bench_exif.py -i ./demo/photos-sdcards/070424 -f CR3
+"""
+
+import argparse
+import glob
+import os
+import time
+from exiftool import ExifTool
+from photogramkit import sort
+
+
+def time_per_file_metadata(camera_folders, img_format):
+    "old approach: one exiftool per camera folder, all tags for one photo at a time"
+    n_files = 0
+    start = time.perf_counter()
+    for camera_folder in camera_folders:
+        with ExifTool() as et:
+            for photo_dir in sorted(glob.glob(os.path.join(camera_folder, f"*.{img_format}"))):
+                et.get_metadata(photo_dir).get("EXIF:DateTimeOriginal")
+                n_files += 1
+    return n_files, time.perf_counter() - start
+
+
+def time_batched_tags(camera_folders, img_format, batch_size):
+    "new approach: one exiftool for the run, only the capture time tags, batch_size photos per request"
+    n_files = 0
+    start = time.perf_counter()
+    with ExifTool() as et:
+        for camera_folder in camera_folders:
+            photo_dirs = sorted(glob.glob(os.path.join(camera_folder, f"*.{img_format}")))
+            sort.read_capture_times(et, photo_dirs, batch_size=batch_size, fast_reader=False)
+            n_files += len(photo_dirs)
+    return n_files, time.perf_counter() - start
+
+
+def time_fast_reader(camera_folders, img_format, batch_size):
+    "built-in reader, exiftool only started for photos it cannot parse"
+    n_files = 0
+    start = time.perf_counter()
+    et = sort.LazyExifTool()
+    try:
+        for camera_folder in camera_folders:
+            photo_dirs = sorted(glob.glob(os.path.join(camera_folder, f"*.{img_format}")))
+            sort.read_capture_times(et, photo_dirs, batch_size=batch_size)
+            n_files += len(photo_dirs)
+    finally:
+        et.terminate()
+    return n_files, time.perf_counter() - start
+
+
+def report(label, n_files, seconds):
+    "print one result line"
+    rate = n_files / seconds if seconds > 0 else float("inf")
+    print(f"{label:<28} {n_files:>7} files  {seconds:>8.2f} s  {rate:>9.1f} files/s")
+
+
+def main():
+    "run the benchmark on one date folder"
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True, help="a date folder containing camera folders")
+    parser.add_argument("-f", "--format", default="CR3", help="image format. Default is CR3")
+    parser.add_argument("--batch-size", type=int, default=sort.DEFAULT_BATCH_SIZE, help="exiftool batch size")
+    args = parser.parse_args()
+
+    camera_folders = [os.path.join(args.input, c) for c in sorted(os.listdir(args.input))
+                      if os.path.isdir(os.path.join(args.input, c)) and not c.startswith('.')]
+
+    report("before (per-file metadata)", *time_per_file_metadata(camera_folders, args.format))
+    report(f"after (batched, {args.batch_size}/batch)", *time_batched_tags(camera_folders, args.format, args.batch_size))
+    report("built-in reader", *time_fast_reader(camera_folders, args.format, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
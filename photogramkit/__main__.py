@@ -8,7 +8,14 @@ import argparse
 from photogramkit import sort
 from photogramkit import color
 from photogramkit import build
+from photogramkit import dedupe
+from photogramkit import mesh
 from photogramkit import relax
+from photogramkit import place
+from photogramkit import proxies
+from photogramkit import screen
+from photogramkit import transfer
+from photogramkit import watch
 
 
 def parse_command_line():
@@ -30,20 +37,68 @@ def parse_command_line():
         default = "CR3",
         choices=["CR3", "JPEG", "PNG", "TIFF", "DNG"],  # restrict to valid options
         required = False)
+    sort_parser.add_argument("--batch-size", type=int, default=sort.DEFAULT_BATCH_SIZE,
+        help=f"number of photos sent to exiftool at once. Default is {sort.DEFAULT_BATCH_SIZE}")
+    sort_parser.add_argument("--rebuild-index", action="store_true",
+        help="ignore the metadata index from earlier runs and read every photo again")
+    sort_parser.add_argument("--placement", default="auto", choices=place.PLACEMENTS,
+        help="how photos are placed in the output folder. auto reflinks photos where the filesystem supports it and copies them otherwise, hardlink and symlink share the photos with the input folder. Default is auto")
+    sort_parser.add_argument("--jobs", type=int, default=transfer.DEFAULT_JOBS,
+        help=f"number of photos placed in parallel. Default is {transfer.DEFAULT_JOBS}")
+    sort_parser.add_argument("--per-device", type=int, default=transfer.DEFAULT_PER_DEVICE,
+        help=f"maximum number of photos read from one device at once. Default is {transfer.DEFAULT_PER_DEVICE}")
+    sort_parser.add_argument("--verify", action="store_true",
+        help="hash every placed photo with blake2b, compare it with its source and write manifest.blake2b")
+    sort_parser.add_argument("--max-time-diff", type=sort.parse_max_time_diff, default=sort.MAX_TIME_DIFF,
+        help=f"pause in seconds that separates two shooting sessions, or auto to pick it from the gaps between photos. Default is {sort.MAX_TIME_DIFF.total_seconds():.0f}")
+    sort_parser.add_argument("--dry-run", action="store_true",
+        help="only plan the sort and write the plan, do not place any photo")
+    sort_parser.add_argument("--plan",
+        help="write the sort plan to this .json or .csv file. Default with --dry-run is <output>/sort_plan.json")
+    sort_parser.add_argument("--duplicates", default="skip", choices=dedupe.DUPLICATE_ACTIONS,
+        help="what to do with photos that have the same content as a photo sorted before: skip them, link them to the first copy, or keep them. Default is skip")
+    sort_parser.add_argument("--watch", action="store_true",
+        help="keep polling the input folder and sort photos while they are copied from the SD cards, until Ctrl-C")
+    sort_parser.add_argument("--interval", type=float, default=watch.DEFAULT_INTERVAL,
+        help=f"seconds between two polls of the input folder with --watch. Default is {watch.DEFAULT_INTERVAL}")
+    sort_parser.add_argument("--idle-exit", type=float, default=0,
+        help="with --watch, stop after this many seconds without new photos. Default is 0 (never)")
 
     # 'color' subcommand
     color_parser = subparsers.add_parser("color", help="apply color profiles to photos")
     color_parser.add_argument("-i", "--input", required=True, help="input folder")
     color_parser.add_argument("-o", "--output", required=True, help="output folder")
     color_parser.add_argument("-d","--darktable", 
-        help="path to the darktable-cli. /Applications/darktable.app/Contents/MacOS/darktable-cli on mac terminal or darktable-cli on Linux system",
-        required = True)
+        help="path to the darktable-cli. /Applications/darktable.app/Contents/MacOS/darktable-cli on mac terminal or darktable-cli on Linux system. Not needed with --engine numpy",
+        required = False)
     color_parser.add_argument("-f",
         "--format",
         help="image format, can be CR3, JEPG, PNG and TIFF. Default is CR3",
         default = "CR3",
         choices=["CR3", "JPEG", "PNG", "TIFF"],  # restrict to valid options
         required = False)
+    color_parser.add_argument("--jobs", type=int, default=color.DEFAULT_JOBS,
+        help=f"number of darktable-cli processes running at once. Default is {color.DEFAULT_JOBS}")
+    color_parser.add_argument("--batch-size", type=int, default=color.DEFAULT_BATCH_SIZE,
+        help=f"maximum number of photos converted by one darktable-cli process, 1 converts photos one by one. Default is {color.DEFAULT_BATCH_SIZE}")
+    color_parser.add_argument("--force", action="store_true",
+        help="convert every photo, even if its output is up to date")
+    color_parser.add_argument("--cache-dir",
+        help="a folder keeping converted photos by the content of the photo and color profile, shared between output folders")
+    color_parser.add_argument("--engine", default="darktable", choices=color.ENGINES,
+        help="darktable, or numpy to convert JPEG, PNG and TIFF photos without darktable-cli. Default is darktable")
+    color_parser.add_argument("--compression", default="none", choices=proxies.COMPRESSIONS,
+        help="TIFF compression of the outputs, deflate is lossless. Default is none")
+    color_parser.add_argument("--tiled", action="store_true",
+        help=f"write tiled TIFFs ({proxies.TILE_SIZE}x{proxies.TILE_SIZE} tiles)")
+    color_parser.add_argument("--bit-depth", type=int, choices=proxies.BIT_DEPTHS,
+        help="bit depth of the outputs. Default is 16 with numpy, darktable's setting with darktable")
+    color_parser.add_argument("--timeout", type=float, default=color.DEFAULT_TIMEOUT,
+        help=f"seconds per photo after which darktable-cli is killed and started again. Default is {color.DEFAULT_TIMEOUT}")
+    color_parser.add_argument("--retries", type=int, default=color.DEFAULT_RETRIES,
+        help=f"how many times darktable-cli is started again after a timeout or a crash. Default is {color.DEFAULT_RETRIES}")
+    color_parser.add_argument("--proxies", type=int, nargs="+", default=[], choices=proxies.PROXY_FACTORS,
+        help="also write proxies downscaled by these factors, like --proxies 2 4, for aligning cameras in build")
 
     # 'build' subcommand
     build_parser = subparsers.add_parser("build", help="build 3D models using Agisoft Metashape Pro")
@@ -60,6 +115,42 @@ def parse_command_line():
         default = "tif",
         choices=["CR3", "JPEG", "PNG", "tif"],  # restrict to valid options
         required = False)
+    build_parser.add_argument("--align-proxy", type=int, choices=proxies.PROXY_FACTORS,
+        help="align cameras on the proxies downscaled by this factor (written by color --proxies), "
+             "then use the full resolution photos for depth maps and texturing")
+    build_parser.add_argument("--jobs", type=int, default=build.DEFAULT_JOBS,
+        help=f"number of flowers built at once, sharing the CPU cores. Default is {build.DEFAULT_JOBS}")
+    build_parser.add_argument("--memory", type=float,
+        help="GB of memory Metashape uses per flower. Flowers are only built at once while this much memory is free. "
+             f"Default is memory_gb of the Metashape settings, or {build.DEFAULT_MEMORY_GB}")
+    build_parser.add_argument("--config", default=build.DEFAULT_METASHAPE_CONFIG,
+        help="path to the Metashape settings (.json). Default is metashape_config.json of the package")
+    build_parser.add_argument("--batch-size", type=int, default=build.DEFAULT_BATCH_SIZE,
+        help=f"maximum number of flowers built by one Metashape process. Default is {build.DEFAULT_BATCH_SIZE}")
+    build_parser.add_argument("--from-stage", choices=build.STAGES,
+        help="build again from this step, even in projects where it was done. Default is to go on from the first step not done")
+    build_parser.add_argument("--timeout", type=float,
+        help="seconds per flower after which a Metashape run is killed and started again. Default is no timeout")
+    build_parser.add_argument("--retries", type=int, default=build.DEFAULT_RETRIES,
+        help=f"how many times a Metashape run is started again after a timeout or a crash. Default is {build.DEFAULT_RETRIES}")
+    build_parser.add_argument("--screen", action="store_true",
+        help="leave blurred and badly exposed photos out, comparing every photo with its camera ring")
+    build_parser.add_argument("--screen-threshold", type=float, default=screen.DEFAULT_THRESHOLD,
+        help=f"robust standard deviations from the median of a camera ring that exclude a photo with --screen. Default is {screen.DEFAULT_THRESHOLD}")
+    build_parser.add_argument("--masks", action="store_true",
+        help="make the background masks before the build instead of in Metashape, and keep them for the next builds")
+    build_parser.add_argument("--backgrounds",
+        help="folder with a folder of background photos for every camera, used with --masks. Default is the background of the Metashape settings")
+    build_parser.add_argument("--preview", action="store_true",
+        help="build a quick preview of every flower first, on its proxies, and only build the flowers whose preview aligned")
+    build_parser.add_argument("--min-aligned", type=float, default=build.DEFAULT_MIN_ALIGNED,
+        help=f"fraction of the cameras a preview must align for its flower to be built with --preview. Default is {build.DEFAULT_MIN_ALIGNED}")
+
+    # 'mesh' subcommand
+    mesh_parser = subparsers.add_parser("mesh", help="write lighter levels of detail of the exported models and report them")
+    mesh_parser.add_argument("-i", "--input", required=True, help="3D model folder, or a .ply model")
+    mesh_parser.add_argument("--grids", type=int, nargs="*", default=mesh.DEFAULT_GRIDS,
+        help=f"grid cubes along the longest side of a model, one level of detail per grid, none to only report the models. Default is {' '.join(map(str, mesh.DEFAULT_GRIDS))}")
 
     # 'relax' subcommand
     relax_parser = subparsers.add_parser("relax", help="do everything: sort, color, and build")
@@ -74,9 +165,21 @@ def parse_command_line():
         default = "CR3",
         choices=["CR3", "JPEG", "PNG", "TIFF"],  # restrict to valid options
         required = False)
+    relax_parser.add_argument("--placement", default="auto", choices=place.PLACEMENTS,
+        help="how sorted photos are placed in the output sorted folder. Default is auto")
+    relax_parser.add_argument("--jobs", type=int, default=transfer.DEFAULT_JOBS,
+        help=f"number of photos placed in parallel when sorting. Default is {transfer.DEFAULT_JOBS}")
+    relax_parser.add_argument("--per-device", type=int, default=transfer.DEFAULT_PER_DEVICE,
+        help=f"maximum number of photos read from one device at once when sorting. Default is {transfer.DEFAULT_PER_DEVICE}")
+    relax_parser.add_argument("--verify", action="store_true",
+        help="hash every sorted photo with blake2b, compare it with its source and write manifest.blake2b")
 
     # parse args
     args = parser.parse_args()
+
+    # watch mode places sessions as they close, there is no whole plan to write
+    if args.command == "sort" and args.watch and (args.dry_run or args.plan is not None):
+        sort_parser.error("--watch cannot be combined with --dry-run or --plan")
     return args
 
 
@@ -87,14 +190,31 @@ def main():
     args = parse_command_line()
 
     # pass argument to call module function
-    if args.command == "sort":
-        sort.run_sort(args.input, args.output, args.format)
+    if args.command == "sort" and args.watch:
+        watch.run_watch(args.input, args.output, args.format, batch_size=args.batch_size, rebuild_index=args.rebuild_index,
+                        placement=args.placement, jobs=args.jobs, per_device=args.per_device, verify=args.verify,
+                        max_time_diff=args.max_time_diff, duplicates=args.duplicates, interval=args.interval,
+                        idle_exit=args.idle_exit)
+    elif args.command == "sort":
+        sort.run_sort(args.input, args.output, args.format, batch_size=args.batch_size, rebuild_index=args.rebuild_index,
+                      placement=args.placement, jobs=args.jobs, per_device=args.per_device, verify=args.verify,
+                      max_time_diff=args.max_time_diff, dry_run=args.dry_run, plan_path=args.plan, duplicates=args.duplicates)
     elif args.command == "color":
-        color.run_color(args.input, args.output, args.darktable, args.format)
+        color.run_color(args.input, args.output, args.darktable, args.format, jobs=args.jobs, batch_size=args.batch_size,
+                        force=args.force, cache_dir=args.cache_dir, engine=args.engine, compression=args.compression,
+                        tiled=args.tiled, bit_depth=args.bit_depth, proxy_factors=args.proxies, timeout=args.timeout,
+                        retries=args.retries)
     elif args.command == "build":
-        build.run_build(args.input, args.output, args.metashape, args.script, args.format)
+        build.run_build(args.input, args.output, args.metashape, args.script, args.format, align_proxy=args.align_proxy,
+                        timeout=args.timeout, retries=args.retries, jobs=args.jobs, metashape_config=args.config,
+                        batch_size=args.batch_size, from_stage=args.from_stage, screen_photos=args.screen,
+                        screen_threshold=args.screen_threshold, make_masks=args.masks, backgrounds_dir=args.backgrounds,
+                        preview=args.preview, min_aligned=args.min_aligned, memory_gb=args.memory)
+    elif args.command == "mesh":
+        mesh.run_mesh(args.input, grids=args.grids)
     elif args.command == "relax":
-        relax.run_relax(args.input_raw, args.output_sort, args.output_color, args.output_model, args.metashape, args.script, args.darktable, args.img_format)
+        relax.run_relax(args.input_raw, args.output_sort, args.output_color, args.output_model, args.metashape, args.script, args.darktable, args.img_format,
+                        placement=args.placement, jobs=args.jobs, per_device=args.per_device, verify=args.verify)
 
 
 if __name__ == "__main__":
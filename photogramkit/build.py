@@ -2,27 +2,159 @@
 
 """
 A function for building 3D models using Agisoft Metashape
+
+    Every flower is built in its own project folder, with the config passed to the Metashape script
+    (see photogramkit.metashape) on its command line, so several builds can run at once:
+
+    ./3d-models
+    └── species
+        └── 2024_site_accession_replicate
+            ├── project_config.json
+            └── 2024_site_accession_replicate.psz
+
+    Projects are saved after every step of metashape.py, so building again goes on from the first
+    step not done (see photogramkit.metashape), and from_stage builds again from an earlier step.
+
+    Flowers are built in batches: one Metashape process builds up to batch_size flowers one after the
+    other (listed in a manifest in .photogramkit_batches), so Metashape starts once per batch. Every
+    project folder gets a status.json saying whether it was built. With jobs, several batches are built
+    at once, each Metashape process getting an equal share of the CPU cores.
+
+    With align_proxy, cameras are aligned on the downscaled proxies written by the color stage
+    (see photogramkit.proxies), and the full resolution photos are only used for depth maps and
+    texturing. Flowers without a proxy for every photo are aligned on the full resolution photos.
+
+    With screen, blurred and badly exposed photos are found before the build (see photogramkit.screen)
+    and left out of the project config, so alignment only sees useful frames. The measures of every
+    photo and the reason of every exclusion are in quality_report.csv in the project folder.
+
+    With masks, the background masks are made before the build (see photogramkit.masks), against the
+    background of every camera, and metashape.py loads them instead of generating them.
+
+    With preview, every flower is first built quickly in a preview folder of its project folder, on
+    its smallest proxies and with coarse settings (PREVIEW_SETTINGS). Only flowers whose preview
+    aligned enough of their cameras are built at full quality, so a mis-sorted flower or a flower
+    missing a camera ring costs minutes instead of hours. The alignment of every preview is in
+    preview_report.csv in the output folder:
+
+    ./3d-models/species/2024_site_accession_replicate
+    ├── preview
+    │   ├── project_config.json
+    │   └── 2024_site_accession_replicate.psz
+    ├── project_config.json
+    └── 2024_site_accession_replicate.psz
+
+    Every step of metashape.py writes its time, peak memory and photo, tie point and face counts to
+    stats.jsonl in its project folder. The records of a run are gathered in build_stats.jsonl, and
+    summarized per step across flowers (median, 90th percentile, max, total) in build_report.csv.
+
+    Metashape runs through the job runner (see photogramkit.runner): a run longer than the timeout
+    is killed and started again, and its output goes to .photogramkit_logs in the output folder.
 """
 
 import os
-import subprocess
 import argparse
+import csv
 import json
-import tempfile
-import glob
+import math
+import time
+import numpy as np
+from photogramkit import masks
+from photogramkit import proxies
+from photogramkit import runner
+from photogramkit import screen
+
+
+# how many times a Metashape run that timed out or crashed is started again
+DEFAULT_RETRIES = 1
+
+# Metashape processes running at once
+DEFAULT_JOBS = 1
+
+# maximum number of flowers built by one Metashape process
+DEFAULT_BATCH_SIZE = 10
+
+# name of the status record in every project folder, written by metashape.py
+STATUS_FILENAME = "status.json"
+
+# name of the folder with the batch manifests, in the output folder
+BATCH_FOLDER = ".photogramkit_batches"
+
+# the steps of metashape.py, in order
+STAGES = ["photos", "masks", "markers", "alignment", "selection", "mesh", "texture", "export"]
+
+# name of the step statistics in every project folder, written by metashape.py
+STATS_FILENAME = "stats.jsonl"
 
-def run_build(input_dir, output_dir, metashape_dir, metashape_script, img_format):
+# name of the step statistics of every flower of a run, in the output folder
+RUN_STATS_FILENAME = "build_stats.jsonl"
+
+# name of the summary of the step statistics across flowers, in the output folder
+REPORT_FILENAME = "build_report.csv"
+
+# statistics of the steps summarized across flowers
+REPORT_STATS = ["seconds", "depth_maps_seconds", "peak_rss", "photos", "aligned", "tie_points_before", "tie_points",
+                "faces"]
+
+# name of the preview folder in every project folder
+PREVIEW_FOLDER = "preview"
+
+# name of the Metashape settings of the previews, in the output folder
+PREVIEW_CONFIG_FILENAME = "preview_metashape_config.json"
+
+# name of the alignment report of the previews, in the output folder
+PREVIEW_REPORT_FILENAME = "preview_report.csv"
+
+# Metashape settings replaced in the previews: fewer keypoints, coarse depth maps, a small model and texture
+PREVIEW_SETTINGS = {
+    "photo_alignment": {"accuracy_downscale": 2, "keypoint_limit": 10000, "tiepoint_limit": 2000, "guided_matching": False},
+    "depth_maps": {"downscale": 8, "filter_mode": "AggressiveFiltering"},
+    "mesh_building": {"face_count": "LowFaceCount", "vertex_colors": False},
+    "texture_building": {"texture_size": 1024},
+}
+
+# fraction of the cameras a preview must align for its flower to be built
+DEFAULT_MIN_ALIGNED = 0.9
+
+# GB of memory a Metashape process is expected to use while it builds a flower, if the settings do not say
+DEFAULT_MEMORY_GB = 16
+
+# name of the config file in every project folder
+PROJECT_CONFIG_FILENAME = "project_config.json"
+
+# the Metashape settings shipped with the package
+DEFAULT_METASHAPE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "metashape_config.json")
+
+
+def photo_extensions(img_format):
+    "the lowercase file extensions of a photo format, tif and tiff are the same format"
+    extension = f".{img_format.lower()}"
+    if extension in (".tif", ".tiff"):
+        return (".tif", ".tiff")
+    if extension in (".jpg", ".jpeg"):
+        return (".jpg", ".jpeg")
+    return (extension,)
+
+
+def list_projects(input_dir, output_dir, img_format, align_proxy=None, metashape_config=DEFAULT_METASHAPE_CONFIG):
     """
-    run the Agisoft Metashape script using the command line.
+    list the Metashape project of every flower.
 
     Parameters:
-        metashape_script: path to the Python script to be executed by Metashape
+        input_dir: the color calibrated photo folder
+        output_dir: the 3D model folder
+        img_format: the photo format, like tif
+        align_proxy: a proxy factor to align cameras on, or None for full resolution
+        metashape_config: path to the Metashape settings
+
+    Outputs:
+        projects: a list of dict with the name and folder of each project and its config for metashape.py
     """
-    # create output_dir if not exist
-    os.makedirs(output_dir, exist_ok=True)
+    extensions = photo_extensions(img_format)
+    projects = []
 
     # get dates
-    dates = [d for d in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, d)) and not d.startswith('.')]
+    dates = sorted(d for d in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, d)) and not d.startswith('.'))
 
     # iterate each date folders
     for date in dates:
@@ -30,48 +162,423 @@ def run_build(input_dir, output_dir, metashape_dir, metashape_script, img_format
         date_folder = os.path.join(input_dir, date)
 
         # iterate each flower folder
-        flowers = os.listdir(date_folder)
+        flowers = sorted(f for f in os.listdir(date_folder)
+                         if os.path.isdir(os.path.join(date_folder, f)) and not f.startswith('.'))
         for flower in flowers:
             # get species name, site number, accession number and replicate, to create output directory
             species, site, accession, replicate = flower.split("_")
-            # create output dir for the species
-            species_dir = os.path.join(output_dir, species)
-            os.makedirs(species_dir, exist_ok=True)
             project_name = f"2024_{site}_{accession}_{replicate}"
+            project_dir = os.path.join(output_dir, species, project_name)
 
             # recursivley read all photo files from each camera in each flower
             photo_files = []
-            cameras = os.listdir(os.path.join(date_folder, flower))
+            cameras = sorted(c for c in os.listdir(os.path.join(date_folder, flower))
+                             if os.path.isdir(os.path.join(date_folder, flower, c)) and not c.startswith('.'))
             for camera in cameras:
-                photos_dir = glob.glob(os.path.join(date_folder, flower, camera, f"*.{img_format}"))
-                for photo_dir in photos_dir:
-                    photo_files.append(photo_dir)
+                camera_folder = os.path.join(date_folder, flower, camera)
+                for name in sorted(os.listdir(camera_folder)):
+                    if os.path.splitext(name)[1].lower() in extensions and not name.startswith('.'):
+                        photo_files.append(os.path.abspath(os.path.join(camera_folder, name)))
 
-            # create a temporary config file to store the input, output and project name
-            temp_config_dir = os.path.join("./", "temp_config.json")
+            # the config read by metashape.py
             config_data = {
                 "photo_files": photo_files,
-                "project_name": project_name
+                "project_name": project_name,
+                "project_path": os.path.abspath(os.path.join(project_dir, f"{project_name}.psz")),
+                "metashape_config": os.path.abspath(metashape_config),
             }
-            with open(temp_config_dir, "w") as f:
-                json.dump(config_data, f)
 
-            # Change working directory to the project folder
-            # os.chdir(species_dir)
+            # align on the proxies if every photo has one
+            if align_proxy:
+                proxy_files = [proxies.proxy_path(photo_file, align_proxy) for photo_file in photo_files]
+                missing = [proxy_file for proxy_file in proxy_files if not os.path.exists(proxy_file)]
+                if missing:
+                    print(f"{len(missing)} photos of {flower} have no 1/{align_proxy} proxy, aligning on full resolution")
+                else:
+                    config_data["alignment_photo_files"] = proxy_files
+                    config_data["proxy_factor"] = align_proxy
+
+            projects.append({"name": project_name, "dir": project_dir, "config": config_data})
+
+    return projects
+
+
+def write_project_config(project):
+    "write the config of a project into its folder, returns its path"
+    os.makedirs(project["dir"], exist_ok=True)
+    config_path = os.path.join(project["dir"], PROJECT_CONFIG_FILENAME)
+    with open(config_path, "w") as f:
+        json.dump(project["config"], f, indent=1)
+    return config_path
+
+
+def screen_projects(projects, threshold=screen.DEFAULT_THRESHOLD):
+    """
+    leave the blurred and badly exposed photos of every project out of its config, comparing every
+    photo with its camera ring. the photos of all projects are measured at once by a pool of processes.
+
+    Outputs:
+        the configs of the projects without the excluded photos, and a quality_report.csv in every project folder
+    """
+    photo_files = [photo_file for project in projects for photo_file in project["config"]["photo_files"]]
+    measurements = screen.measure_photos(photo_files)
+
+    for project in projects:
+        config = project["config"]
+        rows = screen.select_photos(config["photo_files"], measurements, threshold)
+        os.makedirs(project["dir"], exist_ok=True)
+        screen.write_report(rows, os.path.join(project["dir"], screen.REPORT_FILENAME))
+
+        # proxies are in the same order as the photos
+        for key in ("photo_files", "alignment_photo_files"):
+            if key in config:
+                config[key] = [photo_file for photo_file, row in zip(config[key], rows) if row["kept"]]
+        excluded = [row for row in rows if not row["kept"]]
+        if excluded:
+            print(f"{project['name']}: left out {len(excluded)} of {len(rows)} photos: "
+                  + ", ".join(f"{row['camera']}/{os.path.basename(row['photo'])} ({row['reason']})" for row in excluded))
+
+
+def mask_projects(projects, output_dir, metashape_config=DEFAULT_METASHAPE_CONFIG, backgrounds_dir=None):
+    """
+    make the background masks of the photos (and proxies) of every project, and add them to its config.
+    projects with a photo that could not be masked are masked by Metashape.
+
+    Parameters:
+        output_dir: the 3D model folder, the masks are kept in its .photogramkit_masks folder
+        metashape_config: path to the Metashape settings, with the tolerance and the default background
+        backgrounds_dir: a folder with the background photos of every camera (see photogramkit.masks), or None
+    """
+    with open(metashape_config) as f:
+        config = json.load(f)
+    # the background of the settings is relative to the settings file
+    default = os.path.join(os.path.dirname(os.path.abspath(metashape_config)), config["background_mask"])
+    cache = masks.MaskCache(os.path.join(output_dir, masks.MASK_FOLDER),
+                            config["masking"].get("tolerance", masks.DEFAULT_TOLERANCE))
+
+    # photos are in input_dir/date/flower/camera, their proxies in a folder of the camera folder share their background
+    proxy_folders = {proxies.proxy_folder(factor) for factor in proxies.PROXY_FACTORS}
+    photo_backgrounds = {}
+    for project in projects:
+        config_data = project["config"]
+        for photo_file in config_data["photo_files"] + config_data.get("alignment_photo_files", []):
+            camera_folder = os.path.dirname(photo_file)
+            if os.path.basename(camera_folder) in proxy_folders:
+                camera_folder = os.path.dirname(camera_folder)
+            date = os.path.basename(os.path.dirname(os.path.dirname(camera_folder)))
+            photo_backgrounds[photo_file] = masks.find_backgrounds(backgrounds_dir, date, os.path.basename(camera_folder),
+                                                                   default)
+
+    # a missing background is reported once, not for each of its photos
+    missing = sorted({path for backgrounds in photo_backgrounds.values() for path in backgrounds if not os.path.exists(path)})
+    for path in missing:
+        print(f"Background {path} not found, its photos are masked in Metashape")
+    photo_backgrounds = {photo_file: backgrounds for photo_file, backgrounds in photo_backgrounds.items()
+                         if not set(backgrounds).intersection(missing)}
+
+    mask_files, failures, made = cache.make_masks(photo_backgrounds)
+    for photo_file, error in failures:
+        print(f"Cannot mask {photo_file}: {error}")
+    print(f"Masks: {made} made, {len(mask_files) - made} from the cache, {len(failures)} failed")
+
+    for project in projects:
+        config_data = project["config"]
+        photo_files = config_data["photo_files"] + config_data.get("alignment_photo_files", [])
+        if all(photo_file in mask_files for photo_file in photo_files):
+            config_data["mask_files"] = {photo_file: mask_files[photo_file] for photo_file in photo_files}
+        else:
+            print(f"{project['name']}: not every photo has a mask, masking in Metashape")
+
+
+def metashape_command(metashape_dir, metashape_script, config_path, from_stage=None):
+    "the command running the Metashape script on a project config or a manifest"
+    # use -r option to specify the script, its arguments follow
+    command = [metashape_dir, "-r", metashape_script, config_path]
+    if from_stage is not None:
+        command += ["--from-stage", from_stage]
+    return command
+
+
+def batch_projects(projects, batch_size=DEFAULT_BATCH_SIZE, jobs=DEFAULT_JOBS):
+    """
+    split the projects into batches built by one Metashape process each.
+    batches are made smaller when there would be fewer batches than jobs, so every job has work.
+    """
+    size = max(1, min(batch_size, math.ceil(len(projects) / max(jobs, 1))))
+    return [projects[start:start + size] for start in range(0, len(projects), size)]
+
+
+def write_manifest(batch, config_paths, manifest_path, run_id):
+    "write the manifest of a batch, read by metashape.py"
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump({"run_id": run_id, "projects": [config_paths[project["name"]] for project in batch]}, f, indent=1)
+
+
+def read_status(project):
+    "the status record written by metashape.py in a project folder, or None"
+    try:
+        with open(os.path.join(project["dir"], STATUS_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_stats(project, run_id=None):
+    "the step statistics written by metashape.py in a project folder during a run, or during every run if run_id is None"
+    records = []
+    try:
+        with open(os.path.join(project["dir"], STATS_FILENAME)) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError: # a line cut by a crash
+                    continue
+                if run_id is None or record.get("run_id") == run_id:
+                    records.append(record)
+    except OSError:
+        pass
+    return records
+
+
+def write_report(projects, run_id, output_dir):
+    """
+    gather the step statistics of a run, and summarize them per step across flowers.
+
+    Outputs:
+        output_dir/build_stats.jsonl with every record, output_dir/build_report.csv with the median,
+        90th percentile, max and total of every statistic of every step, and the step times printed
+    """
+    records = [record for project in projects for record in read_stats(project, run_id)]
+    with open(os.path.join(output_dir, RUN_STATS_FILENAME), "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    rows = []
+    for stage in STAGES:
+        stage_records = [record for record in records if record["stage"] == stage]
+        for stat in REPORT_STATS:
+            # the peak memory of a whole Metashape process grows with every flower of its batch, only
+            # peaks measured per step can be compared across flowers
+            values = np.array([record[stat] for record in stage_records if record.get(stat) is not None
+                               and (stat != "peak_rss" or record.get("peak_rss_scope") == "step")], dtype=float)
+            if len(values) == 0:
+                continue
+            rows.append({"stage": stage, "statistic": stat, "flowers": len(values),
+                         "p50": np.percentile(values, 50), "p90": np.percentile(values, 90),
+                         "max": values.max(), "total": values.sum()})
+
+    with open(os.path.join(output_dir, REPORT_FILENAME), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["stage", "statistic", "flowers", "p50", "p90", "max", "total"])
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: round(value, 3) if isinstance(value, float) else value for key, value in row.items()})
+
+    for row in rows:
+        if row["statistic"] == "seconds":
+            print(f"{row['stage']}: {row['flowers']} flowers, median {row['p50']:.1f} s, 90th percentile "
+                  f"{row['p90']:.1f} s, max {row['max']:.1f} s, total {row['total']:.1f} s")
+
+
+def write_preview_config(metashape_config, output_dir):
+    "write the Metashape settings of the previews to the output folder, returns their path"
+    with open(metashape_config) as f:
+        config = json.load(f)
+    for section, settings in PREVIEW_SETTINGS.items():
+        config[section] = dict(config.get(section, {}), **settings)
+    # the background is relative to the settings file
+    config["background_mask"] = os.path.join(os.path.dirname(os.path.abspath(metashape_config)), config["background_mask"])
+
+    preview_config = os.path.join(output_dir, PREVIEW_CONFIG_FILENAME)
+    with open(preview_config, "w") as f:
+        json.dump(config, f, indent=1)
+    return preview_config
+
+
+def preview_project(project, preview_config):
+    "the preview of a project, in the preview folder of its project folder, on the smallest proxies every photo has"
+    photo_files = project["config"]["photo_files"]
+    for factor in sorted(proxies.PROXY_FACTORS, reverse=True):
+        proxy_files = [proxies.proxy_path(photo_file, factor) for photo_file in photo_files]
+        if all(os.path.exists(proxy_file) for proxy_file in proxy_files):
+            photo_files = proxy_files
+            break
+
+    preview_dir = os.path.join(project["dir"], PREVIEW_FOLDER)
+    config_data = {
+        "photo_files": photo_files,
+        "project_name": project["name"],
+        "project_path": os.path.abspath(os.path.join(preview_dir, f"{project['name']}.psz")),
+        "metashape_config": os.path.abspath(preview_config),
+    }
+    return {"name": project["name"], "dir": preview_dir, "config": config_data}
+
+
+def check_previews(previews, run_id, min_aligned=DEFAULT_MIN_ALIGNED):
+    """
+    check the alignment of the previews built in a run.
+
+    Outputs:
+        rows: a list of dict, one per preview, with its photo, aligned camera, tie point and face
+              counts, and passed False with the reason if its flower should not be built
+    """
+    rows = []
+    for preview in previews:
+        status = read_status(preview)
+        # the last record of every step, the preview may have been built in an earlier run
+        stats = {record["stage"]: record for record in read_stats(preview)}
+        alignment = stats.get("selection") or stats.get("alignment") or {}
+        photos, aligned = alignment.get("photos") or 0, alignment.get("aligned") or 0
+        ratio = aligned / photos if photos else 0.0
+
+        reasons = []
+        if not (status and status.get("run_id") == run_id and status.get("status") == "done"):
+            reasons.append("preview not built")
+        if ratio < min_aligned:
+            reasons.append(f"{aligned} of {photos} cameras aligned")
+        rows.append({"flower": preview["name"], "photos": photos, "aligned": aligned, "aligned_ratio": round(ratio, 3),
+                     "tie_points": alignment.get("tie_points"), "faces": stats.get("mesh", {}).get("faces"),
+                     "passed": not reasons, "reason": ", ".join(reasons)})
+    return rows
+
+
+def write_preview_report(rows, report_path):
+    "write the alignment of the previews"
+    with open(report_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["flower", "photos", "aligned", "aligned_ratio", "tie_points", "faces",
+                                               "passed", "reason"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def flower_memory(metashape_config, memory_gb=None):
+    """
+    bytes of memory a Metashape process is expected to use while it builds a flower: memory_gb if given,
+    else the memory_gb of the Metashape settings, else DEFAULT_MEMORY_GB. flowers of a batch are built
+    one after the other, so a batch needs as much as one flower.
+    """
+    if memory_gb is None:
+        with open(metashape_config) as f:
+            memory_gb = json.load(f).get("memory_gb", DEFAULT_MEMORY_GB)
+    return int(memory_gb * 1024 ** 3)
+
+
+def run_batches(projects, output_dir, metashape_dir, metashape_script, job_runner, run_id, jobs=DEFAULT_JOBS,
+                batch_size=DEFAULT_BATCH_SIZE, timeout=None, retries=DEFAULT_RETRIES, from_stage=None, prefix="",
+                memory=0):
+    """
+    build projects in batches, one Metashape process per batch, through the job runner, and print
+    whether every project was built. prefix is added to the names of the manifests and logs.
+    a batch only starts when memory bytes (see flower_memory) are free and within the budget of the runner.
+    """
+    cpus = job_runner.cpus // jobs
+    config_paths = {project["name"]: write_project_config(project) for project in projects}
+    batch_folder = os.path.join(output_dir, BATCH_FOLDER)
+
+    futures = []
+    for number, batch in enumerate(batch_projects(projects, batch_size, jobs), 1):
+        manifest_path = os.path.join(batch_folder, f"{prefix}batch_{number}.json")
+        write_manifest(batch, config_paths, manifest_path, run_id)
+        command = metashape_command(metashape_dir, metashape_script, manifest_path, from_stage)
+        name = prefix + batch[0]["name"] + (f"+{len(batch) - 1}" if len(batch) > 1 else "")
+        job = runner.Job(name, command, cpus=cpus, memory=memory, timeout=timeout * len(batch) if timeout else None,
+                         retries=retries, cwd=output_dir)
+        futures.append((batch, job_runner.submit(job)))
+
+    # the status of every project says whether it was built, whatever happened to its batch
+    for batch, future in futures:
+        result = future.result()
+        for project in batch:
+            name = prefix + project["name"]
+            status = read_status(project)
+            if status and status.get("run_id") == run_id and status.get("status") == "done":
+                print(f"Metashape script executed successfully.{name}")
+            elif status and status.get("run_id") == run_id and status.get("status") == "failed":
+                print(f"Error running Metashape script: {name} {status.get('error')}, see {result.log_path}")
+            elif result.timed_out:
+                print(f"Error running Metashape script: {name} killed after a timeout, see {result.log_path}")
+            else:
+                print(f"Error running Metashape script: {name} not built (exit status "
+                      f"{result.returncode}), see {result.log_path}")
+
+
+def run_build(input_dir, output_dir, metashape_dir, metashape_script, img_format, align_proxy=None, timeout=None,
+              retries=DEFAULT_RETRIES, jobs=DEFAULT_JOBS, metashape_config=DEFAULT_METASHAPE_CONFIG,
+              batch_size=DEFAULT_BATCH_SIZE, from_stage=None, screen_photos=False, screen_threshold=screen.DEFAULT_THRESHOLD, make_masks=False,
+              backgrounds_dir=None, preview=False, min_aligned=DEFAULT_MIN_ALIGNED, memory_gb=None):
+    """
+    run the Agisoft Metashape script using the command line.
+
+    Parameters:
+        metashape_script: path to the Python script to be executed by Metashape
+        align_proxy: a proxy factor (see photogramkit.proxies) to align cameras on, or None for full resolution
+        timeout: seconds per flower after which a Metashape run is killed, None for no timeout
+        retries: how many times a Metashape run is started again after a timeout or a crash
+        jobs: the number of flowers built at once
+        metashape_config: path to the Metashape settings, default is metashape_config.json of the package
+        batch_size: the maximum number of flowers built by one Metashape process
+        from_stage: a step of STAGES to build again from, even in projects where it was done. by default
+                    projects go on from their first step not done, and built projects are left as they are
+        screen_photos: if True, leave blurred and badly exposed photos out (see screen_projects)
+        screen_threshold: robust standard deviations from the median of a camera ring that exclude a photo
+        make_masks: if True, make the background masks before the build (see mask_projects)
+        backgrounds_dir: a folder with the background photos of every camera, used with make_masks
+        preview: if True, build a quick preview of every flower first, and only build the flowers whose
+                 preview aligned at least min_aligned of its cameras
+        min_aligned: the fraction of the cameras a preview must align
+        memory_gb: GB of memory a Metashape process uses per flower, default is the memory_gb of the
+                   Metashape settings. flowers are only built at once while their memory is free
+
+    Outputs:
+        the projects, a status.json in every project folder, and the step statistics of the run
+        in output_dir/build_report.csv (see write_report). with preview, the previews and
+        output_dir/preview_report.csv
+    """
+    # create output_dir if not exist
+    os.makedirs(output_dir, exist_ok=True)
+
+    projects = list_projects(input_dir, output_dir, img_format, align_proxy, metashape_config)
+    if screen_photos:
+        screen_projects(projects, screen_threshold)
+    previews = []
+    if preview:
+        preview_config = write_preview_config(metashape_config, output_dir)
+        previews = [preview_project(project, preview_config) for project in projects]
+    if make_masks:
+        mask_projects(projects + previews, output_dir, metashape_config, backgrounds_dir)
+
+    # the cores and memory are shared by the Metashape processes, their output goes to output_dir/.photogramkit_logs
+    jobs = max(jobs, 1)
+    memory = flower_memory(metashape_config, memory_gb)
+    job_runner = runner.JobRunner(cpus=max(os.cpu_count() or 1, jobs),
+                                  log_dir=os.path.join(output_dir, runner.LOG_FOLDER))
+
+    # projects done in this run are skipped when a batch is started again
+    run_id = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
 
-            # run metashape 
-            # use -r option to specify the script
-            command = [metashape_dir, "-r", metashape_script]
+    # manifests of earlier runs
+    batch_folder = os.path.join(output_dir, BATCH_FOLDER)
+    if os.path.isdir(batch_folder):
+        for name in os.listdir(batch_folder):
+            os.remove(os.path.join(batch_folder, name))
 
-            try:
-                subprocess.run(command, check=True)
-                print(f"Metashape script executed successfully.{project_name}")
-            except subprocess.CalledProcessError as e:
-                print(f"Error running Metashape script: {e}")
+    with job_runner:
+        if preview:
+            run_batches(previews, output_dir, metashape_dir, metashape_script, job_runner, run_id, jobs, batch_size,
+                        timeout, retries, from_stage, prefix="preview-", memory=memory)
+            rows = check_previews(previews, run_id, min_aligned)
+            write_preview_report(rows, os.path.join(output_dir, PREVIEW_REPORT_FILENAME))
+            for row in rows:
+                if not row["passed"]:
+                    print(f"Not building {row['flower']}: {row['reason']}")
+            passed = {row["flower"] for row in rows if row["passed"]}
+            projects = [project for project in projects if project["name"] in passed]
 
-            # Delete the temporary config file after use
-            if os.path.exists(temp_config_dir):
-                os.remove(temp_config_dir)
+        run_batches(projects, output_dir, metashape_dir, metashape_script, job_runner, run_id, jobs, batch_size,
+                    timeout, retries, from_stage, memory=memory)
+
+    print(f"Metashape: {job_runner.summary()}")
+    write_report(projects, run_id, output_dir)
 
 
 def parse_command_line():
@@ -107,6 +614,99 @@ def parse_command_line():
         choices=["CR3", "JPEG", "PNG", "tif"],  # restrict to valid options
         required = False)
 
+    # add proxy alignment
+    parser.add_argument(
+        "--align-proxy",
+        help="align cameras on the proxies downscaled by this factor (written by color --proxies), "
+             "then use the full resolution photos for depth maps and texturing",
+        type=int,
+        choices=proxies.PROXY_FACTORS,
+        required = False)
+
+    # add number of flowers built at once
+    parser.add_argument(
+        "--jobs",
+        help=f"number of flowers built at once, sharing the CPU cores. Default is {DEFAULT_JOBS}",
+        type=int,
+        default=DEFAULT_JOBS,
+        required = False)
+
+    # add memory per flower
+    parser.add_argument(
+        "--memory",
+        help="GB of memory Metashape uses per flower. Flowers are only built at once while this much memory is free. "
+             f"Default is memory_gb of the Metashape settings, or {DEFAULT_MEMORY_GB}",
+        type=float,
+        required = False)
+
+    # add Metashape settings
+    parser.add_argument(
+        "--config",
+        help="path to the Metashape settings (.json). Default is metashape_config.json of the package",
+        default=DEFAULT_METASHAPE_CONFIG,
+        required = False)
+
+    # add number of flowers built by one Metashape process
+    parser.add_argument(
+        "--batch-size",
+        help=f"maximum number of flowers built by one Metashape process. Default is {DEFAULT_BATCH_SIZE}",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        required = False)
+
+    # add step to start again from
+    parser.add_argument(
+        "--from-stage",
+        help="build again from this step, even in projects where it was done. Default is to go on from the first step not done",
+        choices=STAGES,
+        required = False)
+
+    # add timeout and retries
+    parser.add_argument(
+        "--timeout",
+        help="seconds per flower after which a Metashape run is killed and started again. Default is no timeout",
+        type=float,
+        required = False)
+    parser.add_argument(
+        "--retries",
+        help=f"how many times a Metashape run is started again after a timeout or a crash. Default is {DEFAULT_RETRIES}",
+        type=int,
+        default=DEFAULT_RETRIES,
+        required = False)
+
+    # add photo screening
+    parser.add_argument(
+        "--screen",
+        help="leave blurred and badly exposed photos out, comparing every photo with its camera ring",
+        action="store_true")
+    parser.add_argument(
+        "--screen-threshold",
+        help=f"robust standard deviations from the median of a camera ring that exclude a photo with --screen. Default is {screen.DEFAULT_THRESHOLD}",
+        type=float,
+        default=screen.DEFAULT_THRESHOLD,
+        required = False)
+
+    # add background masks
+    parser.add_argument(
+        "--masks",
+        help="make the background masks before the build instead of in Metashape, and keep them for the next builds",
+        action="store_true")
+    parser.add_argument(
+        "--backgrounds",
+        help="folder with a folder of background photos for every camera, used with --masks. Default is the background of the Metashape settings",
+        required = False)
+
+    # add preview build
+    parser.add_argument(
+        "--preview",
+        help="build a quick preview of every flower first, on its proxies, and only build the flowers whose preview aligned",
+        action="store_true")
+    parser.add_argument(
+        "--min-aligned",
+        help=f"fraction of the cameras a preview must align for its flower to be built with --preview. Default is {DEFAULT_MIN_ALIGNED}",
+        type=float,
+        default=DEFAULT_MIN_ALIGNED,
+        required = False)
 
     # parse args
     args = parser.parse_args()
@@ -120,7 +720,11 @@ def main():
     args = parse_command_line()
 
     # run build models
-    run_build(input_dir=args.input, output_dir=args.output, metashape_dir=args.metashape, metashape_script=args.script, img_format=args.format)
+    run_build(input_dir=args.input, output_dir=args.output, metashape_dir=args.metashape, metashape_script=args.script, img_format=args.format,
+              align_proxy=args.align_proxy, timeout=args.timeout, retries=args.retries,
+              jobs=args.jobs, metashape_config=args.config, batch_size=args.batch_size, memory_gb=args.memory,
+              from_stage=args.from_stage, screen_photos=args.screen, screen_threshold=args.screen_threshold,
+              make_masks=args.masks, backgrounds_dir=args.backgrounds, preview=args.preview, min_aligned=args.min_aligned)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
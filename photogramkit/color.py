@@ -2,28 +2,174 @@
 
 """
 A function for doing photo color calibration
+
+    Photos are converted by several darktable-cli processes at once. Each worker uses its own
+    temporary config folder and an in-memory library, so the processes do not compete for
+    darktable's library database. Photos that fail are collected and listed at the end
+    (and in color_failures.txt in the output folder) instead of stopping the run.
+
+    darktable-cli takes seconds to start, so the photos of one flower/camera folder (which share
+    their color profile) are handed to one process in batches. Photos missing from a batch's
+    output are converted again one by one.
+
+    Every output is recorded with a fingerprint of what it was made from (the source photo's size and
+    modification time, the color profile's hash, the darktable version and the output options) in
+    .photogramkit_color.json in the output folder. Outputs whose fingerprint did not change are skipped,
+    so changing the profile of one flower only converts that flower again. With a cache folder, outputs
+    are also stored by the content hash of their source and profile, and identical inputs are linked
+    from the cache instead of converted.
+
+    JPEG, PNG and TIFF photos are already demosaiced, so with the numpy engine they are converted in
+    this process (see photogramkit.dcp), a few rows at a time, by a thread pool. RAW photos always
+    go through darktable-cli. The numpy engine needs tifffile (and Pillow for JPEG and PNG).
 """
 
 import os
+import csv
 import glob
+import hashlib
+import json
+import shutil
 import subprocess
 import argparse
+import math
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from photogramkit import dcp
+from photogramkit import place
+from photogramkit import profiles
+from photogramkit import proxies
+from photogramkit import runner
+from photogramkit import transfer
+
+try:
+    import tifffile
+except ImportError: # only needed by the numpy engine
+    tifffile = None
+
+try:
+    from PIL import Image
+except ImportError: # only needed by the numpy engine for JPEG and PNG
+    Image = None
+
+
+# darktable is multi-threaded itself, so do not start one process per core
+DEFAULT_JOBS = max(1, (os.cpu_count() or 1) // 2)
+
+# maximum number of photos converted by one darktable-cli process, 1 converts photos one by one
+DEFAULT_BATCH_SIZE = 50
+
+# seconds per photo after which a darktable-cli process is killed and started again
+DEFAULT_TIMEOUT = 600
 
+# how many times a darktable-cli process that timed out or crashed is started again
+DEFAULT_RETRIES = 1
 
-def run_color(input_dir, output_dir, darktable_dir, img_format):
+# bytes of memory a darktable-cli process is expected to use
+DARKTABLE_MEMORY = 2 * 1024 ** 3
+
+# name of the list of photos that could not be converted, in the output folder
+FAILURES_FILENAME = "color_failures.txt"
+
+# name of the file with the fingerprint of every output, in the output folder
+FINGERPRINTS_FILENAME = ".photogramkit_color.json"
+
+# name of the report of output sizes and times per flower, in the output folder
+REPORT_FILENAME = "color_report.csv"
+
+# output options, part of every fingerprint
+OUTPUT_OPTIONS = {"format": "tiff", "profile": "icc-file"}
+
+# conversion engines, in the order they are offered on the command line
+ENGINES = ["darktable", "numpy"]
+
+# photo formats the numpy engine converts, the others (RAW) go through darktable-cli
+NUMPY_FORMATS = ["JPEG", "JPG", "PNG", "TIFF", "TIF"]
+
+# rows converted at once by the numpy engine
+TILE_ROWS = 256
+
+
+class DarktableWorkers:
     """
-    use darktable-cli to run color calirbation
+    a private darktable config folder for every worker thread, removed when the workers are done,
+    and the job runner starting the darktable-cli processes (see photogramkit.runner).
 
     Parameters:
-        input_dir: photos
-        output_dir: color calibrated photos
-        color_profile: icc file
+        job_runner: a JobRunner, None for one without log files
+        timeout: seconds per photo after which a darktable-cli process is killed, None for no timeout
+        retries: how many times a darktable-cli process that timed out or crashed is started again
+
+    Use as a context manager:
+
+        with DarktableWorkers() as workers:
+            workers.configdir()  # the config folder of the calling thread
+            workers.run(name, cmd)  # run darktable-cli
+    """
+
+    def __init__(self, job_runner=None, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+        self.local = threading.local()
+        self.folders = []
+        self.lock = threading.Lock()
+        self.job_runner = job_runner if job_runner is not None else runner.JobRunner()
+        self.timeout = timeout
+        self.retries = retries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for folder in self.folders:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def configdir(self):
+        "the config folder of the calling thread, created on first use"
+        if not hasattr(self.local, "configdir"):
+            self.local.configdir = tempfile.mkdtemp(prefix="photogramkit-darktable-")
+            with self.lock:
+                self.folders.append(self.local.configdir)
+        return self.local.configdir
+
+    def run(self, calibrated_photo_dirs, cmd):
+        "run a darktable-cli command writing some outputs, named after them in the logs. returns a JobResult"
+        folder, name = os.path.split(calibrated_photo_dirs[0])
+        name = "darktable-" + "_".join(folder.split(os.sep)[-3:]) + "-" + os.path.splitext(name)[0]
+        if len(calibrated_photo_dirs) > 1:
+            name += f"+{len(calibrated_photo_dirs) - 1}"
+        timeout = self.timeout * len(calibrated_photo_dirs) if self.timeout else None
+        return self.job_runner.run(runner.Job(name, cmd, memory=DARKTABLE_MEMORY, timeout=timeout, retries=self.retries))
+
+
+def darktable_command(darktable_dir, photo_dir, calibrated_photo_dir, color_profile_dir, configdir,
+                      options=OUTPUT_OPTIONS):
+    "the darktable-cli command converting one photo with its own config folder and an in-memory library"
+    return ([darktable_dir, photo_dir, calibrated_photo_dir, "--icc-file", color_profile_dir,
+             "--core", "--configdir", configdir, "--library", ":memory:"] + proxies.darktable_conf(options))
+
+
+def darktable_batch_command(darktable_dir, photo_dirs, output_folder, color_profile_dir, configdir,
+                            options=OUTPUT_OPTIONS):
+    "the darktable-cli command converting many photos into <output_folder>/<photo name>.tiff"
+    return ([darktable_dir] + list(photo_dirs) +
+            [os.path.join(output_folder, "$(FILE_NAME)"), "--out-ext", "tiff", "--icc-file", color_profile_dir,
+             "--core", "--configdir", configdir, "--library", ":memory:"] + proxies.darktable_conf(options))
+
+
+def list_color_jobs(input_dir, output_dir, img_format):
+    """
+    list the photos to convert with their output file and color profile.
+    the color profiles of each date are found once (see photogramkit.profiles), and every flower/camera
+    folder of every date is checked to have exactly one profile before anything is converted.
 
     Outputs:
-        color calirbated photos
+        jobs: a list of tuple (photo_dir, calibrated_photo_dir, color_profile_dir)
+        raises ValueError listing every folder without exactly one profile
     """
-    # create output_dir if not exist
-    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    problems = []
 
     # get dates
     dates = [d for d in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, d)) and not d.startswith('.')]
@@ -33,8 +179,8 @@ def run_color(input_dir, output_dir, darktable_dir, img_format):
         # get date folder directory
         date_folder = os.path.join(input_dir, date)
 
-        # get color profile directory
-        colorprofiles_dir = os.path.join(date_folder, "colorprofiles_namelabels")
+        # find the color profiles of the date once
+        registry = profiles.ProfileRegistry(date_folder)
 
         # iterate each flower folders
         # ignore hidden folders (folder.startswith("."))
@@ -43,32 +189,421 @@ def run_color(input_dir, output_dir, darktable_dir, img_format):
             folder for folder in os.listdir(date_folder)
             if os.path.isdir(os.path.join(date_folder, folder))
             and not folder.startswith('.')
-            and folder != 'colorprofiles_namelabels'
+            and folder != profiles.COLORPROFILES_FOLDER
         ]
 
+        # photos of each flower/camera folder
+        photos_by_folder = {}
         for flower in flowers:
             # iterate each camera
-            cameras = os.listdir(os.path.join(date_folder,flower))
+            cameras = [c for c in os.listdir(os.path.join(date_folder, flower))
+                       if os.path.isdir(os.path.join(date_folder, flower, c)) and not c.startswith('.')]
             for camera in cameras:
-                # iterate each photo
                 photos_dir = glob.glob(os.path.join(date_folder, flower, camera, f"*.{img_format}"))
-                for photo_dir in photos_dir:
-                    # get photo name
-                    photo_name = os.path.splitext(os.path.basename(photo_dir))[0]
-                    # get color calibrated photo directory
-                    calibrated_photo_dir = os.path.join(output_dir, date, flower, camera, f"{photo_name}.tiff")
-                    # make the direcotry if not exist
-                    os.makedirs(os.path.dirname(calibrated_photo_dir), exist_ok=True)
-
-                    # get all DCP files in the color profile folder
-                    dcp_files = glob.glob(os.path.join(colorprofiles_dir, flower, camera, "*.dcp"))
-                    # check if there is exactly one .dcp file
-                    if len(dcp_files) == 1:
-                        color_profile_dir = dcp_files[0]  # Get the first (and only) .dcp file
-
-                    # run darktable-cli on mac terminal
-                    cmd = [darktable_dir, photo_dir, calibrated_photo_dir, "--icc-file",color_profile_dir]
-                    subprocess.run(cmd, check=True)
+                if photos_dir:
+                    photos_by_folder[(flower, camera)] = photos_dir
+
+        # check the whole date before converting anything
+        date_problems = registry.problems(photos_by_folder)
+        problems.extend(date_problems)
+        if date_problems:
+            continue
+
+        for (flower, camera), photos_dir in photos_by_folder.items():
+            color_profile_dir = registry.resolve(flower, camera)
+            for photo_dir in photos_dir:
+                # get photo name
+                photo_name = os.path.splitext(os.path.basename(photo_dir))[0]
+                # get color calibrated photo directory
+                calibrated_photo_dir = os.path.join(output_dir, date, flower, camera, f"{photo_name}.tiff")
+
+                jobs.append((photo_dir, calibrated_photo_dir, color_profile_dir))
+
+    if problems:
+        raise ValueError("color profiles are missing or ambiguous:\n" + "\n".join(problems))
+
+    return jobs
+
+
+def remove_output(calibrated_photo_dir):
+    """
+    remove the old output of a photo before darktable-cli writes it. darktable does not overwrite, it would
+    add _01 to the name and leave the old output in place, and the old output may be a link into the cache folder.
+    """
+    if os.path.lexists(calibrated_photo_dir):
+        os.remove(calibrated_photo_dir)
+
+
+def convert_photo(darktable_dir, photo_dir, calibrated_photo_dir, color_profile_dir, workers, options=OUTPUT_OPTIONS):
+    "convert one photo, runs in a worker thread. raises CalledProcessError or TimeoutExpired with darktable's output if it fails"
+    remove_output(calibrated_photo_dir)
+    cmd = darktable_command(darktable_dir, photo_dir, calibrated_photo_dir, color_profile_dir, workers.configdir(),
+                            options)
+    workers.run([calibrated_photo_dir], cmd).check()
+
+
+def batch_color_jobs(color_jobs, batch_size=DEFAULT_BATCH_SIZE, jobs=DEFAULT_JOBS):
+    """
+    split the photos into batches of photos with the same output folder and color profile.
+    batches are made smaller when there would be fewer batches than jobs, so every worker has work.
+
+    Outputs:
+        batches: a list of lists of jobs from list_color_jobs
+    """
+    folders = {}
+    for job in color_jobs:
+        photo_dir, calibrated_photo_dir, color_profile_dir = job
+        folders.setdefault((os.path.dirname(calibrated_photo_dir), color_profile_dir), []).append(job)
+
+    size = max(1, min(batch_size, math.ceil(len(color_jobs) / max(jobs, 1))))
+    return [folder_jobs[start:start + size] for folder_jobs in folders.values()
+            for start in range(0, len(folder_jobs), size)]
+
+
+def convert_batch(darktable_dir, batch, workers, options=OUTPUT_OPTIONS, timings=None):
+    """
+    convert a batch of photos with the same output folder and color profile in one darktable-cli process,
+    then convert the photos missing from its output one by one, and write their proxies. runs in a worker thread.
+
+    Parameters:
+        options: a dict of output options (see photogramkit.proxies.output_options)
+        timings: a dict filled with {calibrated_photo_dir: seconds}, the batch time is shared by its photos
+
+    Outputs:
+        failures: a list of tuple (photo_dir, exception)
+    """
+    start = time.perf_counter()
+    # old outputs are removed first, whatever the size of the batch, so a missing output always means darktable failed
+    for _, calibrated_photo_dir, _ in batch:
+        remove_output(calibrated_photo_dir)
+
+    if len(batch) > 1:
+        output_folder = os.path.dirname(batch[0][1])
+        cmd = darktable_batch_command(darktable_dir, [job[0] for job in batch], output_folder, batch[0][2],
+                                      workers.configdir(), options)
+        # photos missing from the output are converted again below, also when darktable-cli could not be run at all
+        try:
+            workers.run([job[1] for job in batch], cmd)
+        except (OSError, RuntimeError) as error:
+            print(f"darktable-cli failed on a batch of {len(batch)} photos in {output_folder}, "
+                  f"converting them one by one: {error}")
+
+    failures = []
+    for photo_dir, calibrated_photo_dir, color_profile_dir in batch:
+        try:
+            if len(batch) == 1 or not os.path.exists(calibrated_photo_dir) or os.path.getsize(calibrated_photo_dir) == 0:
+                convert_photo(darktable_dir, photo_dir, calibrated_photo_dir, color_profile_dir, workers, options)
+            proxies.finish_output(calibrated_photo_dir, options)
+        except (subprocess.SubprocessError, OSError, RuntimeError, ValueError) as error:
+            failures.append((photo_dir, error))
+
+    if timings is not None:
+        seconds = (time.perf_counter() - start) / len(batch)
+        for _, calibrated_photo_dir, _ in batch:
+            timings[calibrated_photo_dir] = seconds
+    return failures
+
+
+def darktable_version(darktable_dir):
+    "the first line of darktable-cli --version, or unknown if it cannot be run"
+    if darktable_dir is None:
+        return None
+    try:
+        result = subprocess.run([darktable_dir, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                timeout=60)
+        lines = result.stdout.decode(errors="replace").strip().splitlines()
+        return lines[0] if lines else "unknown"
+    except (OSError, subprocess.TimeoutExpired):
+        return "unknown"
+
+
+def fingerprint(parts):
+    "the blake2b hex digest of a JSON-serializable description of an output"
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+class ColorCache:
+    """
+    the fingerprints of the outputs of one output folder, and an optional content-addressed cache folder.
+
+    Parameters:
+        output_dir: the color calibrated photo folder
+        darktable_dir: path to darktable-cli, to get its version, or None if darktable is not used
+        options: a dict of output options, outputs made with other options are converted again
+        cache_dir: a folder keeping outputs by the content hash of their inputs, or None
+    """
+
+    def __init__(self, output_dir, darktable_dir, options=OUTPUT_OPTIONS, cache_dir=None):
+        self.output_dir = output_dir
+        self.cache_dir = cache_dir
+        self.settings = {"darktable": darktable_version(darktable_dir), "options": options}
+        self.profile_hashes = {}
+
+        # {output path relative to output_dir: fingerprint}
+        self.path = os.path.join(output_dir, FINGERPRINTS_FILENAME)
+        self.fingerprints = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.fingerprints = json.load(f)
+
+    def _profile_hash(self, color_profile_dir):
+        "the hash of a color profile, computed once per run"
+        if color_profile_dir not in self.profile_hashes:
+            self.profile_hashes[color_profile_dir] = transfer.hash_file(color_profile_dir)
+        return self.profile_hashes[color_profile_dir]
+
+    def _key(self, calibrated_photo_dir):
+        return os.path.relpath(calibrated_photo_dir, self.output_dir)
+
+    def fingerprint(self, job):
+        "the fingerprint of the output of a job from list_color_jobs"
+        photo_dir, _, color_profile_dir = job
+        stat = os.stat(photo_dir)
+        return fingerprint(dict(self.settings, source=[stat.st_size, stat.st_mtime_ns],
+                                profile=self._profile_hash(color_profile_dir)))
+
+    def cache_path(self, job):
+        "where the output of a job is kept in the cache folder, by the content of the photo and profile"
+        photo_dir, _, color_profile_dir = job
+        key = fingerprint(dict(self.settings, source=transfer.hash_file(photo_dir),
+                               profile=self._profile_hash(color_profile_dir)))
+        return os.path.join(self.cache_dir, key[:2], f"{key}.tiff")
+
+    def is_current(self, job, job_fingerprint):
+        "True if the output of a job exists and was made from the same inputs"
+        calibrated_photo_dir = job[1]
+        return (self.fingerprints.get(self._key(calibrated_photo_dir)) == job_fingerprint
+                and all(os.path.exists(path) for path in proxies.output_paths(calibrated_photo_dir,
+                                                                              self.settings["options"])))
+
+    def record(self, job, job_fingerprint):
+        "remember the fingerprint of a new output"
+        self.fingerprints[self._key(job[1])] = job_fingerprint
+
+    def save(self):
+        "write the fingerprints to the output folder"
+        with open(self.path, "w") as f:
+            json.dump(self.fingerprints, f, indent=1, sort_keys=True)
+
+
+def read_image(photo_dir):
+    """
+    read a demosaiced photo as a (height, width[, channels]) uint8 or uint16 array.
+    uncompressed TIFFs are memory-mapped, so only the rows being converted are read.
+    """
+    if os.path.splitext(photo_dir)[1].lower() in (".tif", ".tiff"):
+        try:
+            return tifffile.memmap(photo_dir, mode="r")
+        except ValueError: # compressed or tiled
+            return tifffile.imread(photo_dir)
+
+    if Image is None:
+        raise ImportError("the numpy engine needs Pillow for JPEG and PNG photos: pip install pillow")
+    with Image.open(photo_dir) as image:
+        return np.asarray(image)
+
+
+def convert_photo_numpy(photo_dir, calibrated_photo_dir, color_profile_dir, options=OUTPUT_OPTIONS):
+    """
+    convert one demosaiced photo with its color profile in this process, TILE_ROWS rows at a time,
+    so a 16-bit photo is never copied as a whole in floating point. its proxies are made from the
+    same rows. runs in a worker thread.
+
+    Outputs:
+        seconds: the time spent writing the files
+    """
+    transform = dcp.load_transform(color_profile_dir)
+    image = read_image(photo_dir)
+    if np.issubdtype(image.dtype, np.integer):
+        scale = float(np.iinfo(image.dtype).max)
+    else:
+        scale = 1.0
+
+    writer = proxies.OutputWriter(calibrated_photo_dir, image.shape[:2], options)
+    for row in range(0, image.shape[0], TILE_ROWS):
+        chunk = np.asarray(image[row:row + TILE_ROWS], dtype=np.float32) / scale
+        # gray photos have one channel, alpha channels are dropped
+        chunk = np.repeat(chunk[..., None], 3, axis=2) if chunk.ndim == 2 else chunk[..., :3]
+        rgb = transform.apply(dcp.srgb_to_linear(np.clip(chunk, 0, 1)))
+        writer.add(dcp.linear_to_srgb(rgb))
+
+    start = time.perf_counter()
+    writer.write()
+    return time.perf_counter() - start
+
+
+def convert_numpy_batch(batch, options=OUTPUT_OPTIONS, timings=None):
+    "convert a batch of photos with the numpy engine, runs in a worker thread. returns failures like convert_batch"
+    failures = []
+    for photo_dir, calibrated_photo_dir, color_profile_dir in batch:
+        try:
+            seconds = convert_photo_numpy(photo_dir, calibrated_photo_dir, color_profile_dir, options)
+        except (OSError, ValueError, KeyError, IndexError) as error:
+            failures.append((photo_dir, error))
+            continue
+        if timings is not None:
+            timings[calibrated_photo_dir] = seconds
+    return failures
+
+
+def write_report(color_jobs, output_dir, options, timings, report_path):
+    """
+    write the size of the outputs and the time spent writing them per flower, to a .csv file and the terminal.
+
+    Parameters:
+        color_jobs: a list of jobs from list_color_jobs
+        output_dir: the color calibrated photo folder
+        options: a dict of output options
+        timings: a dict of {calibrated_photo_dir: seconds} of the photos converted in this run. with darktable
+                 it is the whole conversion, with numpy only the writing of the files
+        report_path: path of the .csv file
+    """
+    flowers = {}
+    for _, calibrated_photo_dir, _ in color_jobs:
+        date, flower = os.path.relpath(calibrated_photo_dir, output_dir).split(os.sep)[:2]
+        row = flowers.setdefault((date, flower), {"date": date, "flower": flower, "photos": 0, "converted": 0,
+                                                  "bytes": 0, "proxy_bytes": 0, "seconds": 0.0})
+        size, proxy_size = proxies.output_size(calibrated_photo_dir, options)
+        row["photos"] += 1
+        row["bytes"] += size
+        row["proxy_bytes"] += proxy_size
+        if calibrated_photo_dir in timings:
+            row["converted"] += 1
+            row["seconds"] += timings[calibrated_photo_dir]
+
+    with open(report_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["date", "flower", "photos", "converted", "bytes", "proxy_bytes", "seconds"])
+        writer.writeheader()
+        for key in sorted(flowers):
+            row = flowers[key]
+            writer.writerow(dict(row, seconds=round(row["seconds"], 3)))
+            print(f"{row['date']}/{row['flower']}: {row['photos']} photos, {row['bytes'] / 1e6:.1f} MB "
+                  f"(proxies {row['proxy_bytes'] / 1e6:.1f} MB), {row['converted']} converted in {row['seconds']:.1f} s")
+
+
+def run_color(input_dir, output_dir, darktable_dir, img_format, jobs=DEFAULT_JOBS, batch_size=DEFAULT_BATCH_SIZE,
+              force=False, cache_dir=None, engine="darktable", compression="none", tiled=False, bit_depth=None,
+              proxy_factors=(), timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+    """
+    use darktable-cli to run color calirbation
+
+    Parameters:
+        input_dir: photos
+        output_dir: color calibrated photos
+        darktable_dir: path to darktable-cli, not needed by the numpy engine
+        img_format: the photo extension, like CR3
+        jobs: the number of darktable-cli processes running at once
+        batch_size: the maximum number of photos converted by one darktable-cli process, 1 converts one by one
+        force: if True, convert every photo even if its output is up to date
+        cache_dir: a folder sharing outputs of identical photos and profiles across output folders, or None
+        engine: darktable, or numpy to convert JPEG, PNG and TIFF photos in this process (RAW photos
+                are always converted by darktable-cli)
+        compression, tiled, bit_depth: the TIFF layout of the outputs (see photogramkit.proxies)
+        proxy_factors: write proxies downscaled by these factors next to every output, like [2, 4]
+        timeout: seconds per photo after which darktable-cli is killed, None for no timeout
+        retries: how many times darktable-cli is started again after a timeout or a crash
+
+    Outputs:
+        color calirbated photos, and their size and writing time per flower in output_dir/color_report.csv.
+        photos that could not be converted are written to output_dir/color_failures.txt, and a RuntimeError
+        is raised once every other photo was converted
+    """
+    # create output_dir if not exist
+    os.makedirs(output_dir, exist_ok=True)
+
+    # the numpy engine only handles demosaiced photos
+    if engine not in ENGINES:
+        raise ValueError(f"unknown engine {engine}, choose from {', '.join(ENGINES)}")
+    if engine == "numpy" and img_format.upper() not in NUMPY_FORMATS:
+        print(f"The numpy engine cannot convert {img_format} photos, using darktable-cli")
+        engine = "darktable"
+    if engine == "numpy" and tifffile is None:
+        raise ImportError("the numpy engine needs tifffile: pip install tifffile")
+    if engine == "darktable" and not darktable_dir:
+        raise ValueError("the path to darktable-cli is needed to convert photos with darktable")
+
+    options = proxies.output_options(dict(OUTPUT_OPTIONS, engine=engine), compression, tiled, bit_depth, proxy_factors)
+    if tifffile is None and proxies.needs_tifffile(options):
+        raise ImportError("tiled outputs and proxies need tifffile: pip install tifffile")
+
+    color_jobs = list_color_jobs(input_dir, output_dir, img_format)
+
+    # make the output folders once
+    for folder in sorted({os.path.dirname(calibrated_photo_dir) for _, calibrated_photo_dir, _ in color_jobs}):
+        os.makedirs(folder, exist_ok=True)
+
+    # skip outputs that are up to date, and take the ones in the cache
+    cache = ColorCache(output_dir, darktable_dir if engine == "darktable" else None, options=options, cache_dir=cache_dir)
+    fingerprints = {}
+    cache_paths = {}
+    to_convert = []
+    cached = []
+    for job in color_jobs:
+        fingerprints[job] = cache.fingerprint(job)
+        if not force and cache.is_current(job, fingerprints[job]):
+            continue
+
+        if cache_dir is not None:
+            cache_paths[job] = cache.cache_path(job)
+            if not force and os.path.exists(cache_paths[job]):
+                place.place_file(cache_paths[job], job[1], "hardlink")
+                cached.append(job)
+                continue
+        to_convert.append(job)
+
+    # convert the other photos in batches, jobs at a time
+    failures = []
+    timings = {}
+    # --jobs is the CPU budget of the darktable-cli processes, their output goes to output_dir/.photogramkit_logs
+    job_runner = runner.JobRunner(cpus=jobs, log_dir=os.path.join(output_dir, runner.LOG_FOLDER))
+    # the runner is left first, so its programs are killed before the pool waits for them
+    with DarktableWorkers(job_runner, timeout, retries) as workers, ThreadPoolExecutor(max_workers=jobs) as pool, job_runner:
+        if engine == "numpy":
+            futures = [pool.submit(convert_numpy_batch, batch, options, timings)
+                       for batch in batch_color_jobs(to_convert, 1, jobs)]
+        else:
+            futures = [pool.submit(convert_batch, darktable_dir, batch, workers, options, timings)
+                       for batch in batch_color_jobs(to_convert, batch_size, jobs)]
+        # the cache only keeps full resolution photos, make the proxies of the ones taken from it
+        cached_futures = [(job, pool.submit(proxies.finish_output, job[1], options, retile=False)) for job in cached]
+        for future in futures:
+            failures.extend(future.result())
+        for job, future in cached_futures:
+            try:
+                future.result()
+                cache.record(job, fingerprints[job])
+            except (OSError, ValueError) as error:
+                failures.append((job[0], error))
+
+    # remember the new outputs, and keep them in the cache
+    failed = {photo_dir for photo_dir, _ in failures}
+    for job in to_convert:
+        if job[0] in failed:
+            continue
+        cache.record(job, fingerprints[job])
+        if cache_dir is not None:
+            os.makedirs(os.path.dirname(cache_paths[job]), exist_ok=True)
+            place.place_file(job[1], cache_paths[job], "hardlink")
+    cache.save()
+
+    print(f"Converted {len(to_convert) - len(failed & {job[0] for job in to_convert})} of {len(to_convert)} photos, "
+          f"{len(cached)} taken from the cache, {len(color_jobs) - len(to_convert) - len(cached)} up to date")
+    if job_runner.stats()["finished"]:
+        print(f"darktable-cli: {job_runner.summary()}")
+    write_report(color_jobs, output_dir, options, timings, os.path.join(output_dir, REPORT_FILENAME))
+
+    # report every failed photo at the end
+    failures_path = os.path.join(output_dir, FAILURES_FILENAME)
+    if failures:
+        with open(failures_path, "w") as f:
+            for photo_dir, error in failures:
+                output = getattr(error, "stdout", None)
+                f.write(f"{photo_dir}: {error}\n")
+                if output:
+                    f.write(output.decode(errors="replace"))
+        raise RuntimeError(f"{len(failures)} photos could not be converted, see {failures_path}")
+    elif os.path.exists(failures_path):
+        os.remove(failures_path)
 
 def parse_command_line():
     "parses args for the module function"
@@ -101,8 +636,8 @@ def parse_command_line():
     parser.add_argument(
         "-d",
         "--darktable",
-        help="path to the darktable-cli. /Applications/darktable.app/Contents/MacOS/darktable-cli on mac terminal or darktable-cli on Linux system",
-        required = True
+        help="path to the darktable-cli. /Applications/darktable.app/Contents/MacOS/darktable-cli on mac terminal or darktable-cli on Linux system. Not needed with --engine numpy",
+        required = False
         )
 
     # add image format
@@ -114,6 +649,84 @@ def parse_command_line():
         choices=["CR3", "JPEG", "PNG", "TIFF"],  # restrict to valid options
         required = False)
 
+    # add number of parallel conversions
+    parser.add_argument(
+        "--jobs",
+        help=f"number of darktable-cli processes running at once. Default is {DEFAULT_JOBS}",
+        type=int,
+        default=DEFAULT_JOBS,
+        required = False)
+
+    # add batch size
+    parser.add_argument(
+        "--batch-size",
+        help=f"maximum number of photos converted by one darktable-cli process, 1 converts photos one by one. "
+             f"Default is {DEFAULT_BATCH_SIZE}",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        required = False)
+
+    # add incremental options
+    parser.add_argument(
+        "--force",
+        help="convert every photo, even if its output is up to date",
+        action="store_true")
+    parser.add_argument(
+        "--cache-dir",
+        help="a folder keeping converted photos by the content of the photo and color profile, "
+             "shared between output folders",
+        required = False)
+
+    # add conversion engine
+    parser.add_argument(
+        "--engine",
+        help="darktable, or numpy to convert JPEG, PNG and TIFF photos without darktable-cli. Default is darktable",
+        default="darktable",
+        choices=ENGINES,
+        required = False)
+
+    # add output layout
+    parser.add_argument(
+        "--compression",
+        help="TIFF compression of the outputs, deflate is lossless. Default is none",
+        default="none",
+        choices=proxies.COMPRESSIONS,
+        required = False)
+    parser.add_argument(
+        "--tiled",
+        help=f"write tiled TIFFs ({proxies.TILE_SIZE}x{proxies.TILE_SIZE} tiles)",
+        action="store_true")
+    parser.add_argument(
+        "--bit-depth",
+        help="bit depth of the outputs. Default is 16 with numpy, darktable's setting with darktable",
+        type=int,
+        choices=proxies.BIT_DEPTHS,
+        required = False)
+
+    # add darktable-cli timeout and retries
+    parser.add_argument(
+        "--timeout",
+        help=f"seconds per photo after which darktable-cli is killed and started again. Default is {DEFAULT_TIMEOUT}",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        required = False)
+    parser.add_argument(
+        "--retries",
+        help=f"how many times darktable-cli is started again after a timeout or a crash. Default is {DEFAULT_RETRIES}",
+        type=int,
+        default=DEFAULT_RETRIES,
+        required = False)
+
+    # add proxies
+    parser.add_argument(
+        "--proxies",
+        help="also write proxies downscaled by these factors, like --proxies 2 4, for aligning cameras in build",
+        type=int,
+        nargs="+",
+        default=[],
+        choices=proxies.PROXY_FACTORS,
+        required = False)
+
     # parse args
     args = parser.parse_args()
 
@@ -126,7 +739,10 @@ def main():
     args = parse_command_line()
 
     # run color calibration
-    run_color(input_dir = args.input, output_dir = args.output, darktable_dir = args.darktable, img_format = args.format)
+    run_color(input_dir = args.input, output_dir = args.output, darktable_dir = args.darktable, img_format = args.format,
+              jobs = args.jobs, batch_size = args.batch_size, force = args.force, cache_dir = args.cache_dir,
+              engine = args.engine, compression = args.compression, tiled = args.tiled, bit_depth = args.bit_depth,
+              proxy_factors = args.proxies, timeout = args.timeout, retries = args.retries)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+"""
+A reader for DNG camera profiles (.dcp) and a NumPy version of the color transform they describe,
+for photos that are already demosaiced (JPEG, PNG, TIFF).
+
+    A .dcp file is a TIFF structure with the magic "IIRC" holding the profile tags:
+
+    ColorMatrix1/2 (0xc621/0xc622)         XYZ to camera RGB under calibration illuminant 1/2
+    ForwardMatrix1/2 (0xc714/0xc715)       white-balanced camera RGB to XYZ D50
+    ProfileHueSatMapDims (0xc6f9)          hue, saturation and value divisions of the hue/sat maps
+    ProfileHueSatMapData1/2 (0xc6fa/0xc6fb) hue shift (degrees), saturation and value scale per division
+    ProfileLookTableDims/Data (0xc725/0xc726) a second hue/sat map applied after the first
+    ProfileToneCurve (0xc6fc)              (x, y) pairs of the tone curve
+
+    The transform follows the DNG pipeline: camera RGB -> XYZ D50 -> linear ProPhoto RGB,
+    hue/sat map, look table and tone curve in ProPhoto RGB, then sRGB. Input photos are taken as
+    white-balanced camera RGB stored with the sRGB transfer curve. The two calibrations are
+    interpolated for daylight (TARGET_TEMPERATURE), since demosaiced photos carry no as-shot white.
+"""
+
+import functools
+import mmap
+import os
+import struct
+import numpy as np
+from photogramkit import exif
+
+
+# DCP tag ids
+TAG_CALIBRATION_ILLUMINANT = (0xc65a, 0xc65b)
+TAG_COLOR_MATRIX = (0xc621, 0xc622)
+TAG_FORWARD_MATRIX = (0xc714, 0xc715)
+TAG_HUE_SAT_MAP_DIMS = 0xc6f9
+TAG_HUE_SAT_MAP_DATA = (0xc6fa, 0xc6fb)
+TAG_LOOK_TABLE_DIMS = 0xc725
+TAG_LOOK_TABLE_DATA = 0xc726
+TAG_TONE_CURVE = 0xc6fc
+TAG_PROFILE_NAME = 0xc6f8
+
+# TIFF field types as (NumPy dtype, size in bytes)
+FIELD_TYPES = {
+    1: ("u1", 1), 2: ("u1", 1), 3: ("u2", 2), 4: ("u4", 4), 5: ("u4", 8),
+    8: ("i2", 2), 9: ("i4", 4), 10: ("i4", 8), 11: ("f4", 4), 12: ("f8", 8),
+}
+
+# color temperature in kelvin of the EXIF light sources used as calibration illuminants
+ILLUMINANT_TEMPERATURES = {
+    1: 5500, 2: 4200, 3: 2850, 4: 5500, 9: 5500, 10: 6500, 11: 7500, 12: 6400, 13: 5000, 14: 4150,
+    15: 3450, 17: 2856, 18: 4874, 19: 6774, 20: 5503, 21: 6504, 22: 7504, 23: 5003, 24: 3200,
+}
+
+# color temperature the two calibrations are interpolated for
+TARGET_TEMPERATURE = 5500
+
+# pixels transformed at once
+BLOCK_PIXELS = 65536
+
+# XYZ of the D50 white point
+D50 = np.array([0.9642, 1.0, 0.8249])
+
+# linear ProPhoto RGB to XYZ D50
+PROPHOTO_TO_XYZ = np.array([
+    [0.7976749, 0.1351917, 0.0313534],
+    [0.2880402, 0.7118741, 0.0000857],
+    [0.0000000, 0.0000000, 0.8252100],
+])
+
+# XYZ D50 to linear sRGB (Bradford-adapted to D65)
+XYZ_TO_SRGB = np.array([
+    [3.1338561, -1.6168667, -0.4906146],
+    [-0.9787684, 1.9161415, 0.0334540],
+    [0.0719453, -0.2289914, 1.4052427],
+])
+
+# Bradford cone response matrix for chromatic adaptation
+BRADFORD = np.array([
+    [0.8951, 0.2664, -0.1614],
+    [-0.7502, 1.7135, 0.0367],
+    [0.0389, -0.0685, 1.0296],
+])
+
+
+def read_dcp(dcp_path):
+    """
+    read the color tags of a DNG camera profile.
+
+    Parameters:
+        dcp_path: a .dcp file
+
+    Outputs:
+        tags: a dict {tag id: NumPy array (ASCII tags as str)} of the tags listed above
+        raises ValueError if the file is not a camera profile
+    """
+    with open(dcp_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            byte_order = buf[:2]
+            if byte_order == b"II":
+                endian = "<"
+            elif byte_order == b"MM":
+                endian = ">"
+            else:
+                raise ValueError(f"{dcp_path} is not a camera profile")
+
+            # camera profiles use "RC" instead of the TIFF magic number 42
+            magic, first_ifd = struct.unpack_from(endian + "HI", buf, 2)
+            if magic not in (0x4352, 42):
+                raise ValueError(f"{dcp_path} is not a camera profile")
+
+            tags = {}
+            for tag, entry in exif.read_ifd(buf, 0, first_ifd, endian).items():
+                value = _read_value(buf, entry, endian)
+                if value is not None:
+                    tags[tag] = value
+    return tags
+
+
+def _read_value(buf, entry, endian):
+    "read the value of an IFD entry as a NumPy array (rationals divided out) or a str"
+    field_type, count = struct.unpack_from(endian + "HI", buf, entry + 2)
+    if field_type not in FIELD_TYPES:
+        return None
+    dtype, size = FIELD_TYPES[field_type]
+
+    # values of up to 4 bytes are stored in the entry itself, longer ones at an offset
+    start = entry + 8 if size * count <= 4 else struct.unpack_from(endian + "I", buf, entry + 8)[0]
+    n_values = count * 2 if field_type in (5, 10) else count
+    values = np.frombuffer(buf, dtype=endian + dtype, count=n_values, offset=start).astype(np.float64)
+
+    if field_type == 2:
+        return bytes(buf[start:start + count]).split(b"\x00", 1)[0].decode("latin-1")
+    if field_type in (5, 10):
+        numerators, denominators = values[0::2], values[1::2]
+        return numerators / np.where(denominators == 0, 1, denominators)
+    return values
+
+
+def interpolation_weight(illuminants, temperature=TARGET_TEMPERATURE):
+    "the weight of calibration 1 for a color temperature, interpolating in inverse temperature as in the DNG SDK"
+    if len(illuminants) < 2:
+        return 1.0
+    t1, t2 = (ILLUMINANT_TEMPERATURES.get(int(light), 5000) for light in illuminants)
+    if t1 == t2:
+        return 1.0
+    weight = (1 / temperature - 1 / t2) / (1 / t1 - 1 / t2)
+    return float(np.clip(weight, 0, 1))
+
+
+def bradford_adaptation(source_white, target_white=D50):
+    "the matrix adapting XYZ colors from source_white to target_white"
+    source = BRADFORD @ source_white
+    target = BRADFORD @ target_white
+    return np.linalg.inv(BRADFORD) @ np.diag(target / source) @ BRADFORD
+
+
+class DcpTransform:
+    """
+    the color transform of one camera profile, derived once and applied to chunks of pixels.
+
+    Parameters:
+        tags: a dict from read_dcp
+        temperature: the color temperature the two calibrations are interpolated for
+    """
+
+    def __init__(self, tags, temperature=TARGET_TEMPERATURE):
+        illuminants = [tags[tag][0] for tag in TAG_CALIBRATION_ILLUMINANT if tag in tags]
+        weight = interpolation_weight(illuminants, temperature)
+
+        def interpolate(tag_pair):
+            "interpolate a pair of tags, or use the only one present"
+            values = [tags[tag] for tag in tag_pair if tag in tags]
+            if not values:
+                return None
+            if len(values) == 1:
+                return values[0]
+            return weight * values[0] + (1 - weight) * values[1]
+
+        # white-balanced camera RGB to XYZ D50
+        forward_matrix = interpolate(TAG_FORWARD_MATRIX)
+        color_matrix = interpolate(TAG_COLOR_MATRIX)
+        if forward_matrix is not None:
+            camera_to_xyz = forward_matrix.reshape(3, 3)
+        elif color_matrix is not None:
+            # the camera neutral (1, 1, 1) is the white of the photo, adapt it to D50
+            xyz_to_camera = color_matrix.reshape(3, 3)
+            camera_to_xyz = np.linalg.inv(xyz_to_camera)
+            white = camera_to_xyz @ np.ones(3)
+            camera_to_xyz = bradford_adaptation(white / white[1]) @ camera_to_xyz / white[1]
+        else:
+            raise ValueError("the camera profile has neither a ForwardMatrix nor a ColorMatrix")
+
+        self.camera_to_prophoto = (np.linalg.inv(PROPHOTO_TO_XYZ) @ camera_to_xyz).astype(np.float32)
+        self.prophoto_to_srgb = (XYZ_TO_SRGB @ PROPHOTO_TO_XYZ).astype(np.float32)
+
+        # hue/sat map and look table as arrays (value, hue, saturation, 3)
+        self.hue_sat_map = None
+        data = interpolate(TAG_HUE_SAT_MAP_DATA)
+        if data is not None and TAG_HUE_SAT_MAP_DIMS in tags:
+            self.hue_sat_map = _hue_sat_table(tags[TAG_HUE_SAT_MAP_DIMS], data)
+        self.look_table = None
+        if TAG_LOOK_TABLE_DATA in tags and TAG_LOOK_TABLE_DIMS in tags:
+            self.look_table = _hue_sat_table(tags[TAG_LOOK_TABLE_DIMS], tags[TAG_LOOK_TABLE_DATA])
+
+        # tone curve as (x, y) points
+        self.tone_curve = None
+        if TAG_TONE_CURVE in tags and len(tags[TAG_TONE_CURVE]) >= 4:
+            points = tags[TAG_TONE_CURVE].reshape(-1, 2)
+            self.tone_curve = (points[:, 0].astype(np.float32), points[:, 1].astype(np.float32))
+
+    def apply(self, rgb):
+        """
+        transform linear camera RGB to linear sRGB.
+
+        Parameters:
+            rgb: a float32 array (..., 3) of linear camera RGB in [0, 1]
+
+        Outputs:
+            a float32 array of the same shape with linear sRGB in [0, 1]
+        """
+        shape = rgb.shape
+        rgb = rgb.reshape(-1, 3)
+        output = np.empty(rgb.shape, dtype=np.float32)
+
+        # the hue/sat maps need many temporary arrays, keep them small enough for the CPU cache
+        for start in range(0, len(rgb), BLOCK_PIXELS):
+            pixels = rgb[start:start + BLOCK_PIXELS] @ self.camera_to_prophoto.T
+            np.clip(pixels, 0, None, out=pixels)
+
+            for table in (self.hue_sat_map, self.look_table):
+                if table is not None:
+                    pixels = apply_hue_sat_table(pixels, table)
+
+            if self.tone_curve is not None:
+                pixels = np.interp(np.clip(pixels, 0, 1), *self.tone_curve).astype(np.float32)
+
+            np.clip(pixels @ self.prophoto_to_srgb.T, 0, 1, out=output[start:start + BLOCK_PIXELS])
+        return output.reshape(shape)
+
+
+def _hue_sat_table(dims, data):
+    "reshape hue/sat map data stored in value, hue, saturation order into (value, hue, saturation, 3)"
+    hue_divisions, sat_divisions = int(dims[0]), int(dims[1])
+    val_divisions = int(dims[2]) if len(dims) > 2 else 1
+    return np.asarray(data, dtype=np.float32).reshape(val_divisions, hue_divisions, sat_divisions, 3)
+
+
+def rgb_to_hsv(pixels):
+    "convert (n, 3) RGB into hue in [0, 6), saturation and value, as in the DNG SDK"
+    red, green, blue = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+    value = np.maximum(np.maximum(red, green), blue)
+    delta = value - np.minimum(np.minimum(red, green), blue)
+    inverse_delta = np.divide(1, delta, out=np.zeros_like(delta), where=delta > 0)
+
+    # the sector of the largest channel, then the position inside it
+    hue = np.where(value == red, green - blue, np.where(value == green, blue - red, red - green)) * inverse_delta
+    hue += np.where(value == red, np.where(hue < 0, 6, 0), np.where(value == green, 2, 4)).astype(np.float32)
+    saturation = delta * np.divide(1, value, out=np.zeros_like(value), where=value > 0)
+    return hue, saturation, value
+
+
+def hsv_to_rgb(hue, saturation, value):
+    "convert hue in [0, 6), saturation and value back into (n, 3) RGB"
+    rgb = np.empty((len(hue), 3), dtype=np.float32)
+    chroma = value * saturation
+    for channel, n in enumerate((5, 3, 1)):
+        k = n + hue
+        k -= np.where(k >= 6, 6, 0).astype(np.float32)
+        rgb[:, channel] = value - chroma * np.clip(np.minimum(k, 4 - k), 0, 1)
+    return rgb
+
+
+def apply_hue_sat_table(pixels, table):
+    """
+    apply a hue/sat map to (n, 3) linear ProPhoto RGB with trilinear interpolation, the hue wrapping around.
+
+    Parameters:
+        pixels: a float32 array (n, 3)
+        table: an array (value, hue, saturation, 3) of hue shift in degrees, saturation scale and value scale
+    """
+    val_divisions, hue_divisions, sat_divisions, _ = table.shape
+    flat_table = table.reshape(-1, 3)
+    hue, saturation, value = rgb_to_hsv(pixels)
+
+    # positions in the table, the lower corner and the fraction towards the upper corner
+    hue_position = hue * np.float32(hue_divisions / 6)
+    hue_low = np.floor(hue_position).astype(np.int64)
+    hue_fraction = (hue_position - hue_low)[:, None]
+    hue_low %= hue_divisions
+    hue_high = (hue_low + 1) % hue_divisions
+
+    def corners(position, divisions):
+        "lower and upper index and fraction along an axis that does not wrap"
+        if divisions == 1:
+            zero = np.zeros(len(position), dtype=np.int64)
+            return zero, zero, np.float32(0)
+        position = np.clip(position, 0, 1) * np.float32(divisions - 1)
+        low = np.minimum(np.floor(position).astype(np.int64), divisions - 2)
+        return low, low + 1, (position - low)[:, None]
+
+    sat_low, sat_high, sat_fraction = corners(saturation, sat_divisions)
+    val_low, val_high, val_fraction = corners(value, val_divisions)
+
+    def plane(val_index):
+        "bilinear interpolation over hue and saturation in one value plane, with flat indices into the table"
+        base_low = (val_index * hue_divisions + hue_low) * sat_divisions
+        base_high = (val_index * hue_divisions + hue_high) * sat_divisions
+        def lookup(index):
+            # np.take is several times faster than fancy indexing for row gathers
+            return np.take(flat_table, index, axis=0)
+        low = lookup(base_low + sat_low) * (1 - sat_fraction) + lookup(base_low + sat_high) * sat_fraction
+        high = lookup(base_high + sat_low) * (1 - sat_fraction) + lookup(base_high + sat_high) * sat_fraction
+        return low * (1 - hue_fraction) + high * hue_fraction
+
+    modifiers = plane(val_low)
+    if val_divisions > 1:
+        modifiers = modifiers * (1 - val_fraction) + plane(val_high) * val_fraction
+
+    hue = hue + modifiers[:, 0] * np.float32(6 / 360)
+    hue -= np.floor(hue * np.float32(1 / 6)) * 6
+    saturation = np.clip(saturation * modifiers[:, 1], 0, 1)
+    value = value * modifiers[:, 2]
+    return hsv_to_rgb(hue, saturation, value)
+
+
+@functools.lru_cache(maxsize=64)
+def _load_transform(dcp_path, mtime_ns):
+    "read and derive the transform of a profile, cached by path and modification time"
+    return DcpTransform(read_dcp(dcp_path))
+
+
+def load_transform(dcp_path):
+    "the DcpTransform of a .dcp file, derived once per profile and run unless the file changes"
+    return _load_transform(os.path.abspath(dcp_path), os.stat(dcp_path).st_mtime_ns)
+
+
+def srgb_to_linear(values):
+    "decode the sRGB transfer curve of values in [0, 1]"
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4).astype(np.float32)
+
+
+def linear_to_srgb(values):
+    "encode values in [0, 1] with the sRGB transfer curve"
+    return np.where(values <= 0.0031308, values * 12.92, 1.055 * values ** (1 / 2.4) - 0.055).astype(np.float32)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+Functions for finding photos that were already sorted, so they are not processed twice.
+
+    Dumping the same SD card twice, or two date folders holding the same photos, would place
+    the same photo in two flower folders, and color and build would process it twice.
+
+    Every photo gets a cheap partial hash (its size, first and last block). Only photos whose
+    partial hash collides with another photo of the plan, or with a photo placed by an earlier
+    run, are hashed completely. Both hashes are kept in the metadata index (see photogramkit.index),
+    so photos are hashed once across runs.
+
+    Duplicates are skipped (not placed), linked (a symbolic link to the first copy) or kept,
+    and listed in duplicates.csv in the output folder.
+"""
+
+import csv
+import hashlib
+import os
+from photogramkit import transfer
+
+
+# what to do with duplicates, in the order they are offered on the command line
+DUPLICATE_ACTIONS = ["skip", "link", "keep"]
+
+# bytes hashed at the start and at the end of every photo
+PARTIAL_BLOCK_SIZE = 64 * 1024
+
+# name of the duplicates report in the output folder
+REPORT_FILENAME = "duplicates.csv"
+
+# columns of the duplicates report
+REPORT_FIELDS = ["source", "destination", "original_source", "original_destination", "action"]
+
+
+def partial_hash(path, size=None):
+    "return the blake2b hex digest of the size, the first and the last PARTIAL_BLOCK_SIZE bytes of a file"
+    if size is None:
+        size = os.stat(path).st_size
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(size.to_bytes(8, "little"))
+    with open(path, "rb") as f:
+        digest.update(f.read(PARTIAL_BLOCK_SIZE))
+        if size > PARTIAL_BLOCK_SIZE:
+            f.seek(max(size - PARTIAL_BLOCK_SIZE, PARTIAL_BLOCK_SIZE))
+            digest.update(f.read(PARTIAL_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+class HashCache:
+    """
+    hashes of source photos, read from and written to a MetadataIndex.
+
+    Parameters:
+        index: a MetadataIndex. if None, hashes are only kept in memory
+    """
+
+    def __init__(self, index=None):
+        self.index = index
+        self.hashes = {}
+
+    def _get(self, path, full):
+        "get the partial (full=False) or full hash of a photo, computing it if needed"
+        if path not in self.hashes:
+            stat = os.stat(path)
+            stored = self.index.lookup_hashes(path, stat=stat) if self.index is not None else (None, None)
+            self.hashes[path] = [stat, stored[0], stored[1]]
+
+        stat, partial, complete = self.hashes[path]
+        if not full and partial is None:
+            partial = self.hashes[path][1] = partial_hash(path, stat.st_size)
+            if self.index is not None:
+                self.index.store_hashes(path, partial_hash=partial, stat=stat)
+        if full and complete is None:
+            complete = self.hashes[path][2] = transfer.hash_file(path)
+            if self.index is not None:
+                self.index.store_hashes(path, full_hash=complete, stat=stat)
+        return complete if full else partial
+
+    def partial(self, path):
+        "the partial hash of a photo"
+        return self._get(path, full=False)
+
+    def full(self, path):
+        "the full hash of a photo"
+        return self._get(path, full=True)
+
+
+def find_duplicates(sort_plan, index=None):
+    """
+    find photos of a sort plan with the same content as an earlier photo of the plan,
+    or as a photo placed by an earlier run.
+
+    Parameters:
+        sort_plan: a list of plan entries (see photogramkit.plan)
+        index: a MetadataIndex keeping hashes and placed photos across runs
+
+    Outputs:
+        duplicates: a list of tuple (entry, original)
+        where original is a dict with the source and destination of the first copy
+    """
+    cache = HashCache(index)
+
+    # group photos by partial hash, which only reads two blocks of each photo
+    by_partial = {}
+    for entry in sort_plan:
+        by_partial.setdefault(cache.partial(entry["source"]), []).append(entry)
+
+    sources = {os.path.abspath(entry["source"]) for entry in sort_plan}
+
+    duplicates = []
+    for partial, entries in by_partial.items():
+        # photos placed by earlier runs come first, unless they are placed again now (maybe in another flower)
+        placed = index.find_placed(partial) if index is not None else []
+        candidates = []
+        placed_before = set()
+        for destination, source, full in placed:
+            if source in sources:
+                placed_before.add((source, destination))
+                continue
+            if not os.path.exists(destination):
+                continue
+            if full is None:
+                full = transfer.hash_file(destination)
+                index.store_placed_full_hash(destination, full)
+            candidates.append(({"source": source, "destination": destination}, full))
+
+        if len(entries) + len(candidates) < 2:
+            continue
+
+        # photos placed at the same destination before are the originals, then the first photo of the plan
+        entries = sorted(entries, key=lambda entry: (os.path.abspath(entry["source"]),
+                                                     os.path.abspath(entry["destination"])) not in placed_before)
+
+        # the full hash decides, the first photo with a content is the original
+        originals = {}
+        for original, full in candidates:
+            originals.setdefault(full, original)
+        for entry in entries:
+            full = cache.full(entry["source"])
+            original = originals.setdefault(full, entry)
+            if original is not entry:
+                duplicates.append((entry, {"source": original["source"], "destination": original["destination"]}))
+
+    if index is not None:
+        index.commit()
+    return duplicates
+
+
+def apply_duplicates(sort_plan, duplicates, action="skip"):
+    """
+    remove or link the duplicates found by find_duplicates.
+
+    Parameters:
+        sort_plan: a list of plan entries
+        duplicates: a list from find_duplicates
+        action: skip drops duplicates from the plan, link places them as a symbolic link to the
+                destination of the original (see plan.execute_plan), keep places them like any other photo
+
+    Outputs:
+        sort_plan: the new plan
+    """
+    if action not in DUPLICATE_ACTIONS:
+        raise ValueError(f"unknown duplicate action {action}, choose from {', '.join(DUPLICATE_ACTIONS)}")
+
+    originals = {id(entry): original for entry, original in duplicates}
+    new_plan = []
+    for entry in sort_plan:
+        original = originals.get(id(entry))
+        if original is None or action == "keep":
+            new_plan.append(entry)
+        elif action == "link":
+            new_plan.append(dict(entry, duplicate_of=original["destination"]))
+    return new_plan
+
+
+def write_report(duplicates, action, report_path):
+    "write the duplicates found by find_duplicates and what was done with them to a .csv file"
+    with open(report_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        for entry, original in duplicates:
+            writer.writerow({
+                "source": entry["source"],
+                "destination": entry["destination"],
+                "original_source": original["source"],
+                "original_destination": original["destination"],
+                "action": action,
+            })
+
+
+def record_placed(sort_plan, index):
+    """
+    remember the hashes of the photos of a plan in the index before they are placed (their sources may be moved),
+    so later runs find their duplicates. photos that end up not placed are ignored and pruned by later runs.
+    """
+    cache = HashCache(index)
+    for entry in sort_plan:
+        if entry.get("duplicate_of"):
+            continue
+        partial = cache.partial(entry["source"])
+        index.store_placed(entry["destination"], entry["source"], partial, cache.hashes[entry["source"]][2])
+    index.commit()
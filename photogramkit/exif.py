@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""
+A small built-in reader for the capture time of photos, so sorting does not need to start exiftool.
+
+    Only the few tags needed to sort photos are read:
+
+    DateTimeOriginal (0x9003) and SubSecTimeOriginal (0x9291) from the EXIF IFD,
+    BodySerialNumber (0xa431) or the DNG CameraSerialNumber (0xc62f) for the camera serial.
+
+    Supported containers:
+
+    TIFF / DNG   the file itself is a TIFF structure
+    JPEG         the TIFF structure is in the APP1 "Exif" segment
+    PNG          the TIFF structure is in the eXIf chunk
+    CR3          an ISO base media file, the EXIF IFD is stored as a TIFF structure
+                 in the CMT2 box of Canon's uuid box inside moov (CMT1 holds IFD0)
+
+    The file is memory-mapped, so only the pages holding the headers are read from disk.
+    Anything unexpected makes the reader return None, and the caller falls back to exiftool.
+"""
+
+import mmap
+import struct
+
+
+# EXIF tag ids
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_SUBSEC_TIME_ORIGINAL = 0x9291
+TAG_BODY_SERIAL_NUMBER = 0xa431
+TAG_CAMERA_SERIAL_NUMBER = 0xc62f
+
+# TIFF field type of ASCII strings
+TYPE_ASCII = 2
+
+# Canon's uuid box in the moov box of a CR3 file
+CANON_CR3_UUID = bytes.fromhex("85c0b687820f11e08111f4ce462b6a48")
+
+# an IFD with more entries than this is treated as corrupt
+MAX_IFD_ENTRIES = 1000
+
+
+def read_exif_dates(photo_dir):
+    """
+    read the capture time of one photo without exiftool.
+
+    Parameters:
+        photo_dir: a photo directory (CR3, DNG, TIFF, JPEG or PNG)
+
+    Outputs:
+        metadata: a dict with capture_time (DateTimeOriginal, like '2024:07:04 10:31:05'),
+        subsec_time (SubSecTimeOriginal) and serial (camera serial number), a missing tag is None.
+        None if the file could not be parsed or has no DateTimeOriginal.
+    """
+    try:
+        with open(photo_dir, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                tags = _read_tags(buf)
+    except (OSError, ValueError, struct.error, IndexError):
+        # empty files cannot be mapped (ValueError), truncated files fail to unpack
+        return None
+
+    if not tags or not tags.get(TAG_DATETIME_ORIGINAL):
+        return None
+
+    return {
+        "capture_time": tags[TAG_DATETIME_ORIGINAL],
+        "subsec_time": tags.get(TAG_SUBSEC_TIME_ORIGINAL),
+        "serial": tags.get(TAG_BODY_SERIAL_NUMBER) or tags.get(TAG_CAMERA_SERIAL_NUMBER),
+    }
+
+
+def _read_tags(buf):
+    "dispatch on the file signature and return the wanted tags as {tag: str}"
+    head = buf[:12]
+
+    # TIFF and DNG
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return _read_tiff(buf, 0)
+
+    # JPEG
+    if head[:2] == b"\xff\xd8":
+        tiff_offset = _find_jpeg_exif(buf)
+        return None if tiff_offset is None else _read_tiff(buf, tiff_offset)
+
+    # PNG
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        tiff_offset = _find_png_exif(buf)
+        return None if tiff_offset is None else _read_tiff(buf, tiff_offset)
+
+    # CR3 (ISO base media file with a crx brand)
+    if head[4:8] == b"ftyp" and head[8:12] == b"crx ":
+        tiff_offset = _find_cr3_exif(buf)
+        # the CMT2 box starts directly with the EXIF IFD
+        return None if tiff_offset is None else _read_tiff(buf, tiff_offset, exif_ifd_first=True)
+
+    return None
+
+
+def _read_tiff(buf, base, exif_ifd_first=False):
+    """
+    read the wanted tags of a TIFF structure starting at base.
+    offsets in a TIFF structure are relative to its header.
+    if exif_ifd_first, the first IFD is the EXIF IFD itself (CR3 CMT2 box).
+    """
+    byte_order = buf[base:base + 2]
+    if byte_order == b"II":
+        endian = "<"
+    elif byte_order == b"MM":
+        endian = ">"
+    else:
+        return None
+
+    magic, first_ifd = struct.unpack_from(endian + "HI", buf, base + 2)
+    if magic != 42:
+        return None
+
+    tags = {}
+    ifd0 = read_ifd(buf, base, base + first_ifd, endian)
+
+    if exif_ifd_first:
+        exif_ifd = ifd0
+    else:
+        # IFD0 holds the DNG camera serial and a pointer to the EXIF IFD
+        if TAG_CAMERA_SERIAL_NUMBER in ifd0:
+            tags[TAG_CAMERA_SERIAL_NUMBER] = _read_ascii(buf, base, ifd0[TAG_CAMERA_SERIAL_NUMBER], endian)
+        if TAG_EXIF_IFD not in ifd0:
+            return tags
+        exif_offset = _read_long(buf, ifd0[TAG_EXIF_IFD], endian)
+        exif_ifd = read_ifd(buf, base, base + exif_offset, endian)
+
+    for tag in (TAG_DATETIME_ORIGINAL, TAG_SUBSEC_TIME_ORIGINAL, TAG_BODY_SERIAL_NUMBER):
+        if tag in exif_ifd:
+            tags[tag] = _read_ascii(buf, base, exif_ifd[tag], endian)
+
+    return tags
+
+
+def read_ifd(buf, base, offset, endian):
+    "return {tag: entry offset} for the entries of the IFD at offset, also used to read camera profiles (see photogramkit.dcp)"
+    count = struct.unpack_from(endian + "H", buf, offset)[0]
+    if count > MAX_IFD_ENTRIES:
+        raise ValueError(f"implausible IFD entry count {count}")
+
+    entries = {}
+    for i in range(count):
+        entry = offset + 2 + 12 * i
+        tag = struct.unpack_from(endian + "H", buf, entry)[0]
+        entries[tag] = entry
+    return entries
+
+
+def _read_long(buf, entry, endian):
+    "read the value of a LONG (or IFD) entry"
+    return struct.unpack_from(endian + "I", buf, entry + 8)[0]
+
+
+def _read_ascii(buf, base, entry, endian):
+    "read the value of an ASCII entry, None for any other type"
+    field_type, count = struct.unpack_from(endian + "HI", buf, entry + 2)
+    if field_type != TYPE_ASCII:
+        return None
+
+    # values of up to 4 bytes are stored in the entry itself, longer ones at an offset
+    if count <= 4:
+        start = entry + 8
+    else:
+        start = base + struct.unpack_from(endian + "I", buf, entry + 8)[0]
+
+    raw = buf[start:start + count]
+    if len(raw) != count:
+        raise ValueError("ASCII value runs past the end of the file")
+
+    value = raw.split(b"\x00", 1)[0].decode("ascii", errors="replace").strip()
+    return value or None
+
+
+def _find_jpeg_exif(buf):
+    "return the offset of the TIFF structure in the APP1 Exif segment of a JPEG"
+    offset = 2
+    size = len(buf)
+
+    while offset + 4 <= size:
+        if buf[offset] != 0xff:
+            return None
+        marker = buf[offset + 1]
+
+        # padding bytes between segments
+        if marker == 0xff:
+            offset += 1
+            continue
+
+        # start of scan, no metadata after this point
+        if marker == 0xda:
+            return None
+
+        length = struct.unpack_from(">H", buf, offset + 2)[0]
+        if marker == 0xe1 and buf[offset + 4:offset + 10] == b"Exif\x00\x00":
+            return offset + 10
+
+        offset += 2 + length
+
+    return None
+
+
+def _find_png_exif(buf):
+    "return the offset of the TIFF structure in the eXIf chunk of a PNG"
+    offset = 8
+    size = len(buf)
+
+    while offset + 8 <= size:
+        length, chunk_type = struct.unpack_from(">I4s", buf, offset)
+        if chunk_type == b"eXIf":
+            return offset + 8
+        if chunk_type == b"IEND":
+            return None
+        # length, type, data and crc
+        offset += 12 + length
+
+    return None
+
+
+def _iter_boxes(buf, start, end):
+    "yield (box type, payload start, box end) for the ISO base media boxes between start and end"
+    offset = start
+
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", buf, offset)
+        header = 8
+
+        # 64-bit box size
+        if size == 1:
+            size = struct.unpack_from(">Q", buf, offset + 8)[0]
+            header = 16
+        # box runs to the end of its parent
+        elif size == 0:
+            size = end - offset
+
+        if size < header or offset + size > end:
+            return
+
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def _find_cr3_exif(buf):
+    "return the offset of the CMT2 (EXIF IFD) TIFF structure of a CR3"
+    for box_type, start, end in _iter_boxes(buf, 0, len(buf)):
+        if box_type != b"moov":
+            continue
+
+        for child_type, child_start, child_end in _iter_boxes(buf, start, end):
+            # Canon's metadata box, its payload starts with the 16 byte uuid
+            if child_type != b"uuid" or buf[child_start:child_start + 16] != CANON_CR3_UUID:
+                continue
+
+            for cmt_type, cmt_start, _ in _iter_boxes(buf, child_start + 16, child_end):
+                if cmt_type == b"CMT2":
+                    return cmt_start
+        return None
+
+    return None
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+Functions for grouping the photos of all cameras of one date into shooting sessions at once.
+
+    Grouping each camera on its own and matching the groups by their order breaks as soon as
+    one camera has an extra or a missing burst: every later flower is shifted. Here the
+    timestamps of all cameras are put into NumPy arrays, the clock offset of each camera
+    is estimated from the starts of its sessions, and the corrected timestamps of all cameras
+    are cut into sessions together wherever every camera paused for longer than max_time_diff:
+
+    bottom   ||||    |||||||||||        ||||    ||||||||||
+    middle    |||    ||||||||||          |||    |||||||||||
+    top      ||||     ||||||||||        ||||
+             -----   -----------        -----   -----------
+             session session            session session
+
+    A session missing on one camera only leaves that camera out of the session.
+"""
+
+import numpy as np
+
+
+# gaps are clipped to this many seconds before taking their log
+MIN_GAP = 1e-3
+
+# the smallest gap between sessions must be this many times the largest gap inside a session
+MIN_SEPARATION = 3.0
+
+
+def timestamps_to_arrays(timestamps_by_camera, sort_by_time=True):
+    """
+    convert the timestamps of each camera into arrays sorted by time.
+
+    Parameters:
+        timestamps_by_camera: a dict {camera: timestamps}
+        where timestamps is a list of tuple (photo name, datetime) from extract_time_for_photos_in_one_camera
+        sort_by_time: if False, keep the photos in the given order
+
+    Outputs:
+        arrays: a dict {camera: (photo names, seconds)}
+        where photo names is a NumPy array of names and seconds a float64 array of capture times in seconds
+    """
+    arrays = {}
+    for camera, timestamps in timestamps_by_camera.items():
+        names = np.array([photo for photo, _ in timestamps], dtype=object)
+        times = np.array([timestamp for _, timestamp in timestamps], dtype="datetime64[us]")
+        seconds = times.astype(np.int64) / 1e6
+
+        # file names do not always follow capture order (e.g. IMG_9999 -> IMG_0001)
+        if sort_by_time:
+            order = np.argsort(seconds, kind="stable")
+            names, seconds = names[order], seconds[order]
+        arrays[camera] = (names, seconds)
+    return arrays
+
+
+def camera_gaps(arrays):
+    "return the gaps in seconds between consecutive photos of each camera, all cameras in one array"
+    gaps = [np.diff(seconds) for _, seconds in arrays.values() if len(seconds) > 1]
+    return np.concatenate(gaps) if gaps else np.empty(0)
+
+
+def adaptive_gap_threshold(gaps, default, bins=256, min_separation=MIN_SEPARATION):
+    """
+    pick the pause that separates sessions from the gaps between consecutive photos.
+
+    gaps inside a session (seconds) and between sessions (minutes) form two clusters on a log scale.
+    they are split with Otsu's method on a histogram of the log gaps, which is linear in the number of gaps.
+    if the gaps do not form two clearly separated clusters (e.g. a single session), default is used.
+
+    Parameters:
+        gaps: an array of gaps in seconds, from camera_gaps
+        default: the threshold in seconds used when the gaps cannot be split
+        bins: the number of histogram bins
+        min_separation: the minimal ratio between the smallest long gap and the largest short gap
+
+    Outputs:
+        threshold: the session break threshold in seconds
+    """
+    # photos taken in the same second (without sub-second time) have a gap of 0
+    log_gaps = np.log10(np.maximum(np.asarray(gaps, dtype=np.float64), MIN_GAP))
+    if len(log_gaps) < 2 or np.ptp(log_gaps) == 0:
+        return default
+
+    counts, edges = np.histogram(log_gaps, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    # class weights and means for every split position
+    weight_low = np.cumsum(counts)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(counts * centers)
+    mean_low = sum_low / np.maximum(weight_low, 1)
+    mean_high = (sum_low[-1] - sum_low) / np.maximum(weight_high, 1)
+
+    # the split with the largest between-class variance
+    between = weight_low * weight_high * (mean_low - mean_high) ** 2 / weight_low[-1] ** 2
+    split = int(np.argmax(between))
+    edge = edges[split + 1]
+    largest_short = log_gaps[log_gaps <= edge].max()
+    smallest_long = log_gaps[log_gaps > edge].min()
+
+    # both clusters need a clear empty band between them
+    if smallest_long - largest_short < np.log10(min_separation):
+        return default
+
+    # put the threshold halfway (on the log scale) between the largest short gap and the smallest long gap
+    return float(10 ** ((largest_short + smallest_long) / 2))
+
+
+def session_starts(seconds, max_gap):
+    "return the first capture time of every session of one camera, given sorted capture times in seconds"
+    if len(seconds) == 0:
+        return seconds
+    is_start = np.concatenate([[True], np.diff(seconds) > max_gap])
+    return seconds[is_start]
+
+
+def nearest_values(values, sorted_reference):
+    "return the element of the sorted array sorted_reference that is nearest to each element of values"
+    if len(sorted_reference) == 1:
+        return np.full(np.shape(values), sorted_reference[0])
+    right = np.clip(np.searchsorted(sorted_reference, values), 1, len(sorted_reference) - 1)
+    left = right - 1
+    use_left = np.abs(values - sorted_reference[left]) <= np.abs(values - sorted_reference[right])
+    return np.where(use_left, sorted_reference[left], sorted_reference[right])
+
+
+def estimate_clock_offsets(arrays, max_gap):
+    """
+    estimate how far the clock of each camera is ahead of the reference camera (the one with the most sessions).
+
+    every difference between a session start of a camera and a session start of the reference camera is a
+    candidate offset. the candidate that lines up the most session starts (within max_gap) wins, and is
+    refined with the median difference of the lined up starts.
+
+    Parameters:
+        arrays: a dict from timestamps_to_arrays
+        max_gap: the pause in seconds that separates two sessions
+
+    Outputs:
+        offsets: a dict {camera: offset in seconds}, subtract it from the camera's capture times
+    """
+    starts = {camera: session_starts(seconds, max_gap) for camera, (_, seconds) in arrays.items()}
+    if not starts:
+        return {}
+    reference = max(starts, key=lambda camera: len(starts[camera]))
+    reference_starts = starts[reference]
+
+    offsets = {}
+    for camera, camera_starts in starts.items():
+        if camera == reference or len(camera_starts) == 0 or len(reference_starts) == 0:
+            offsets[camera] = 0.0
+            continue
+
+        # all candidate offsets, one per pair of session starts
+        candidates = (camera_starts[:, None] - reference_starts[None, :]).ravel()
+
+        # for each candidate, the distance from every shifted start to its nearest reference start
+        shifted = camera_starts[None, :] - candidates[:, None]
+        matches = np.abs(shifted - nearest_values(shifted, reference_starts)) <= max_gap
+
+        # most lined up starts first, then the smallest offset
+        score = matches.sum(axis=1)
+        best = np.lexsort((np.abs(candidates), -score))[0]
+
+        # refine with the median difference of the matched starts
+        matched = camera_starts[matches[best]]
+        nearest = nearest_values(matched - candidates[best], reference_starts)
+        offsets[camera] = float(np.median(matched - nearest))
+
+    return offsets
+
+
+def group_sessions(arrays, offsets, max_gap):
+    """
+    cut the photos of all cameras into sessions in one pass over the merged, clock-corrected timestamps.
+
+    Parameters:
+        arrays: a dict from timestamps_to_arrays
+        offsets: a dict from estimate_clock_offsets
+        max_gap: the pause in seconds (on all cameras) that separates two sessions
+
+    Outputs:
+        sessions: a list of dict {camera: [photo names]} in capture order.
+        a camera without photos in a session is not in its dict. For example:
+            [{"bottom": [img1, img2], "top": [img1]}, {"bottom": [img3, ...], "middle": [...], "top": [...]}]
+    """
+    cameras = [camera for camera in arrays if len(arrays[camera][1]) > 0]
+    if not cameras:
+        return []
+
+    # merge all cameras, remembering where each camera starts in the merged array
+    corrected = np.concatenate([arrays[camera][1] - offsets.get(camera, 0.0) for camera in cameras])
+    bounds = np.cumsum([0] + [len(arrays[camera][1]) for camera in cameras])
+
+    # a new session starts wherever the merged timeline pauses for longer than max_gap
+    order = np.argsort(corrected, kind="stable")
+    is_start = np.concatenate([[0], np.diff(corrected[order]) > max_gap])
+    session_ids = np.empty(len(corrected), dtype=np.int64)
+    session_ids[order] = np.cumsum(is_start)
+    n_sessions = int(session_ids.max()) + 1
+
+    sessions = [{} for _ in range(n_sessions)]
+    for i, camera in enumerate(cameras):
+        names = arrays[camera][0]
+        camera_ids = session_ids[bounds[i]:bounds[i + 1]]
+
+        # photos of one camera are sorted by time, so their session ids do not decrease
+        splits = np.searchsorted(camera_ids, np.arange(n_sessions + 1))
+        for session_id in np.unique(camera_ids):
+            sessions[session_id][camera] = list(names[splits[session_id]:splits[session_id + 1]])
+
+    return sessions
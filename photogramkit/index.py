@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+"""
+A persistent index of photo metadata, so re-running sort does not read the same photos again.
+
+    The index is a SQLite file in the root of the sort output folder:
+
+    ./photos-organized
+    ├── .photogramkit_index.sqlite
+    ├── 070324
+    └── 070424
+
+    Each photo is keyed by its absolute path and stored together with its size and
+    modification time. A photo whose size or modification time changed is read again.
+    The content hashes used to find duplicate photos (see photogramkit.dedupe) are kept
+    next to the metadata, together with the hashes of every photo placed in the output folder.
+"""
+
+import os
+import sqlite3
+
+
+# name of the index file in the output folder
+INDEX_FILENAME = ".photogramkit_index.sqlite"
+
+# bump when the table layout changes, older index files are then rebuilt
+SCHEMA_VERSION = 2
+
+
+class MetadataIndex:
+    """
+    an on-disk index of photo metadata keyed by path, size and mtime.
+
+    Parameters:
+        index_path: path of the SQLite file, created if not exist
+        rebuild: if True, drop everything already stored and start from an empty index
+        read_only: if True, work on a copy of the index in memory, so nothing is written to disk
+    """
+
+    def __init__(self, index_path, rebuild=False, read_only=False):
+        self.index_path = index_path
+
+        if read_only:
+            # what is stored is lost on close, the index file and its folder are left as they are
+            self.connection = sqlite3.connect(":memory:")
+            if os.path.exists(index_path):
+                with sqlite3.connect(f"file:{os.path.abspath(index_path)}?mode=ro", uri=True) as disk:
+                    disk.backup(self.connection)
+        else:
+            # create the parent folder if not exist
+            os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+            self.connection = sqlite3.connect(index_path)
+
+        # start from an empty table if asked to, or if the file was written by another version
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if rebuild or version != SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS photos")
+            self.connection.execute("DROP TABLE IF EXISTS placed")
+
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS photos (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                capture_time TEXT,
+                subsec_time TEXT,
+                serial TEXT,
+                format TEXT,
+                partial_hash TEXT,
+                full_hash TEXT
+            )
+            """)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS placed (
+                destination TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                partial_hash TEXT NOT NULL,
+                full_hash TEXT
+            )
+            """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS placed_partial_hash ON placed (partial_hash)")
+        self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        "commit and close the index file"
+        self.connection.commit()
+        self.connection.close()
+
+    def lookup(self, photo_dir, stat=None):
+        """
+        get the stored metadata of one photo.
+
+        Parameters:
+            photo_dir: a photo directory
+            stat: the os.stat result of the photo, if the caller already has it
+
+        Outputs:
+            metadata: a dict with capture_time, subsec_time, serial and format,
+            or None if the photo is not indexed or changed since it was indexed
+        """
+        if stat is None:
+            stat = os.stat(photo_dir)
+
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, capture_time, subsec_time, serial, format FROM photos WHERE path = ?",
+            (os.path.abspath(photo_dir),)).fetchone()
+
+        # invalidate entries of photos that were replaced or modified
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+
+        return {"capture_time": row[2], "subsec_time": row[3], "serial": row[4], "format": row[5]}
+
+    def store(self, photo_dir, metadata, stat=None):
+        """
+        add or replace the metadata of one photo. its stored hashes are dropped.
+
+        Parameters:
+            photo_dir: a photo directory
+            metadata: a dict with capture_time, subsec_time, serial and format
+            stat: the os.stat result of the photo, if the caller already has it
+        """
+        if stat is None:
+            stat = os.stat(photo_dir)
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?, ?, ?, NULL, NULL)",
+            (os.path.abspath(photo_dir), stat.st_size, stat.st_mtime_ns,
+             metadata.get("capture_time"), metadata.get("subsec_time"),
+             metadata.get("serial"), metadata.get("format")))
+
+    def lookup_hashes(self, photo_dir, stat=None):
+        """
+        get the stored content hashes of one photo.
+
+        Parameters:
+            photo_dir: a photo directory
+            stat: the os.stat result of the photo, if the caller already has it
+
+        Outputs:
+            a tuple (partial hash, full hash), None for a hash that is not stored
+            or if the photo changed since it was hashed
+        """
+        if stat is None:
+            stat = os.stat(photo_dir)
+
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, partial_hash, full_hash FROM photos WHERE path = ?",
+            (os.path.abspath(photo_dir),)).fetchone()
+
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None, None
+        return row[2], row[3]
+
+    def store_hashes(self, photo_dir, partial_hash=None, full_hash=None, stat=None):
+        """
+        remember the content hashes of one photo, a hash given as None keeps the stored one.
+
+        Parameters:
+            photo_dir: a photo directory
+            partial_hash: the hash from dedupe.partial_hash
+            full_hash: the hash from transfer.hash_file
+            stat: the os.stat result of the photo, if the caller already has it
+        """
+        if stat is None:
+            stat = os.stat(photo_dir)
+
+        # a photo indexed with another size or mtime keeps its entry until its metadata is read again
+        self.connection.execute(
+            """
+            INSERT INTO photos (path, size, mtime_ns, partial_hash, full_hash) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                partial_hash = COALESCE(excluded.partial_hash, partial_hash),
+                full_hash = COALESCE(excluded.full_hash, full_hash)
+            WHERE size = excluded.size AND mtime_ns = excluded.mtime_ns
+            """,
+            (os.path.abspath(photo_dir), stat.st_size, stat.st_mtime_ns, partial_hash, full_hash))
+
+    def store_placed(self, destination, source, partial_hash, full_hash=None):
+        "remember that the photo source with the given hashes was placed at destination"
+        self.connection.execute(
+            "INSERT OR REPLACE INTO placed VALUES (?, ?, ?, ?)",
+            (os.path.abspath(destination), os.path.abspath(source), partial_hash, full_hash))
+
+    def store_placed_full_hash(self, destination, full_hash):
+        "add the full hash of a placed photo, once it was needed"
+        self.connection.execute(
+            "UPDATE placed SET full_hash = ? WHERE destination = ?", (full_hash, os.path.abspath(destination)))
+
+    def find_placed(self, partial_hash):
+        """
+        get the photos placed by earlier runs with the given partial hash.
+
+        Outputs:
+            a list of tuple (destination, source, full hash), full hash is None if it was never needed
+        """
+        return self.connection.execute(
+            "SELECT destination, source, full_hash FROM placed WHERE partial_hash = ?", (partial_hash,)).fetchall()
+
+    def commit(self):
+        "write stored entries to disk"
+        self.connection.commit()
+
+    def prune(self):
+        """
+        remove entries of photos that no longer exist on disk, and of placed photos
+        that were removed from the output folder.
+
+        Outputs:
+            the number of removed entries
+        """
+        paths = [row[0] for row in self.connection.execute("SELECT path FROM photos")]
+        missing = [(path,) for path in paths if not os.path.exists(path)]
+        self.connection.executemany("DELETE FROM photos WHERE path = ?", missing)
+
+        destinations = [row[0] for row in self.connection.execute("SELECT destination FROM placed")]
+        removed = [(path,) for path in destinations if not os.path.lexists(path)]
+        self.connection.executemany("DELETE FROM placed WHERE destination = ?", removed)
+
+        self.connection.commit()
+        return len(missing) + len(removed)
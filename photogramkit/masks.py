@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""
+Functions for making the background masks of the photos before they reach Metashape.
+
+    The rig and its background do not change during a session, so instead of Metashape comparing
+    every photo with the background photo in every project, the masks are made here with NumPy, by
+    a pool of processes: a pixel is kept if one of its channels differs from the background by more
+    than the tolerance of the Metashape settings, then every pixel takes the value of most pixels
+    around it, removing specks and filling pinholes.
+
+    Every camera can have its own background, in a backgrounds folder with one folder per camera,
+    optionally inside date folders. Several background photos of a camera are combined by their
+    median, computed once before the masks are made and kept as a 16-bit TIFF that the worker
+    processes memory-map. Cameras without a background folder use the background_mask of the
+    Metashape settings:
+
+    ./backgrounds
+    ├── 070424
+    │   └── top
+    │       └── IMG_0100.tiff
+    ├── bottom
+    │   ├── IMG_0001.tiff
+    │   └── IMG_0002.tiff
+    └── top
+        └── IMG_0001.tiff
+
+    Masks are kept in .photogramkit_masks in the 3D model folder, by a fingerprint of the background
+    (its content), the photo (its path, size and modification time) and the mask settings, so a mask
+    is made once, and made again when the photo or the background changes. Proxies (see photogramkit.proxies) are masked against
+    the median background downscaled the same way, kept next to it in the backgrounds folder:
+
+    ./3d-models/.photogramkit_masks
+    ├── 3f
+    │   └── 3f2a...c1.tif
+    └── backgrounds
+        ├── 9b04...e7.tif
+        └── 9b04...e7_2.tif
+
+    metashape.py loads the masks instead of generating them.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+from photogramkit import color
+from photogramkit import proxies
+from photogramkit import transfer
+
+try:
+    import tifffile
+except ImportError: # only needed to make masks
+    tifffile = None
+
+
+# name of the folder keeping the masks, in the 3D model folder
+MASK_FOLDER = ".photogramkit_masks"
+
+# changes when masks are made differently, so masks made before are made again
+MASK_VERSION = 2
+
+# name of the folder keeping the median backgrounds, in the mask folder
+BACKGROUND_FOLDER = "backgrounds"
+
+# width and height of the square of pixels whose majority sets a pixel of the mask
+FILTER_SIZE = 5
+
+# rows of a photo compared with the background at once
+CHUNK_ROWS = 256
+
+# tolerance of the Metashape settings, in levels of 8-bit photos, if they have none
+DEFAULT_TOLERANCE = 10
+
+# file extensions of background photos
+BACKGROUND_EXTENSIONS = (".tif", ".tiff", ".jpg", ".jpeg", ".png")
+
+
+def background_files(folder):
+    "the background photos in a folder, an empty list if it does not exist"
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if os.path.splitext(name)[1].lower() in BACKGROUND_EXTENSIONS and not name.startswith('.'))
+
+
+def find_backgrounds(backgrounds_dir, date, camera, default):
+    """
+    the background photos of a camera.
+
+    Parameters:
+        backgrounds_dir: the backgrounds folder, or None
+        date: the date folder of the photos
+        camera: the camera folder of the photos
+        default: the background photo used for cameras without a background folder
+
+    Outputs:
+        a list of background photo paths
+    """
+    if backgrounds_dir is not None:
+        for folder in (os.path.join(backgrounds_dir, date, camera), os.path.join(backgrounds_dir, camera)):
+            found = background_files(folder)
+            if found:
+                return found
+    return [default]
+
+
+def photo_factor(photo_path):
+    "the factor a photo is downscaled by: that of its proxy folder (see photogramkit.proxies), 1 for other photos"
+    folder = os.path.basename(os.path.dirname(photo_path))
+    for factor in proxies.PROXY_FACTORS:
+        if folder == proxies.proxy_folder(factor):
+            return factor
+    return 1
+
+
+def rgb_rows(image, row, rows):
+    "rows of an image as float32 RGB in [0, 1], gray images have their channel repeated and alpha is dropped"
+    scale = float(np.iinfo(image.dtype).max) if np.issubdtype(image.dtype, np.integer) else 1.0
+    chunk = np.asarray(image[row:row + rows], dtype=np.float32) / scale
+    return np.repeat(chunk[..., None], 3, axis=2) if chunk.ndim == 2 else chunk[..., :3]
+
+
+def write_tiff(path, image):
+    "write an array to a TIFF file that can be memory-mapped, a build running at the same time may write it too"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    tifffile.imwrite(temporary_path, image, photometric="rgb" if image.ndim == 3 else "minisblack")
+    os.replace(temporary_path, path)
+
+
+def write_background(background_paths, background_file):
+    """
+    write the median of the background photos of a camera as 16-bit RGB, CHUNK_ROWS rows at a time,
+    so only the rows being combined are held in floating point.
+    """
+    if tifffile is None:
+        raise ImportError("making masks needs tifffile: pip install tifffile")
+    frames = [color.read_image(path) for path in background_paths]
+    if len({frame.shape[:2] for frame in frames}) > 1:
+        raise ValueError(f"the background photos {', '.join(background_paths)} do not have the same size")
+
+    background = np.empty(frames[0].shape[:2] + (3,), dtype=np.uint16)
+    for row in range(0, background.shape[0], CHUNK_ROWS):
+        chunks = [rgb_rows(frame, row, CHUNK_ROWS) for frame in frames]
+        median = chunks[0] if len(chunks) == 1 else np.median(np.stack(chunks), axis=0)
+        background[row:row + CHUNK_ROWS] = np.round(median * 65535)
+    write_tiff(background_file, background)
+
+
+def write_proxy_background(background_file, factor, proxy_file):
+    "write the median background downscaled by factor, the same way as the proxies of the photos"
+    background = tifffile.memmap(background_file, mode="r")
+    height = background.shape[0] // factor
+    proxy = np.empty((height, background.shape[1] // factor, 3), dtype=np.uint16)
+    for row in range(0, height, CHUNK_ROWS):
+        chunk = rgb_rows(background, row * factor, CHUNK_ROWS * factor)
+        proxy[row:row + CHUNK_ROWS] = np.round(proxies.downscale(chunk, factor) * 65535)
+    write_tiff(proxy_file, proxy)
+
+
+@lru_cache(maxsize=2)
+def load_background(background_file):
+    """
+    a median background written by write_background, memory-mapped, so the worker processes share
+    its pages instead of each holding a copy. the photos of a camera go to the same worker.
+    """
+    return tifffile.memmap(background_file, mode="r")
+
+
+def majority_filter(mask, size=FILTER_SIZE):
+    "set every pixel of a boolean mask to the value of most pixels in the size x size square around it, as 0 or 255"
+    pad = size // 2
+    sums = np.pad(np.pad(mask, pad, mode="edge").astype(np.int32).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    box = sums[size:, size:] - sums[:-size, size:] - sums[size:, :-size] + sums[:-size, :-size]
+    return np.where(box * 2 > size * size, 255, 0).astype(np.uint8)
+
+
+def background_mask(photo_path, background_file, tolerance):
+    "the mask of a photo against its background, 255 where the photo differs from the background and 0 elsewhere"
+    image = color.read_image(photo_path)
+    background = load_background(background_file)
+    if background.shape[:2] != image.shape[:2]:
+        raise ValueError(f"the background {background.shape[1]}x{background.shape[0]} does not match "
+                         f"a {image.shape[1]}x{image.shape[0]} photo")
+
+    mask = np.empty(image.shape[:2], dtype=bool)
+    for row in range(0, image.shape[0], CHUNK_ROWS):
+        difference = np.abs(rgb_rows(image, row, CHUNK_ROWS) - rgb_rows(background, row, CHUNK_ROWS)).max(axis=2)
+        mask[row:row + CHUNK_ROWS] = difference * 255 > tolerance
+    return majority_filter(mask)
+
+
+def make_mask(task):
+    "make and write the mask of one photo, runs in a worker process. returns (photo_path, error or None)"
+    photo_path, background_file, mask_path, tolerance = task
+    try:
+        mask = background_mask(photo_path, background_file, tolerance)
+        os.makedirs(os.path.dirname(mask_path), exist_ok=True)
+        # a build running at the same time may be writing the same mask
+        temporary_path = f"{mask_path}.{os.getpid()}.tmp"
+        tifffile.imwrite(temporary_path, mask, compression="zlib", photometric="minisblack")
+        os.replace(temporary_path, mask_path)
+        return photo_path, None
+    except (OSError, ValueError, ImportError) as error:
+        return photo_path, str(error)
+
+
+class MaskCache:
+    """
+    the masks of a 3D model folder, kept by a fingerprint of their background, photo and settings.
+
+    Parameters:
+        cache_dir: the folder keeping the masks
+        tolerance: the tolerance of the Metashape settings, in levels of 8-bit photos
+    """
+
+    def __init__(self, cache_dir, tolerance=DEFAULT_TOLERANCE):
+        self.cache_dir = cache_dir
+        self.settings = {"version": MASK_VERSION, "tolerance": tolerance, "filter": FILTER_SIZE}
+        self.background_hashes = {}
+
+    def _background_hash(self, path):
+        "the hash of a background photo, computed once per run"
+        if path not in self.background_hashes:
+            self.background_hashes[path] = transfer.hash_file(path)
+        return self.background_hashes[path]
+
+    def background_file(self, background_paths, factor=1):
+        """
+        the median of the background photos of a camera, downscaled by factor for proxies,
+        written the first time it is needed. raises OSError, ValueError or ImportError if it cannot be made
+        """
+        key = color.fingerprint({"version": MASK_VERSION, "background": [self._background_hash(path)
+                                                                        for path in background_paths]})
+        background_file = os.path.join(self.cache_dir, BACKGROUND_FOLDER, f"{key}.tif")
+        if not os.path.exists(background_file):
+            write_background(background_paths, background_file)
+        if factor == 1:
+            return background_file
+
+        proxy_file = os.path.join(self.cache_dir, BACKGROUND_FOLDER, f"{key}_{factor}.tif")
+        if not os.path.exists(proxy_file):
+            write_proxy_background(background_file, factor, proxy_file)
+        return proxy_file
+
+    def mask_path(self, photo_path, background_paths):
+        "where the mask of a photo against its background is kept"
+        stat = os.stat(photo_path)
+        key = color.fingerprint(dict(self.settings, source=[os.path.abspath(photo_path), stat.st_size, stat.st_mtime_ns],
+                                     background=[self._background_hash(path) for path in background_paths]))
+        return os.path.join(self.cache_dir, key[:2], f"{key}.tif")
+
+    def make_masks(self, photo_backgrounds, jobs=None):
+        """
+        make the masks of photos that are not in the cache yet, in a pool of processes.
+
+        Parameters:
+            photo_backgrounds: a dict of {photo path: list of background photo paths}
+            jobs: the number of processes, default is one per CPU core
+
+        Outputs:
+            mask_files: a dict of {photo path: mask path} of the photos with a mask
+            failures: a list of tuple (photo path, error message)
+            made: the number of masks made, the other masks were in the cache
+        """
+        mask_files, failures, tasks = {}, [], []
+        # {(background paths, factor): background file or the error making it}
+        background_files = {}
+        for photo_path, background_paths in photo_backgrounds.items():
+            try:
+                mask_path = self.mask_path(photo_path, background_paths)
+            except OSError as error:
+                failures.append((photo_path, str(error)))
+                continue
+            if os.path.exists(mask_path):
+                mask_files[photo_path] = mask_path
+                continue
+
+            # the median of every background is made once, here, and only read by the workers
+            key = (tuple(background_paths), photo_factor(photo_path))
+            if key not in background_files:
+                try:
+                    background_files[key] = self.background_file(*key)
+                except (OSError, ValueError, ImportError) as error:
+                    background_files[key] = error
+            if isinstance(background_files[key], Exception):
+                failures.append((photo_path, str(background_files[key])))
+                continue
+            mask_files[photo_path] = mask_path
+            tasks.append((photo_path, background_files[key], mask_path, self.settings["tolerance"]))
+
+        # the photos of a camera go to the same worker, which maps their background once
+        tasks.sort(key=lambda task: task[1])
+        jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+        if jobs <= 1:
+            results = list(map(make_mask, tasks))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(make_mask, tasks, chunksize=max(1, len(tasks) // (jobs * 4))))
+
+        made = 0
+        for photo_path, error in results:
+            if error is not None:
+                failures.append((photo_path, error))
+                del mask_files[photo_path]
+            else:
+                made += 1
+        return mask_files, failures, made
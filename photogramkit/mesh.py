@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+
+"""
+Functions for making lighter levels of detail of the models exported by the build stage.
+
+    Models of millions of faces are too heavy for most 3D viewers. The binary .ply models exported
+    by metashape.py are memory-mapped as NumPy structured arrays and read a million rows at a time,
+    so a model is never copied into memory as a whole. Every level of detail is made by vertex
+    clustering: the bounding box of the model is cut into a grid of cubes (grid cubes along its
+    longest side), the vertices of a cube are merged into their mean (with their mean color), and
+    faces left with fewer than 3 different vertices are dropped. Texture coordinates and normals
+    are not kept.
+
+    Memory does not grow with the faces of the model: the kept faces of a level of detail are
+    written to a temporary file a chunk at a time, and faces merged into a triangle already kept
+    are found in a sorted array of the triangles kept so far. Making a level of detail holds 4 bytes
+    per vertex of the model (its cluster), about 100 bytes per vertex of the level of detail, 16 bytes
+    per face of the level of detail, and a chunk of rows.
+
+    Only binary .ply models can be memory-mapped, .obj models (model_export format ModelFormatOBJ)
+    are reported and skipped.
+
+    ./3d-models/species/2024_site_accession_replicate
+    ├── 2024_site_accession_replicate.ply
+    ├── 2024_site_accession_replicate_lod1.ply   (grid 256)
+    └── 2024_site_accession_replicate_lod2.ply   (grid 64)
+
+    The vertex and face counts and the bounding box of every model and level of detail are written
+    to mesh_report.csv in the input folder.
+"""
+
+import argparse
+import csv
+import os
+import re
+import numpy as np
+
+
+# grid cubes along the longest side of the bounding box of every level of detail, finest first
+DEFAULT_GRIDS = [256, 64]
+
+# rows of vertices or faces read at once
+CHUNK_SIZE = 1 << 20
+
+# name of the report in the input folder
+REPORT_FILENAME = "mesh_report.csv"
+
+# columns of the report
+REPORT_FIELDS = ["model", "level", "grid", "vertices", "faces", "min_x", "min_y", "min_z", "max_x", "max_y", "max_z",
+                 "bytes"]
+
+# names of the folders of the quick previews of the build stage, not worth a level of detail
+SKIPPED_FOLDERS = ["preview"]
+
+# extensions of models exported by the build stage that are not .ply, reported as skipped
+SKIPPED_EXTENSIONS = (".obj",)
+
+# file names of levels of detail, not models
+LOD_PATTERN = re.compile(r"_lod\d+\.ply$", re.IGNORECASE)
+
+# NumPy types of the PLY property types
+PLY_TYPES = {"char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1", "short": "i2", "int16": "i2",
+             "ushort": "u2", "uint16": "u2", "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+             "float": "f4", "float32": "f4", "double": "f8", "float64": "f8"}
+
+# names of the property holding the vertices of a face
+FACE_INDEX_NAMES = ["vertex_indices", "vertex_index"]
+
+# key of a triangle of clusters: first * clusters + second cluster, then third cluster, in increasing order
+TRIANGLE_KEY = np.dtype([("first", "<i8"), ("last", "<i8")])
+
+
+def read_header(path):
+    """
+    read the header of a binary PLY file.
+
+    Outputs:
+        header_size: bytes of the header, the data starts after it
+        byte_order: "<" for little endian, ">" for big endian
+        elements: a list of tuple (name, count, properties), properties are tuple (name, type) or
+                  (name, count type, item type) for lists
+    """
+    with open(path, "rb") as f:
+        if f.readline().strip() != b"ply":
+            raise ValueError(f"{path} is not a PLY file")
+        byte_order = None
+        elements = []
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{path} has no end of header")
+            words = line.decode("ascii", errors="replace").split()
+            if not words or words[0] in ("comment", "obj_info"):
+                continue
+            if words[0] == "format":
+                if words[1] == "binary_little_endian":
+                    byte_order = "<"
+                elif words[1] == "binary_big_endian":
+                    byte_order = ">"
+                else:
+                    raise ValueError(f"{path} is an ASCII PLY file, only binary PLY files can be memory-mapped")
+            elif words[0] == "element":
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == "property" and words[1] == "list":
+                elements[-1][2].append((words[4], words[2], words[3]))
+            elif words[0] == "property":
+                elements[-1][2].append((words[2], words[1]))
+            elif words[0] == "end_header":
+                if byte_order is None:
+                    raise ValueError(f"{path} has no format")
+                return f.tell(), byte_order, elements
+
+
+def first_list_lengths(f, offset, properties, byte_order):
+    "the lengths of the list properties of the first row of an element, read at offset"
+    lengths = {}
+    f.seek(offset)
+    for prop in properties:
+        if len(prop) == 2:
+            f.seek(np.dtype(PLY_TYPES[prop[1]]).itemsize, os.SEEK_CUR)
+            continue
+        name, count_type, item_type = prop
+        count_dtype = np.dtype(byte_order + PLY_TYPES[count_type])
+        count = int(np.frombuffer(f.read(count_dtype.itemsize), dtype=count_dtype)[0])
+        lengths[name] = count
+        f.seek(count * np.dtype(PLY_TYPES[item_type]).itemsize, os.SEEK_CUR)
+    return lengths
+
+
+def element_dtype(properties, byte_order, list_lengths):
+    "the structured NumPy type of the rows of an element, with lists of the given lengths"
+    fields = []
+    for prop in properties:
+        if len(prop) == 2:
+            fields.append((prop[0], byte_order + PLY_TYPES[prop[1]]))
+        else:
+            name, count_type, item_type = prop
+            fields.append((f"{name}_count", byte_order + PLY_TYPES[count_type]))
+            fields.append((name, byte_order + PLY_TYPES[item_type], (list_lengths.get(name, 0),)))
+    return np.dtype(fields)
+
+
+def chunks(count, size=CHUNK_SIZE):
+    "the (start, stop) of the chunks of count rows"
+    return [(start, min(start + size, count)) for start in range(0, count, size)]
+
+
+class PlyMesh:
+    """
+    a binary PLY triangle mesh, memory-mapped.
+
+    Parameters:
+        path: path to the .ply file
+
+    vertices and faces are structured arrays backed by the file. Faces of a row must have as many
+    entries in their lists as the first face (3 vertices for Metashape models), check() checks it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        header_size, byte_order, elements = read_header(path)
+
+        self.vertices = None
+        self.faces = None
+        offset = header_size
+        with open(path, "rb") as f:
+            for name, count, properties in elements:
+                list_lengths = first_list_lengths(f, offset, properties, byte_order) if count else {}
+                dtype = element_dtype(properties, byte_order, list_lengths)
+                if name in ("vertex", "face"):
+                    array = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,)) if count \
+                        else np.empty(0, dtype=dtype)
+                    setattr(self, "vertices" if name == "vertex" else "faces", array)
+                elif list_lengths:
+                    # rows after a list of varying length cannot be found
+                    raise ValueError(f"{path} has an element {name} with lists, only vertices and faces can have lists")
+                offset += count * dtype.itemsize
+
+        if self.vertices is None or not all(axis in self.vertices.dtype.names for axis in "xyz"):
+            raise ValueError(f"{path} has no vertex positions")
+        if self.faces is None:
+            self.faces = np.empty(0, dtype=[("vertex_indices_count", "u1"), ("vertex_indices", "<i4", (3,))])
+        self.index_name = next((name for name in FACE_INDEX_NAMES if name in self.faces.dtype.names), None)
+        if self.index_name is None:
+            raise ValueError(f"{path} has faces without vertex indices")
+        self.colors = [name for name in ("red", "green", "blue") if name in self.vertices.dtype.names]
+        if len(self.colors) != 3:
+            self.colors = []
+
+    def check(self):
+        "raise ValueError if a face is not a triangle or a list of a face has another length than the first face"
+        counts = [name for name in self.faces.dtype.names if name.endswith("_count")]
+        for start, stop in chunks(len(self.faces)):
+            for name in counts:
+                length = self.faces.dtype[name[:-len("_count")]].shape[0]
+                if np.any(self.faces[name][start:stop] != length):
+                    raise ValueError(f"{self.path} has faces of different sizes, only triangle meshes are supported")
+        if len(self.faces) and self.faces.dtype[self.index_name].shape[0] != 3:
+            raise ValueError(f"{self.path} is not a triangle mesh")
+
+    def positions(self, start, stop):
+        "the positions of vertices start to stop, as a (n, 3) float64 array"
+        rows = self.vertices[start:stop]
+        return np.stack([rows["x"], rows["y"], rows["z"]], axis=1).astype(np.float64)
+
+    def bounds(self):
+        "the lower and upper corners of the bounding box of the vertices, None if there are none"
+        if len(self.vertices) == 0:
+            return None, None
+        lower = np.full(3, np.inf)
+        upper = np.full(3, -np.inf)
+        for start, stop in chunks(len(self.vertices)):
+            positions = self.positions(start, stop)
+            lower = np.minimum(lower, positions.min(axis=0))
+            upper = np.maximum(upper, positions.max(axis=0))
+        return lower, upper
+
+
+def cluster_vertices(mesh, grid, lower, upper):
+    """
+    merge the vertices of a mesh in the cubes of a grid over its bounding box.
+
+    Outputs:
+        vertex_cluster: the cluster of every vertex of the mesh, clusters are numbered in the order of their cubes
+        positions: a (clusters, 3) array with the mean position of the vertices of every cluster
+        colors: a (clusters, 3) array with their mean color, or None if the vertices have no color
+    """
+    size = max(float((upper - lower).max()) / grid, np.finfo(np.float64).tiny)
+    dims = np.floor((upper - lower) / size).astype(np.int64) + 1
+
+    def vertex_cells(start, stop):
+        "the cube of vertices start to stop, one integer per vertex"
+        cube = np.minimum(((mesh.positions(start, stop) - lower) / size).astype(np.int64), dims - 1)
+        return (cube[:, 0] * dims[1] + cube[:, 1]) * dims[2] + cube[:, 2]
+
+    # the cubes holding vertices, sorted, one per cluster
+    cells = np.empty(0, dtype=np.int64)
+    for start, stop in chunks(len(mesh.vertices)):
+        cells = np.union1d(cells, vertex_cells(start, stop))
+    clusters = len(cells)
+    vertex_cluster = np.empty(len(mesh.vertices), dtype=np.int32 if clusters <= np.iinfo(np.int32).max else np.int64)
+
+    # sums of the positions and colors of every cluster
+    counts = np.zeros(clusters)
+    sums = np.zeros((clusters, 3))
+    color_sums = np.zeros((clusters, 3)) if mesh.colors else None
+    for start, stop in chunks(len(mesh.vertices)):
+        cluster = np.searchsorted(cells, vertex_cells(start, stop))
+        vertex_cluster[start:stop] = cluster
+        counts += np.bincount(cluster, minlength=clusters)
+        positions = mesh.positions(start, stop)
+        for axis in range(3):
+            sums[:, axis] += np.bincount(cluster, weights=positions[:, axis], minlength=clusters)
+        if color_sums is not None:
+            rows = mesh.vertices[start:stop]
+            for channel, name in enumerate(mesh.colors):
+                color_sums[:, channel] += np.bincount(cluster, weights=rows[name], minlength=clusters)
+
+    positions = sums / counts[:, None]
+    colors = color_sums / counts[:, None] if color_sums is not None else None
+    return vertex_cluster, positions, colors
+
+
+def triangle_keys(faces, clusters):
+    "one sortable key per face, equal for faces with the same 3 clusters whatever their orientation"
+    corners = np.sort(faces.astype(np.int64), axis=1)
+    keys = np.empty(len(faces), dtype=TRIANGLE_KEY)
+    keys["first"] = corners[:, 0] * clusters + corners[:, 1]
+    keys["last"] = corners[:, 2]
+    return keys
+
+
+def cluster_faces(mesh, vertex_cluster, clusters, faces_path):
+    """
+    write the faces of a mesh between clusters of vertices, without the faces left with fewer than 3 clusters
+    or twice, to faces_path as rows of 3 int32, a chunk at a time and in the order of the mesh.
+
+    Outputs:
+        the number of faces written
+    """
+    # keys of the triangles written so far, sorted
+    written = np.empty(0, dtype=TRIANGLE_KEY)
+    with open(faces_path, "wb") as f:
+        for start, stop in chunks(len(mesh.faces)):
+            faces = vertex_cluster[mesh.faces[mesh.index_name][start:stop]]
+            keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+            faces = faces[keep]
+
+            # the first face of every triangle of the chunk, if the triangle was not written before
+            keys, first = np.unique(triangle_keys(faces, clusters), return_index=True)
+            found = np.searchsorted(written, keys)
+            new = found == len(written)
+            new[~new] = written[found[~new]] != keys[~new]
+            f.write(faces[np.sort(first[new])].astype("<i4").tobytes())
+            written = np.insert(written, found[new], keys[new])
+    return len(written)
+
+
+def write_ply(path, positions, faces, colors=None, color_type="u1"):
+    "write a binary little endian PLY triangle mesh, a chunk at a time"
+    vertex_dtype = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+    if colors is not None:
+        vertex_dtype += [(name, "<" + color_type) for name in ("red", "green", "blue")]
+    face_dtype = np.dtype([("vertex_indices_count", "u1"), ("vertex_indices", "<i4", (3,))])
+
+    header = ["ply", "format binary_little_endian 1.0", "comment made by photogramkit.mesh",
+              f"element vertex {len(positions)}", "property float x", "property float y", "property float z"]
+    if colors is not None:
+        type_name = next(name for name, code in PLY_TYPES.items() if code == color_type)
+        header += [f"property {type_name} {name}" for name in ("red", "green", "blue")]
+    header += [f"element face {len(faces)}", "property list uchar int vertex_indices", "end_header"]
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        for start, stop in chunks(len(positions)):
+            rows = np.empty(stop - start, dtype=vertex_dtype)
+            for axis, name in enumerate("xyz"):
+                rows[name] = positions[start:stop, axis]
+            if colors is not None:
+                for channel, name in enumerate(("red", "green", "blue")):
+                    rows[name] = np.round(colors[start:stop, channel])
+            f.write(rows.tobytes())
+        for start, stop in chunks(len(faces)):
+            rows = np.empty(stop - start, dtype=face_dtype)
+            rows["vertex_indices_count"] = 3
+            rows["vertex_indices"] = faces[start:stop]
+            f.write(rows.tobytes())
+    os.replace(temporary_path, path)
+
+
+def make_lod(mesh, grid, lod_path, lower, upper):
+    """
+    write a level of detail of a mesh by vertex clustering.
+
+    Parameters:
+        mesh: a PlyMesh
+        grid: grid cubes along the longest side of the bounding box
+        lod_path: path of the level of detail
+        lower, upper: the bounding box of the mesh
+
+    Outputs:
+        a dict with the vertex and face counts and the bounding box of the level of detail
+    """
+    vertex_cluster, positions, colors = cluster_vertices(mesh, grid, lower, upper)
+    faces_path = lod_path + ".faces.tmp"
+    try:
+        n_faces = cluster_faces(mesh, vertex_cluster, len(positions), faces_path)
+        del vertex_cluster
+        faces = np.memmap(faces_path, dtype="<i4", mode="r+", shape=(n_faces, 3)) if n_faces \
+            else np.empty((0, 3), dtype="<i4")
+
+        # clusters used by no face are dropped, unless the mesh has no faces
+        if len(mesh.faces):
+            used = np.zeros(len(positions), dtype=bool)
+            for start, stop in chunks(n_faces):
+                used[faces[start:stop].ravel()] = True
+            renumber = (np.cumsum(used) - 1).astype("<i4")
+            for start, stop in chunks(n_faces):
+                faces[start:stop] = renumber[faces[start:stop]]
+            positions = positions[used]
+            colors = colors[used] if colors is not None else None
+
+        color_type = mesh.vertices.dtype[mesh.colors[0]].str[1:] if colors is not None else "u1"
+        write_ply(lod_path, positions, faces, colors, color_type)
+        del faces
+    finally:
+        if os.path.exists(faces_path):
+            os.remove(faces_path)
+    return model_row(lod_path, len(positions), n_faces, positions.min(axis=0) if len(positions) else None,
+                     positions.max(axis=0) if len(positions) else None)
+
+
+def model_row(path, vertices, faces, lower, upper):
+    "a row of the report"
+    row = {"model": path, "vertices": vertices, "faces": faces, "bytes": os.path.getsize(path)}
+    for corner, name in ((lower, "min"), (upper, "max")):
+        for axis, value in zip("xyz", corner if corner is not None else [None] * 3):
+            row[f"{name}_{axis}"] = round(float(value), 6) if value is not None else None
+    return row
+
+
+def lod_path(model_path, level):
+    "the path of a level of detail of a model, level 1 is the finest"
+    return f"{os.path.splitext(model_path)[0]}_lod{level}.ply"
+
+
+def find_models(input_dir):
+    """
+    find the models in a folder and its subfolders, without levels of detail and previews.
+
+    Outputs:
+        models: the paths of the .ply models
+        skipped: the paths of the models in other formats (.obj), which cannot be memory-mapped
+    """
+    models = []
+    skipped = []
+    for folder, subfolders, names in os.walk(input_dir):
+        subfolders[:] = sorted(name for name in subfolders if not name.startswith('.') and name not in SKIPPED_FOLDERS)
+        for name in sorted(names):
+            if name.startswith('.'):
+                continue
+            if name.lower().endswith(".ply") and not LOD_PATTERN.search(name):
+                models.append(os.path.join(folder, name))
+            elif name.lower().endswith(SKIPPED_EXTENSIONS):
+                skipped.append(os.path.join(folder, name))
+    return models, skipped
+
+
+def process_model(model_path, grids=DEFAULT_GRIDS):
+    """
+    report a model and write its levels of detail.
+
+    Parameters:
+        model_path: path to a binary .ply model
+        grids: grid cubes along the longest side of the bounding box, one per level of detail
+
+    Outputs:
+        rows: a list of dict, the model and its levels of detail, with the REPORT_FIELDS
+    """
+    if any(grid < 1 for grid in grids):
+        raise ValueError("grids must be at least 1")
+    mesh = PlyMesh(model_path)
+    mesh.check()
+    lower, upper = mesh.bounds()
+    rows = [dict(model_row(model_path, len(mesh.vertices), len(mesh.faces), lower, upper), level=0, grid=None)]
+    if lower is None:
+        return rows
+
+    for level, grid in enumerate(sorted(grids, reverse=True), 1):
+        row = make_lod(mesh, grid, lod_path(model_path, level), lower, upper)
+        rows.append(dict(row, level=level, grid=grid))
+    return rows
+
+
+def run_mesh(input_path, grids=DEFAULT_GRIDS):
+    """
+    write the levels of detail of every model of a 3D model folder, and report them.
+
+    Parameters:
+        input_path: a 3D model folder, or one .ply model
+        grids: grid cubes along the longest side of the bounding box, one per level of detail. empty
+               to only report the models
+
+    Outputs:
+        the levels of detail next to their models, and mesh_report.csv in the input folder
+    """
+    if os.path.isdir(input_path):
+        models, skipped = find_models(input_path)
+        report_path = os.path.join(input_path, REPORT_FILENAME)
+    else:
+        models, skipped = [input_path], []
+        report_path = os.path.join(os.path.dirname(os.path.abspath(input_path)), REPORT_FILENAME)
+
+    for model_path in skipped:
+        print(f"Skipping {model_path}: only binary .ply models are read, export models with "
+              f"the ModelFormatPLY format (model_export in the Metashape settings)")
+
+    rows = []
+    for model_path in models:
+        try:
+            model_rows = process_model(model_path, grids)
+        except (OSError, ValueError) as error:
+            print(f"Cannot read {model_path}: {error}")
+            continue
+        for row in model_rows:
+            print(f"{row['model']}: {row['vertices']} vertices, {row['faces']} faces, bounding box "
+                  f"({row['min_x']}, {row['min_y']}, {row['min_z']}) to ({row['max_x']}, {row['max_y']}, {row['max_z']})")
+        rows += model_rows
+
+    with open(report_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"{len(models)} models" + (f", {len(skipped)} skipped" if skipped else "") + f", see {report_path}")
+
+
+def parse_command_line():
+    "parses args for the module function"
+
+    # init parser and add arguments
+    parser = argparse.ArgumentParser()
+
+    # add input 3D model folder or model
+    parser.add_argument("-i", "--input", required=True, help="3D model folder, or a .ply model")
+
+    # add levels of detail
+    parser.add_argument(
+        "--grids",
+        help=f"grid cubes along the longest side of a model, one level of detail per grid, none to only report the models. Default is {' '.join(map(str, DEFAULT_GRIDS))}",
+        type=int,
+        nargs="*",
+        default=DEFAULT_GRIDS,
+        required = False)
+
+    # parse args
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    "run main function on parsed args"
+
+    # get arguments from command line as a dict-like object
+    args = parse_command_line()
+
+    # run levels of detail
+    run_mesh(input_path=args.input, grids=args.grids)
+
+if __name__ == "__main__":
+    main()
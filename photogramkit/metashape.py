@@ -2,68 +2,428 @@
 
 """
 A Python script to be executed by Agisoft Metashape
+
+    build.py writes a project config into the project folder and passes it on the command line:
+
+        MetashapePro -r metashape.py <project folder>/project_config.json
+
+    The project config lists the photos, the project file to save and the Metashape settings
+    (metashape_config.json next to this script by default). If build.py made the background masks
+    (see photogramkit.masks), they are listed in the project config and loaded instead of generated.
+
+    Starting Metashape takes time (license check, Python startup), so build.py can also pass a
+    manifest listing several project configs. They are built one after the other in this session,
+    each in a new document that is closed before the next one. Every project gets a status.json in
+    its folder (running, done or failed, with the time taken or the error). A project already done
+    in the same run (same run_id) is skipped, so a batch restarted after a crash goes on where it
+    stopped.
+
+    The project is saved after each of the 8 steps, and the last step done is kept in the project.
+    A project built again is opened and goes on from the first step not done (checked against the
+    cameras, depth maps and model it holds), unless its photos changed. --from-stage starts again
+    from an earlier step:
+
+        MetashapePro -r metashape.py project_config.json --from-stage alignment
+
+    Every step adds a line to stats.jsonl in the project folder, with its wall time, the peak memory
+    of Metashape so far, and the photo, aligned camera, tie point and face counts after it (and the
+    tie points before filtering for the selection step). build.py summarizes them across flowers.
+
+    The last step exports the textured model next to the project, as a binary .ply by default (see
+    model_export in metashape_config.json), for photogramkit.mesh and 3D viewers.
 """
 
 import Metashape
+import argparse
+import gc
 import json
 import os
+import resource
+import sys
+import time
+import traceback
+
+
+# name of the status record in every project folder, also read by photogramkit.build
+STATUS_FILENAME = "status.json"
+
+# the steps of a build, in order, also used by photogramkit.build
+STAGES = ["photos", "masks", "markers", "alignment", "selection", "mesh", "texture", "export"]
+
+# key of the number of steps done, in the metadata of the chunk
+STAGE_KEY = "photogramkit/stage"
+
+# name of the step statistics (JSON lines) in every project folder, also read by photogramkit.build
+STATS_FILENAME = "stats.jsonl"
+
+# model export settings used if the Metashape settings have none
+DEFAULT_MODEL_EXPORT = {"format": "ModelFormatPLY", "binary": True, "save_texture": True, "save_colors": True,
+                        "save_normals": False}
+
+# file extensions of the exported model formats
+MODEL_EXTENSIONS = {"ModelFormatPLY": ".ply", "ModelFormatOBJ": ".obj"}
+
+
+def use_full_resolution(chunk, proxy_files, photo_files, factor):
+    """
+    point the cameras aligned on proxies at their full resolution photos, and scale the sensor
+    calibrations to the full resolution. camera positions do not change.
+
+    Parameters:
+        chunk: the Metashape chunk
+        proxy_files: the photos the cameras were aligned on
+        photo_files: the full resolution photos, in the same order
+        factor: the proxy downscale factor
+    """
+    full_resolution = {os.path.normpath(proxy): photo for proxy, photo in zip(proxy_files, photo_files)}
+    for camera in chunk.cameras:
+        photo = camera.photo.copy()
+        photo.path = full_resolution[os.path.normpath(camera.photo.path)]
+        camera.photo = photo
+
+    for sensor in chunk.sensors:
+        # proxies drop the last rows and columns that do not fill a block, so the centers differ slightly
+        camera = next(camera for camera in chunk.cameras if camera.sensor == sensor)
+        image = camera.photo.image()
+        proxy = sensor.calibration
+        calibration = Metashape.Calibration()
+        calibration.width, calibration.height = image.width, image.height
+        calibration.f = proxy.f * factor
+        calibration.cx = proxy.cx * factor + (proxy.width * factor - image.width) / 2
+        calibration.cy = proxy.cy * factor + (proxy.height * factor - image.height) / 2
+        calibration.b1, calibration.b2 = proxy.b1 * factor, proxy.b2 * factor
+        # distortion coefficients are relative to f, they do not change
+        calibration.k1, calibration.k2, calibration.k3, calibration.k4 = proxy.k1, proxy.k2, proxy.k3, proxy.k4
+        calibration.p1, calibration.p2 = proxy.p1, proxy.p2
+
+        sensor.width, sensor.height = image.width, image.height
+        if sensor.pixel_width:
+            sensor.pixel_width, sensor.pixel_height = sensor.pixel_width / factor, sensor.pixel_height / factor
+        sensor.user_calib = calibration
+        sensor.calibration = calibration
+        sensor.fixed_calibration = True
+
+
+def generate_masks(chunk, config, config_path):
+    "mask every photo of the chunk with the background photo of the config, relative to the config file"
+    background_path = os.path.join(os.path.dirname(config_path), config["background_mask"])
+    mask_conf = config["masking"]
+
+    chunk.generateMasks(
+        path=background_path,
+        masking_mode=getattr(Metashape, mask_conf["method"]),
+        mask_operation=getattr(Metashape, mask_conf["operation"]),
+        tolerance=mask_conf["tolerance"]
+        )
+
+
+def import_masks(chunk, mask_files):
+    "load the masks made by photogramkit.masks, a dict of {photo path: mask path}, into the cameras of the chunk"
+    mask_files = {os.path.normpath(photo): mask for photo, mask in mask_files.items()}
+    for camera in chunk.cameras:
+        mask = Metashape.Mask()
+        mask.load(mask_files[os.path.normpath(camera.photo.path)])
+        camera.mask = mask
+
+
+def mask_photos(chunk, project_config, config, config_path):
+    "load the masks of the project config if build.py made them, or generate them from the background photo"
+    if "mask_files" in project_config:
+        import_masks(chunk, project_config["mask_files"])
+    else:
+        generate_masks(chunk, config, config_path)
+
+
+def write_status(project_config_path, status):
+    "write the status record of a project next to its config"
+    status_path = os.path.join(os.path.dirname(project_config_path), STATUS_FILENAME)
+    with open(status_path + ".tmp", "w") as f:
+        json.dump(status, f, indent=1)
+    os.replace(status_path + ".tmp", status_path)
+
+
+def read_status(project_config_path):
+    "the status record of a project, or None"
+    status_path = os.path.join(os.path.dirname(project_config_path), STATUS_FILENAME)
+    try:
+        with open(status_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def completed_stages(chunk):
+    """
+    the number of steps done in a saved chunk. a step recorded as done whose result is missing from
+    the chunk (no cameras, no aligned camera, no model, no texture) is done again with the steps after it.
+    """
+    try:
+        done = int(chunk.meta[STAGE_KEY] or 0)
+    except (KeyError, TypeError, ValueError):
+        done = 0
+
+    checks = {
+        1: lambda: len(chunk.cameras) > 0,
+        4: lambda: any(camera.transform for camera in chunk.cameras),
+        6: lambda: chunk.model is not None,
+        7: lambda: chunk.model is not None and bool(getattr(chunk.model, "textures", True)),
+    }
+    for number in range(1, done + 1):
+        if number in checks and not checks[number]():
+            return number - 1
+    return done
+
+
+def start_step():
+    "start measuring a step: resets the peak resident memory on Linux (see peak_rss), returns time.time()"
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    return time.time()
+
+
+def peak_rss():
+    """
+    the peak resident memory of this process, in bytes, and what it covers: "step" for the peak since
+    start_step on Linux, "process" for the peak of the whole process so far elsewhere, which grows
+    with every flower of a batch
+    """
+    if os.access("/proc/self/clear_refs", os.W_OK):
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024, "step"
+        except OSError:
+            pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return (peak if sys.platform == "darwin" else peak * 1024), "process"
+
+
+def tie_point_count(chunk):
+    "the number of tie points of a chunk, None before alignment"
+    # tie_points since Metashape 2.0, point_cloud before
+    tie_points = getattr(chunk, "tie_points", None) or getattr(chunk, "point_cloud", None)
+    return len(tie_points.points) if tie_points is not None else None
 
-def main():
-    # get the config file path (assumes the config is in the same directory as this script)
-    universal_config_path = os.path.join(os.path.dirname(__file__), "metashape_config.json")
-    with open(universal_config_path, 'r') as f:
-        config = json.load(f)
 
+def face_count(chunk):
+    "the number of faces of the model of a chunk, None before the model is built"
+    return len(chunk.model.faces) if chunk.model is not None else None
+
+
+def checkpoint(doc, chunk, number, project_path, project_config_path, started, **stats):
+    """
+    save the project after a step, record the step in the project and in its status, and add the
+    statistics of the step to stats.jsonl. returns the time the next step starts (see start_step).
+
+    Parameters:
+        number: the number of the step done, 1 to 8
+        started: time.time() when the step started
+        stats: more statistics of the step, like tie points before filtering
+    """
+    seconds = time.time() - started
+    peak, peak_scope = peak_rss()
+    chunk.meta[STAGE_KEY] = str(number)
+    doc.save(project_path)
+    status = read_status(project_config_path) or {}
+    write_status(project_config_path, dict(status, stage=STAGES[number - 1]))
+
+    record = dict(
+        run_id=status.get("run_id"),
+        project=os.path.basename(os.path.dirname(project_config_path)),
+        stage=STAGES[number - 1],
+        step=number,
+        seconds=seconds,
+        peak_rss=peak,
+        peak_rss_scope=peak_scope,
+        photos=len(chunk.cameras),
+        aligned=sum(1 for camera in chunk.cameras if camera.transform),
+        tie_points=tie_point_count(chunk),
+        faces=face_count(chunk),
+        **stats)
+    with open(os.path.join(os.path.dirname(project_config_path), STATS_FILENAME), "a") as f:
+        f.write(json.dumps(record) + "\n")
+    return start_step()
+
+
+def open_project(project_path, photo_sets):
+    "open a saved project to go on with, or None if there is none or its photos are not one of photo_sets"
+    if not os.path.exists(project_path):
+        return None
+    doc = Metashape.Document()
+    try:
+        # a project left by a crash is still locked
+        doc.open(project_path, read_only=False, ignore_lock=True)
+    except (OSError, RuntimeError) as error:
+        print(f"Cannot open {project_path}, building it again: {error}")
+        return None
+    if doc.chunk is None or {os.path.normpath(camera.photo.path) for camera in doc.chunk.cameras} not in photo_sets:
+        print(f"The photos of {project_path} changed, building it again")
+        doc.clear()
+        return None
+    return doc
+
+
+def build_project(project_config_path, from_stage=None):
+    """
+    build the 3D model of one project, going on from the first step not done in its saved project.
+    from_stage is the name of a step in STAGES to start again from, even if it was done.
+    """
     # Load project-specific config
-    project_config_path = os.path.join("./", "temp_config.json")
     with open(project_config_path, 'r') as f:
         project_config = json.load(f)
 
+    # get the Metashape settings, next to this script by default
+    universal_config_path = project_config.get("metashape_config",
+                                               os.path.join(os.path.dirname(__file__), "metashape_config.json"))
+    with open(universal_config_path, 'r') as f:
+        config = json.load(f)
+
     photo_files = project_config["photo_files"]
     project_name = project_config["project_name"]
 
+    # cameras may be aligned on downscaled proxies of the photos (see photogramkit.proxies)
+    alignment_photo_files = project_config.get("alignment_photo_files")
+
     # -- initialize project --
-    # get the current project folder from the current working directory (set by build.py)
-    current_project = os.getcwd()
-    project_path = os.path.join(current_project, f"{project_name}.psz")
+    # the project is saved next to its config, unless the config names the project file
+    project_path = project_config.get("project_path",
+                                      os.path.join(os.path.dirname(project_config_path), f"{project_name}.psz"))
 
-    # Open the project specified by project_path
-    doc = Metashape.app.document
-    # Save initial (empty) project to ensure structure
-    # doc.save(project_path)
-    chunk = doc.addChunk()
+    # go on with the saved project, the cameras are on the proxies until step 5 is done
+    photo_sets = [{os.path.normpath(path) for path in files} for files in (photo_files, alignment_photo_files) if files]
+    doc = open_project(project_path, photo_sets)
+    done = completed_stages(doc.chunk) if doc is not None else 0
+    start = done + 1
+    if from_stage is not None:
+        start = min(start, STAGES.index(from_stage) + 1)
+    if start > len(STAGES):
+        print(f"Project {project_name} is already built")
+        doc.clear()
+        return
+    if start > 1:
+        print(f"Going on with {project_path} from step {start}/8 ({STAGES[start - 1]})")
+        chunk = doc.chunk
+    else:
+        # a new document for every project, so projects of a batch do not share memory
+        if doc is not None:
+            doc.clear()
+        doc = Metashape.Document()
+        chunk = doc.addChunk()
 
     # -- step1: Add photos to chunk --
     # Find all image files in the folder (common extensions)
-    print("********** Step 1/7: Loading photos **********")
-    chunk.addPhotos(photo_files)
-    print(f"Loaded {len(chunk.cameras)} images")
-    # doc.save()
+    started = start_step()
+    if start <= 1:
+        print("********** Step 1/8: Loading photos **********")
+        chunk.addPhotos(alignment_photo_files or photo_files)
+        print(f"Loaded {len(chunk.cameras)} images")
+        started = checkpoint(doc, chunk, 1, project_path, project_config_path, started)
 
     # -- step2: Apply background mask to all photos --
-    print("********** Step 2/7: Importing background mask **********")
-    background_path = os.path.join("/Users/yue/Documents/class/25Spring_programming_for_biologists/photogramkit/example-data/", config["background_mask"])
-    mask_conf = config["masking"]
+    if start <= 2:
+        print("********** Step 2/8: Importing background mask **********")
+        mask_photos(chunk, project_config, config, universal_config_path)
+        print("Applied background mask to all images")
+        started = checkpoint(doc, chunk, 2, project_path, project_config_path, started)
 
-    chunk.generateMasks(
-        path=background_path,
-        masking_mode=getattr(Metashape, mask_conf["method"]),
-        mask_operation=getattr(Metashape, mask_conf["operation"]),
-        tolerance=mask_conf["tolerance"]
+    # -- step3: Detect coded markers (12-bit circular) --
+    if start <= 3:
+        print("********** Step 3/8: Detecting markers **********")
+        chunk.detectMarkers(
+            target_type=getattr(Metashape, config["marker_detection"]["target_type"])
+            )
+        print("Detected 12-bit circular markers")
+        started = checkpoint(doc, chunk, 3, project_path, project_config_path, started)
+
+    # -- step4: Align photos with specified parameters --
+    if start <= 4:
+        align_photos(chunk, config)
+        started = checkpoint(doc, chunk, 4, project_path, project_config_path, started)
+
+    # -- step5: Gradual selection and camera optimization, then switch to full resolution photos --
+    if start <= 5:
+        tie_points_before = tie_point_count(chunk)
+        select_tie_points(chunk, config)
+        if alignment_photo_files and os.path.normpath(chunk.cameras[0].photo.path) in photo_sets[1]:
+            use_full_resolution(chunk, alignment_photo_files, photo_files, project_config["proxy_factor"])
+            mask_photos(chunk, project_config, config, universal_config_path)
+            print(f"Using full resolution photos instead of 1/{project_config['proxy_factor']} proxies")
+        started = checkpoint(doc, chunk, 5, project_path, project_config_path, started,
+                             tie_points_before=tie_points_before)
+
+    # -- step6: Build mesh --
+    if start <= 6:
+        print("********** Step 6/8: Building mesh **********")
+        # depth maps saved before a crash while building the model are kept, unless step 6 is done again on purpose
+        depth_maps_started = time.time()
+        if chunk.depth_maps is None or start < 6 or from_stage == "mesh":
+            chunk.buildDepthMaps(
+                downscale=config["depth_maps"]["downscale"],
+                filter_mode=getattr(Metashape, config["depth_maps"]["filter_mode"])
+            )
+            doc.save(project_path)
+        depth_maps_seconds = time.time() - depth_maps_started
+        print(f"Depth maps built (downscale={config['depth_maps']['downscale']}, filter={config['depth_maps']['filter_mode']})")
+        mesh_conf = config["mesh_building"]
+        chunk.buildModel(
+            source_data=getattr(Metashape, mesh_conf["source_data"]),
+            surface_type=getattr(Metashape, mesh_conf["surface_type"]),
+            face_count=getattr(Metashape, mesh_conf["face_count"]),
+            vertex_colors=mesh_conf["vertex_colors"]
         )
-    print("Applied background mask to all images")
-    # doc.save()
+        started = checkpoint(doc, chunk, 6, project_path, project_config_path, started,
+                             depth_maps_seconds=depth_maps_seconds)
 
-    # -- step3: Detect coded markers (12-bit circular) --
-    print("********** Step 3/7: Detecting markers **********")
-    chunk.detectMarkers(
-        target_type=getattr(Metashape, config["marker_detection"]["target_type"])
+    # -- step7: Build texture --
+    if start <= 7:
+        print("********** Step 7/8: Building texture **********")
+        tex_conf = config["texture_building"]
+        chunk.buildUV(mapping_mode=getattr(Metashape, tex_conf["mapping_mode"]))
+        chunk.buildTexture(
+            blending_mode=getattr(Metashape, tex_conf["blending_mode"]),
+            texture_size=tex_conf["texture_size"]
         )
-    print("Detected 12-bit circular markers")
-    # doc.save()
+        print("Texture is mapped to the model.")
+        started = checkpoint(doc, chunk, 7, project_path, project_config_path, started)
 
-    # -- step4: Align photos with specified parameters --
-    print("********** Step 4/7: Aligning photos **********")
+    # -- step8: Export model --
+    print("********** Step 8/8: Exporting model **********")
+    model_path = export_model(chunk, config, project_path)
+    print(f"Model exported to {model_path}")
+
+    # Save project
+    checkpoint(doc, chunk, 8, project_path, project_config_path, started, model_bytes=os.path.getsize(model_path))
+    print("Project saved successfully.")
+
+    # release the photos, depth maps and model before the next project
+    doc.clear()
+    del chunk, doc
+    gc.collect()
+
+
+def export_model(chunk, config, project_path):
+    "export the model of the chunk next to the project file, with the model_export settings of the config. returns its path"
+    export_conf = dict(DEFAULT_MODEL_EXPORT, **config.get("model_export", {}))
+    model_path = os.path.splitext(project_path)[0] + MODEL_EXTENSIONS[export_conf["format"]]
+    chunk.exportModel(
+        path=model_path,
+        format=getattr(Metashape, export_conf["format"]),
+        binary=export_conf["binary"],
+        save_texture=export_conf["save_texture"],
+        save_colors=export_conf["save_colors"],
+        save_normals=export_conf["save_normals"]
+    )
+    return model_path
+
+
+def align_photos(chunk, config):
+    "match and align the photos with the settings of the config"
+    print("********** Step 4/8: Aligning photos **********")
     align_conf = config["photo_alignment"]
     chunk.matchPhotos(
         downscale=align_conf["accuracy_downscale"],
@@ -78,13 +438,16 @@ def main():
     )
     chunk.alignCameras()
     print("Photo matching completed")
-    # doc.save()
 
-    # -- step5: Gradual selection: filter tie points by thresholds from config --
-    # 1) Reconstruction uncertainty
-    # 2) optimize cameras
-    # 3) reprojection error
-    print("********** Step 5/7: Gradual selection and camera optimization **********")
+
+def select_tie_points(chunk, config):
+    """
+    gradual selection: filter tie points by thresholds from config
+    1) Reconstruction uncertainty
+    2) optimize cameras
+    3) reprojection error
+    """
+    print("********** Step 5/8: Gradual selection and camera optimization **********")
     recon_thresh = config["gradual_selection"]["reconstruction_uncertainty_threshold"]
     reproj_thresh = config["gradual_selection"]["reprojection_error_threshold"]
 
@@ -92,46 +455,64 @@ def main():
     f.init(chunk, criterion = Metashape.TiePoints.Filter.ReconstructionUncertainty)
     f.removePoints(threshold=recon_thresh)
     print(f"Removed tie points with reconstruction uncertainty > {recon_thresh}")
-    # doc.save()
 
     chunk.optimizeCameras()
     print("Optimized camera parameters")
-    # doc.save()
 
     f.init(chunk, criterion = Metashape.TiePoints.Filter.ReprojectionError)
     f.removePoints(threshold=reproj_thresh)
     print(f"Removed tie points with reprojection error > {reproj_thresh}")
-    # doc.save()
 
-    # -- step6: Build mesh --
-    print("********** Step 6/7: Building mesh **********")
-    mesh_conf = config["mesh_building"]
-    chunk.buildDepthMaps(
-        downscale=config["depth_maps"]["downscale"],
-        filter_mode=getattr(Metashape, config["depth_maps"]["filter_mode"])
-    )
-    chunk.buildModel(
-        source_data=getattr(Metashape, mesh_conf["source_data"]),
-        surface_type=getattr(Metashape, mesh_conf["surface_type"]),
-        face_count=getattr(Metashape, mesh_conf["face_count"]),
-        vertex_colors=mesh_conf["vertex_colors"]
-    )
-    print(f"Depth maps built (downscale={downscale}, filter={filter_mode_name})")
-    # doc.save()
 
-    # -- step7: Build texture --
-    print("********** Step 7/7: Building texture **********")
-    tex_conf = config["texture_building"]
-    chunk.buildUV(mapping_mode=getattr(Metashape, tex_conf["mapping_mode"]))
-    chunk.buildTexture(
-        blending_mode=getattr(Metashape, tex_conf["blending_mode"]),
-        texture_size=tex_conf["texture_size"]
-    )
-    print("Texture is mapped to the model.")
+def main():
+    # the project config, or a manifest of project configs, passed by build.py
+    parser = argparse.ArgumentParser(prog="MetashapePro -r metashape.py")
+    parser.add_argument("config", help="a project config or a manifest of project configs (.json)")
+    parser.add_argument("--from-stage", choices=STAGES,
+        help="start again from this step, even if it was done. Default is the first step not done")
+    args = parser.parse_args(sys.argv[1:])
 
-    # Save project
-    doc.save()
-    print("Project saved successfully.")
+    with open(args.config, 'r') as f:
+        manifest = json.load(f)
+    if "projects" in manifest:
+        run_id = manifest["run_id"]
+        project_config_paths = manifest["projects"]
+    else:
+        run_id = None
+        project_config_paths = [args.config]
+
+    failed = 0
+    for number, project_config_path in enumerate(project_config_paths, 1):
+        project_config_path = os.path.abspath(project_config_path)
+
+        # skip projects built before a restart of the same batch
+        status = read_status(project_config_path)
+        if run_id is not None and status and status.get("run_id") == run_id and status.get("status") == "done":
+            print(f"Project {number}/{len(project_config_paths)} already built: {project_config_path}")
+            continue
+
+        print(f"========== Project {number}/{len(project_config_paths)}: {project_config_path} ==========")
+        start = time.time()
+        # the last step done is kept from earlier runs until a step is done in this one
+        stage = (status or {}).get("stage")
+        # a batch started again after a crash goes on where it stopped, it does not start again from from_stage
+        restarted = run_id is not None and status and status.get("run_id") == run_id
+        from_stage = None if restarted else args.from_stage
+        write_status(project_config_path, {"status": "running", "run_id": run_id, "started": start, "stage": stage})
+        try:
+            build_project(project_config_path, from_stage)
+            status = {"status": "done"}
+        except Exception as error:
+            # one failed project does not stop the batch
+            traceback.print_exc()
+            failed += 1
+            status = {"status": "failed", "error": repr(error)}
+            gc.collect()
+        write_status(project_config_path, dict(read_status(project_config_path) or {}, seconds=time.time() - start,
+                                               **status))
+
+    if failed:
+        sys.exit(f"{failed} of {len(project_config_paths)} projects failed")
 
 
 if __name__ == "__main__":
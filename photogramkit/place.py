@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+Functions for placing a photo at its sorted location without always copying it.
+
+    Placement modes:
+
+    copy       a full copy, made in the kernel with copy_file_range or sendfile when possible
+    hardlink   a second name for the same file, only on the same filesystem
+    reflink    a copy-on-write clone sharing the data blocks (btrfs, XFS, APFS), only on the same filesystem
+    symlink    a symbolic link to the source photo
+    move       rename the source photo (copy and delete across filesystems)
+    auto       reflink when the filesystem supports it, copy otherwise
+
+    Any mode that is not possible for a file falls back to copy. auto never links: a photo and its
+    hardlink or symlink are the same file, so editing the sorted photo would edit the SD card dump.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import sys
+
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
+
+
+# all placement modes, in the order they are offered on the command line
+PLACEMENTS = ["auto", "copy", "hardlink", "reflink", "symlink", "move"]
+
+# the ioctl request number cloning a file on Linux (FICLONE)
+FICLONE = 0x40049409
+
+# chunk size for copy_file_range and sendfile
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+# the mode that worked for auto placement, reflink or copy, per (source device, destination device)
+_auto_modes = {}
+
+
+def reflink_file(src, dst):
+    """
+    clone src to dst so both share the same data blocks until one of them is modified.
+    raises OSError if the filesystem does not support it.
+    """
+    # macOS (APFS)
+    if sys.platform == "darwin":
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), src)
+        return
+
+    # Linux (btrfs, XFS)
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflink is not supported on this platform", src)
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            # do not leave an empty destination file behind
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def copy_file(src, dst):
+    """
+    copy src to dst and preserve its timestamps.
+    the data is copied inside the kernel with os.copy_file_range (which also lets filesystems
+    and network shares clone or copy server-side), then os.sendfile, then a plain read/write loop.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+
+        for copy_chunk in (_copy_file_range, _sendfile):
+            try:
+                while copied < size:
+                    n = copy_chunk(fsrc.fileno(), fdst.fileno(), copied, min(COPY_CHUNK_SIZE, size - copied))
+                    # the source got shorter while copying
+                    if n == 0:
+                        break
+                    copied += n
+                break
+            except (OSError, AttributeError):
+                # not supported for these files or on this platform, try the next method from where it stopped
+                continue
+
+        # plain copy of whatever is left
+        if copied < size:
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            shutil.copyfileobj(fsrc, fdst)
+
+    # keep modification times and permission bits
+    shutil.copystat(src, dst)
+
+
+def _copy_file_range(fd_src, fd_dst, offset, count):
+    "copy count bytes at offset with os.copy_file_range"
+    return os.copy_file_range(fd_src, fd_dst, count, offset, offset)
+
+
+def _sendfile(fd_src, fd_dst, offset, count):
+    "copy count bytes at offset with os.sendfile"
+    os.lseek(fd_dst, offset, os.SEEK_SET)
+    return os.sendfile(fd_dst, fd_src, offset, count)
+
+
+def place_file(src, dst, placement="auto"):
+    """
+    place the photo src at dst.
+
+    Parameters:
+        src: a photo directory
+        dst: the directory the photo should have after placing, its folder must exist
+        placement: one of PLACEMENTS
+
+    Outputs:
+        the placement mode that was actually used
+    """
+    if placement not in PLACEMENTS:
+        raise ValueError(f"unknown placement {placement}, choose from {', '.join(PLACEMENTS)}")
+
+    # re-running with links: nothing to do if dst already is src
+    if os.path.lexists(dst):
+        if placement == "hardlink" and os.path.exists(dst) and os.path.samefile(src, dst):
+            return "hardlink"
+        os.remove(dst)
+
+    if placement == "auto":
+        return _place_auto(src, dst)
+
+    try:
+        if placement == "hardlink":
+            os.link(src, dst)
+        elif placement == "reflink":
+            reflink_file(src, dst)
+        elif placement == "symlink":
+            os.symlink(os.path.abspath(src), dst)
+        elif placement == "move":
+            shutil.move(src, dst)
+        else:
+            copy_file(src, dst)
+        return placement
+    except OSError:
+        if placement == "copy":
+            raise
+
+    # the mode is not possible here (e.g. a hardlink across filesystems), so copy
+    copy_file(src, dst)
+    return "copy"
+
+
+def _place_auto(src, dst):
+    "reflink src to dst when their filesystem supports it, copy otherwise"
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+
+    # different filesystems can only be copied, and a filesystem that could not reflink is not tried again
+    if devices[0] == devices[1] and _auto_modes.get(devices) != "copy":
+        try:
+            reflink_file(src, dst)
+            _auto_modes[devices] = "reflink"
+            return "reflink"
+        except OSError:
+            _auto_modes[devices] = "copy"
+
+    copy_file(src, dst)
+    return "copy"
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""
+Functions for planning the sort before any photo is placed.
+
+    A sort plan is a list of entries, one per photo:
+
+    {"date": "070424", "session": 3, "role": "flower", "flower": "flower2", "camera": "bottom",
+     "source": "./photos-sdcards/070424/bottom/IMG_0102.CR3",
+     "destination": "./photos-organized/070424/flower2/bottom/IMG_0102.CR3"}
+
+    where role is flower (photos of the flower) or colorprofile (color profiles and name labels
+    shot before the flower). The plan can be written to JSON or CSV, checked for problems, and
+    executed in one go. A duplicate photo (see photogramkit.dedupe) can also have duplicate_of,
+    the destination of its first copy, and is placed as a symbolic link to it.
+"""
+
+import csv
+import json
+import os
+from photogramkit import place
+
+
+# columns of a sort plan, in the order they are written to CSV
+PLAN_FIELDS = ["date", "session", "role", "flower", "camera", "source", "destination", "duplicate_of"]
+
+
+def plan_sessions(sessions, date, date_folder, sorted_folder, min_flower_photos):
+    """
+    plan where the photos of one date go, where small sessions (fewer than min_flower_photos images on every camera)
+    go to the colorprofile folder and big sessions (min_flower_photos or more images on some camera) to a flower folder.
+
+    Parameters:
+        sessions: a list of dict {camera: [photo names]} generated by group.group_sessions function
+        date: the name of the date folder
+        date_folder: a directory of date folder
+        sorted_folder: a directory of output date folder
+        min_flower_photos: the number of photos on one camera that makes a session a flower
+
+    Outputs:
+        sort_plan: a list of plan entries, see the module docstring
+    """
+    sort_plan = []
+
+    # set flower folder index (flower1, flower2, flower3 for different flowers)
+    flower_idx = 1
+
+    # iterate each session, all cameras at once
+    for session_idx, session in enumerate(sessions):
+        is_flower = max(len(photos) for photos in session.values()) >= min_flower_photos
+
+        for camera, photos in session.items():
+            if is_flower:
+                target_folder = os.path.join(sorted_folder, f"flower{flower_idx}", camera)
+            else:
+                target_folder = os.path.join(sorted_folder, "colorprofiles_namelabels", f"flower{flower_idx}", camera)
+
+            for photo in photos:
+                sort_plan.append({
+                    "date": date,
+                    "session": session_idx,
+                    "role": "flower" if is_flower else "colorprofile",
+                    "flower": f"flower{flower_idx}",
+                    "camera": camera,
+                    "source": os.path.join(date_folder, camera, photo),
+                    "destination": os.path.join(target_folder, photo),
+                })
+
+        # move to the next flower
+        if is_flower:
+            flower_idx += 1
+
+    return sort_plan
+
+
+def validate_plan(sort_plan, cameras_by_date):
+    """
+    check a sort plan before any photo is placed.
+
+    Parameters:
+        sort_plan: a list of plan entries
+        cameras_by_date: a dict {date: [camera names]} of the cameras every flower should have
+
+    Outputs:
+        errors: a list of messages for problems that make the plan impossible to execute
+                (two photos planned to the same destination, a source that does not exist)
+        bugs: a dict {date: [messages]} for flowers missing a camera, which usually means a flower
+              burst was too short and went to colorprofiles_namelabels
+    """
+    errors = []
+    sources_by_destination = {}
+    flower_cameras = {}
+
+    for entry in sort_plan:
+        # every destination must be used once
+        destination = os.path.normpath(entry["destination"])
+        if destination in sources_by_destination:
+            errors.append(f"{entry['source']} and {sources_by_destination[destination]} are both planned to {destination}")
+        sources_by_destination[destination] = entry["source"]
+
+        if not os.path.exists(entry["source"]):
+            errors.append(f"{entry['source']} does not exist")
+
+        if entry["role"] == "flower":
+            flower_cameras.setdefault((entry["date"], entry["flower"]), set()).add(entry["camera"])
+
+    # Check each flower for the presence of the cameras
+    bugs = {}
+    for (date, flower), cameras in flower_cameras.items():
+        missing_cameras = [camera for camera in cameras_by_date.get(date, []) if camera not in cameras]
+        if missing_cameras:
+            bugs.setdefault(date, []).append(
+                f"{flower} is missing: {', '.join(missing_cameras)} camera. "
+                f"Please go to species's corresponding colorprofile_namelabels to check.")
+
+    return errors, bugs
+
+
+def write_plan(sort_plan, plan_path):
+    "write a sort plan to a .csv file, or to a .json file for any other extension"
+    os.makedirs(os.path.dirname(os.path.abspath(plan_path)), exist_ok=True)
+
+    with open(plan_path, "w", newline="") as f:
+        if plan_path.lower().endswith(".csv"):
+            writer = csv.DictWriter(f, fieldnames=PLAN_FIELDS)
+            writer.writeheader()
+            writer.writerows(sort_plan)
+        else:
+            json.dump(sort_plan, f, indent=1)
+
+
+def execute_plan(sort_plan, placement="auto", executor=None):
+    """
+    place all photos of a sort plan: create every folder first, then place the photos.
+
+    Parameters:
+        sort_plan: a list of plan entries
+        placement: one of place.PLACEMENTS, used when executor is None
+        executor: a transfer.CopyExecutor placing photos in parallel. the caller waits for it.
+                  if None, photos are placed one by one
+    """
+    # create all folders at once
+    for folder in sorted({os.path.dirname(entry["destination"]) for entry in sort_plan}):
+        os.makedirs(folder, exist_ok=True)
+
+    for entry in sort_plan:
+        # a duplicate links to its first copy, which may not be placed yet
+        if entry.get("duplicate_of"):
+            place.place_file(entry["duplicate_of"], entry["destination"], "symlink")
+        elif executor is None:
+            place.place_file(entry["source"], entry["destination"], placement)
+        else:
+            executor.submit(entry["source"], entry["destination"])
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+Functions for finding the color profile of every flower and camera of a date at once.
+
+    Color profiles (.dcp) are made by hand in the colorprofiles_namelabels folder of each date,
+    one per flower and camera:
+
+    ./photos-organized/070424
+    ├── colorprofiles_namelabels
+    │   ├── flower1
+    │   │   ├── bottom
+    │   │   │   ├── IMG_0001.CR3
+    │   │   │   └── Canon EOS R100.dcp
+    │   │   ├── middle
+    │   │   └── top
+    │   └── flower2
+    ├── flower1
+    └── flower2
+
+    The profiles of a date are found in one scan, and every flower/camera folder is checked to
+    have exactly one profile before any photo is converted.
+"""
+
+import os
+
+
+# name of the folder holding color profiles and name labels in each date folder
+COLORPROFILES_FOLDER = "colorprofiles_namelabels"
+
+
+class ProfileRegistry:
+    """
+    the color profiles of one date folder, found in a single scan.
+
+    Parameters:
+        date_folder: a directory of a sorted date folder
+
+    Use resolve to get the profile of a flower and camera, and problems to check the whole date first.
+    """
+
+    def __init__(self, date_folder):
+        self.date_folder = date_folder
+
+        # {(flower, camera): [.dcp paths]}
+        self.profiles = {}
+        colorprofiles_dir = os.path.join(date_folder, COLORPROFILES_FOLDER)
+        if not os.path.isdir(colorprofiles_dir):
+            return
+
+        for flower_entry in os.scandir(colorprofiles_dir):
+            if not flower_entry.is_dir() or flower_entry.name.startswith('.'):
+                continue
+            for camera_entry in os.scandir(flower_entry.path):
+                if not camera_entry.is_dir() or camera_entry.name.startswith('.'):
+                    continue
+                self.profiles[(flower_entry.name, camera_entry.name)] = sorted(
+                    entry.path for entry in os.scandir(camera_entry.path)
+                    if entry.is_file() and entry.name.lower().endswith(".dcp") and not entry.name.startswith('.'))
+
+    def problems(self, folders):
+        """
+        check that every flower/camera folder has exactly one profile.
+
+        Parameters:
+            folders: a list of tuple (flower, camera) of the folders with photos to convert
+
+        Outputs:
+            a list of messages, empty if every folder has its profile
+        """
+        messages = []
+        for flower, camera in sorted(folders):
+            found = self.profiles.get((flower, camera), [])
+            expected = os.path.join(self.date_folder, COLORPROFILES_FOLDER, flower, camera)
+            if not found:
+                messages.append(f"no .dcp color profile in {expected}")
+            elif len(found) > 1:
+                messages.append(f"{len(found)} .dcp color profiles in {expected}, expected one: "
+                                + ", ".join(os.path.basename(path) for path in found))
+        return messages
+
+    def resolve(self, flower, camera):
+        "the color profile of a flower and camera, KeyError if it does not have exactly one"
+        found = self.profiles.get((flower, camera), [])
+        if len(found) != 1:
+            raise KeyError(f"{flower}/{camera} has {len(found)} color profiles")
+        return found[0]
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+Functions for writing color calibrated photos in a build-friendly layout, with downscaled proxies.
+
+    Big uncompressed TIFFs make disk I/O and Metashape's image loading the slowest part of a build.
+    The color stage can write its outputs compressed (deflate, lossless), tiled and with a chosen bit
+    depth, and write proxies at 1/2 or 1/4 of the resolution next to every output in the same pass:
+
+    ./photos-color-calibrated/070424/flower1/bottom
+    ├── IMG_0001.tiff
+    ├── IMG_0002.tiff
+    ├── proxy_2
+    │   ├── IMG_0001.tiff
+    │   └── IMG_0002.tiff
+    └── proxy_4
+        ├── IMG_0001.tiff
+        └── IMG_0002.tiff
+
+    The build stage can align the cameras on a proxy and switch to the full resolution photos for
+    depth maps and texturing (see photogramkit.build).
+"""
+
+import os
+import numpy as np
+
+try:
+    import tifffile
+except ImportError: # only needed to write compressed, tiled outputs or proxies
+    tifffile = None
+
+
+# TIFF compressions, both darktable-cli and tifffile write them without extra codecs
+COMPRESSIONS = ["none", "deflate"]
+
+# bit depths of the outputs
+BIT_DEPTHS = [8, 16]
+
+# proxy downscale factors
+PROXY_FACTORS = [2, 4]
+
+# width and height of the tiles of tiled outputs
+TILE_SIZE = 256
+
+# rows of a photo read at once when writing proxies, a multiple of every proxy factor
+CHUNK_ROWS = 256
+
+
+def output_options(base, compression="none", tiled=False, bit_depth=None, proxy_factors=()):
+    """
+    add the output layout to a dict of output options. options left at their default are not added,
+    so the fingerprints of outputs made before these options existed do not change.
+
+    Parameters:
+        base: a dict of output options
+        compression: one of COMPRESSIONS
+        tiled: if True, write tiled TIFFs
+        bit_depth: one of BIT_DEPTHS, or None for the default of the engine
+        proxy_factors: a list of PROXY_FACTORS
+
+    Outputs:
+        options: a new dict
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"unknown compression {compression}, choose from {', '.join(COMPRESSIONS)}")
+    if bit_depth is not None and bit_depth not in BIT_DEPTHS:
+        raise ValueError(f"unknown bit depth {bit_depth}, choose from {', '.join(map(str, BIT_DEPTHS))}")
+    for factor in proxy_factors:
+        if factor not in PROXY_FACTORS:
+            raise ValueError(f"unknown proxy factor {factor}, choose from {', '.join(map(str, PROXY_FACTORS))}")
+
+    options = dict(base)
+    if compression != "none":
+        options["compression"] = compression
+    if tiled:
+        options["tile"] = TILE_SIZE
+    if bit_depth is not None:
+        options["bit_depth"] = bit_depth
+    if proxy_factors:
+        options["proxies"] = sorted(set(proxy_factors))
+    return options
+
+
+def needs_tifffile(options):
+    "True if writing outputs with these options needs tifffile after darktable-cli"
+    return bool(options.get("tile") or options.get("proxies"))
+
+
+def proxy_folder(factor):
+    "the name of the folder of the proxies downscaled by factor, in the folder of their photos"
+    return f"proxy_{factor}"
+
+
+def proxy_path(calibrated_photo_dir, factor):
+    "the path of the proxy of a color calibrated photo, downscaled by factor"
+    folder, name = os.path.split(calibrated_photo_dir)
+    return os.path.join(folder, proxy_folder(factor), name)
+
+
+def output_paths(calibrated_photo_dir, options):
+    "the color calibrated photo and its proxies"
+    return [calibrated_photo_dir] + [proxy_path(calibrated_photo_dir, factor) for factor in options.get("proxies", [])]
+
+
+def darktable_conf(options):
+    "darktable-cli --conf options writing TIFFs with the compression and bit depth of options"
+    conf = []
+    if "compression" in options:
+        # 2 is deflate with a predictor
+        conf += ["--conf", "plugins/imageio/format/tiff/compress=2"]
+    if "bit_depth" in options:
+        conf += ["--conf", f"plugins/imageio/format/tiff/bpp={options['bit_depth']}"]
+    return conf
+
+
+def quantize(rgb, bit_depth):
+    "convert floating point RGB in [0, 1] to uint8 or uint16"
+    if bit_depth == 8:
+        return np.round(rgb * 255).astype(np.uint8)
+    return np.round(rgb * 65535).astype(np.uint16)
+
+
+def downscale(chunk, factor):
+    "average factor x factor blocks of a (height, width, channels) floating point chunk, dropping incomplete blocks"
+    height, width = chunk.shape[0] // factor * factor, chunk.shape[1] // factor * factor
+    blocks = chunk[:height, :width].reshape(height // factor, factor, width // factor, factor, -1)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def write_tiff(path, image, options):
+    "write an RGB array to a TIFF file with the compression and tiling of options"
+    kwargs = {}
+    if options.get("compression") == "deflate":
+        kwargs.update(compression="zlib", predictor=True)
+    if options.get("tile"):
+        kwargs["tile"] = (options["tile"], options["tile"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # the path may be a link into the cache folder, do not write through it
+    if os.path.lexists(path):
+        os.remove(path)
+    tifffile.imwrite(path, image, photometric="rgb", **kwargs)
+
+
+class OutputWriter:
+    """
+    collect the rows of one color calibrated photo and write it and its proxies.
+
+    Parameters:
+        calibrated_photo_dir: path of the full resolution output
+        shape: (height, width) of the photo
+        options: a dict of output options (see output_options)
+        default_bit_depth: the bit depth used if options do not have one
+
+    Add floating point RGB rows in [0, 1] from top to bottom, then call write.
+    """
+
+    def __init__(self, calibrated_photo_dir, shape, options, default_bit_depth=16):
+        self.calibrated_photo_dir = calibrated_photo_dir
+        self.options = options
+        self.bit_depth = options.get("bit_depth", default_bit_depth)
+        dtype = np.uint8 if self.bit_depth == 8 else np.uint16
+        height, width = shape
+
+        self.image = np.empty((height, width, 3), dtype=dtype)
+        self.proxies = {factor: np.empty((height // factor, width // factor, 3), dtype=dtype)
+                        for factor in options.get("proxies", [])}
+        self.row = 0
+
+    def add(self, rgb):
+        "add the next rows, their count must be a multiple of every proxy factor except for the last rows"
+        self.image[self.row:self.row + len(rgb)] = quantize(rgb, self.bit_depth)
+        for factor, proxy in self.proxies.items():
+            small = downscale(rgb, factor)
+            proxy_row = self.row // factor
+            proxy[proxy_row:proxy_row + len(small)] = quantize(small, self.bit_depth)
+        self.row += len(rgb)
+
+    def write(self, full_resolution=True):
+        "write the proxies, and the full resolution photo unless it was written by another program"
+        if full_resolution:
+            write_tiff(self.calibrated_photo_dir, self.image, self.options)
+        for factor, proxy in self.proxies.items():
+            write_tiff(proxy_path(self.calibrated_photo_dir, factor), proxy, self.options)
+
+
+def finish_output(calibrated_photo_dir, options, retile=True):
+    """
+    write the proxies of a photo written by darktable-cli (or taken from the cache), reading it once.
+
+    Parameters:
+        calibrated_photo_dir: path of the full resolution output
+        options: a dict of output options
+        retile: if True and options ask for tiles, write the full resolution photo again tiled
+    """
+    retile = retile and bool(options.get("tile"))
+    if not retile and not options.get("proxies"):
+        return
+
+    try:
+        image = tifffile.memmap(calibrated_photo_dir, mode="r")
+    except ValueError: # compressed
+        image = tifffile.imread(calibrated_photo_dir)
+    if image.ndim == 2:
+        image = image[..., None]
+    scale = float(np.iinfo(image.dtype).max) if np.issubdtype(image.dtype, np.integer) else 1.0
+    default_bit_depth = 8 if image.dtype == np.uint8 else 16
+
+    writer = OutputWriter(calibrated_photo_dir, image.shape[:2], options, default_bit_depth)
+    for row in range(0, image.shape[0], CHUNK_ROWS):
+        chunk = np.asarray(image[row:row + CHUNK_ROWS], dtype=np.float32) / scale
+        writer.add(np.repeat(chunk, 3, axis=2) if chunk.shape[2] == 1 else chunk[..., :3])
+    del image
+    writer.write(full_resolution=retile)
+
+
+def output_size(calibrated_photo_dir, options):
+    "bytes of a color calibrated photo and of its proxies, 0 for files that do not exist"
+    sizes = []
+    for path in output_paths(calibrated_photo_dir, options):
+        sizes.append(os.path.getsize(path) if os.path.exists(path) else 0)
+    return sizes[0], sum(sizes[1:])
@@ -6,13 +6,15 @@ A function for automatically doing photo sorting, color calibration and model bu
 from photogramkit import sort
 from photogramkit import color
 from photogramkit import build
+from photogramkit import transfer
 
-def run_relax(input_raw, output_sort, output_color, output_model, metashape, script, darktable, img_format):
+def run_relax(input_raw, output_sort, output_color, output_model, metashape, script, darktable, img_format, placement="auto",
+              jobs=transfer.DEFAULT_JOBS, per_device=transfer.DEFAULT_PER_DEVICE, verify=False):
     print("Starting full relax pipeline...")
 
     # 1. Sort
     print("Step 1/3: Sorting photos...")
-    sort.run_sort(input_raw, output_sort, img_format)
+    sort.run_sort(input_raw, output_sort, img_format, placement=placement, jobs=jobs, per_device=per_device, verify=verify)
 
     # Pause for user to generate color profiles
     input("\n✅ Photo sorting complete. Please generate color profiles now. Type 'ok' and press Enter to continue... ")
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+"""
+A job runner for the external programs of the pipeline (darktable-cli, Metashape).
+
+    Every job says how many CPU cores and how much memory it needs. Jobs start in the order they
+    were submitted, as soon as the cores and memory they need are free, so a few large Metashape
+    runs and many small darktable-cli runs can share a machine. A job larger than the whole budget
+    runs alone.
+
+    A job that runs longer than its timeout is killed (with its child processes) and started again,
+    up to its number of retries. Jobs killed by a signal (like the out-of-memory killer) are retried
+    too, jobs that exit with an error are not: they would fail again.
+
+    The output of every job goes to its own log file:
+
+    ./photos-color-calibrated/.photogramkit_logs
+    ├── darktable-070424_flower1_bottom-IMG_0001.log
+    └── darktable-070424_flower1_top-IMG_0001.log
+
+    stats() gives the queue depth and runtime statistics of the jobs so far.
+"""
+
+import os
+import re
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# name of the folder with the logs of the jobs, in the output folder of a stage
+LOG_FOLDER = ".photogramkit_logs"
+
+# seconds a killed job gets to exit before it is killed with SIGKILL
+KILL_GRACE = 10
+
+# bytes of the end of a job's output kept in its result
+OUTPUT_TAIL = 64 * 1024
+
+# seconds between checks of the free memory while a job waits for it
+MEMORY_POLL = 1.0
+
+
+def available_memory():
+    "bytes of memory available for new processes, or None if it cannot be found"
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def log_name(text):
+    "a file name made from text, keeping letters, digits, dots, dashes, plus signs and underscores"
+    return re.sub(r"[^A-Za-z0-9._+-]+", "_", text).strip("_") or "job"
+
+
+class Job:
+    """
+    an external program to run.
+
+    Parameters:
+        name: a name for logs and statistics, also the name of the log file
+        cmd: the command, a list of strings
+        cpus: CPU cores the program uses
+        memory: bytes of memory the program is expected to use, 0 if unknown
+        timeout: seconds after which the program is killed, None for no timeout
+        retries: how many times the program is started again after a timeout or a kill by a signal
+        cwd: the working directory of the program, None for the current one
+    """
+
+    def __init__(self, name, cmd, cpus=1, memory=0, timeout=None, retries=0, cwd=None):
+        self.name = name
+        self.cmd = [str(part) for part in cmd]
+        self.cpus = max(1, cpus)
+        self.memory = max(0, memory)
+        self.timeout = timeout
+        self.retries = retries
+        self.cwd = cwd
+
+
+class JobResult:
+    """
+    what happened to a job.
+
+    Attributes:
+        job: the Job
+        returncode: the exit code of the last attempt, negative if it was killed by a signal
+        attempts: how many times the program was started
+        seconds: the time from the first start to the end of the last attempt
+        timed_out: True if the last attempt was killed after the timeout
+        log_path: the log file, or None if the runner has no log folder
+        output: the end of the output of the last attempt, as bytes
+    """
+
+    def __init__(self, job, returncode, attempts, seconds, timed_out, log_path, output):
+        self.job = job
+        self.returncode = returncode
+        self.attempts = attempts
+        self.seconds = seconds
+        self.timed_out = timed_out
+        self.log_path = log_path
+        self.output = output
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def check(self):
+        "raise TimeoutExpired or CalledProcessError with the job's output if the job did not succeed"
+        if self.timed_out:
+            raise subprocess.TimeoutExpired(self.job.cmd, self.job.timeout, output=self.output)
+        if self.returncode != 0:
+            raise subprocess.CalledProcessError(self.returncode, self.job.cmd, output=self.output)
+        return self
+
+
+class JobRunner:
+    """
+    run jobs against a budget of CPU cores and memory.
+
+    Parameters:
+        cpus: CPU cores the jobs may use together. Default is every core
+        memory: bytes of memory the jobs may use together. Default is the memory available now
+        log_dir: a folder for the log files of the jobs, None to keep only the end of their output
+
+    run(job) runs a job from the calling thread, once it fits in the budget. submit(job) runs it in
+    the background and returns a Future of its JobResult. Use as a context manager, so running jobs
+    are killed if the caller stops with an error.
+    """
+
+    def __init__(self, cpus=None, memory=None, log_dir=None):
+        self.cpus = cpus or os.cpu_count() or 1
+        self.memory = memory if memory is not None else available_memory()
+        self.log_dir = log_dir
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.submitted = 0
+        self.running_cpus = 0
+        self.running_memory = 0
+        self.processes = set()
+        self.results = []
+        self.executor = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.kill_all()
+        if self.executor is not None:
+            self.executor.shutdown(wait=exc_type is None, cancel_futures=exc_type is not None)
+
+    def _fits(self, job):
+        "True if job can start now, called with the condition held"
+        if not self.processes and self.running_cpus == 0:
+            # a job larger than the whole budget runs alone
+            return True
+        if self.running_cpus + job.cpus > self.cpus:
+            return False
+        if self.memory is not None and self.running_memory + job.memory > self.memory:
+            return False
+        if job.memory:
+            # other programs may be using memory too
+            free = available_memory()
+            return free is None or free >= job.memory
+        return True
+
+    def run(self, job):
+        "run a job from the calling thread, waiting for its turn and for room in the budget. returns a JobResult"
+        ticket = object()
+        with self.condition:
+            self.waiting.append(ticket)
+            while not self.closed and (self.waiting[0] is not ticket or not self._fits(job)):
+                self.condition.wait(MEMORY_POLL if job.memory else None)
+            self.waiting.remove(ticket)
+            if self.closed:
+                self.condition.notify_all()
+                raise RuntimeError(f"the job runner was stopped before {job.name} started")
+            self.running_cpus += job.cpus
+            self.running_memory += job.memory
+            self.condition.notify_all()
+
+        try:
+            result = self._execute(job)
+        finally:
+            with self.condition:
+                self.running_cpus -= job.cpus
+                self.running_memory -= job.memory
+                self.condition.notify_all()
+
+        with self.condition:
+            self.results.append(result)
+        return result
+
+    def submit(self, job):
+        "run a job in the background, returns a Future of its JobResult"
+        with self.condition:
+            if self.executor is None:
+                # jobs use at least one core, so no more than cpus run at once
+                self.executor = ThreadPoolExecutor(max_workers=self.cpus)
+            self.submitted += 1
+        return self.executor.submit(self._run_submitted, job)
+
+    def _run_submitted(self, job):
+        with self.condition:
+            self.submitted -= 1
+        return self.run(job)
+
+    def _execute(self, job):
+        "start a job's program until it succeeds, fails, or runs out of retries"
+        log_path = os.path.join(self.log_dir, f"{log_name(job.name)}.log") if self.log_dir is not None else None
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            log_file = open(log_path, "w+b" if attempt == 1 else "a+b") if log_path else tempfile.TemporaryFile()
+            with log_file as log:
+                log.write(f"--- attempt {attempt}: {' '.join(job.cmd)}\n".encode())
+                log.flush()
+                offset = log.tell()
+
+                process = subprocess.Popen(job.cmd, stdout=log, stderr=subprocess.STDOUT, cwd=job.cwd,
+                                           start_new_session=True)
+                with self.condition:
+                    self.processes.add(process)
+                try:
+                    process.wait(timeout=job.timeout)
+                    timed_out = False
+                except subprocess.TimeoutExpired:
+                    self._kill(process)
+                    timed_out = True
+                    log.write(f"--- killed after {job.timeout} s\n".encode())
+                finally:
+                    with self.condition:
+                        self.processes.discard(process)
+
+                log.flush()
+                log.seek(max(offset, log.seek(0, os.SEEK_END) - OUTPUT_TAIL))
+                output = log.read()
+
+            # errors are not retried, they would happen again
+            if (not timed_out and process.returncode >= 0) or attempt > job.retries:
+                break
+
+        return JobResult(job, process.returncode, attempt, time.monotonic() - start, timed_out, log_path, output)
+
+    def _kill(self, process):
+        "stop a program and its children, then kill them if they do not exit in KILL_GRACE seconds"
+        for sig, grace in ((signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, None)):
+            try:
+                os.killpg(process.pid, sig)
+            except (ProcessLookupError, PermissionError):
+                pass
+            try:
+                process.wait(timeout=grace)
+                return
+            except subprocess.TimeoutExpired:
+                continue
+
+    def kill_all(self):
+        "kill every running program, and do not start the waiting ones"
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            processes = list(self.processes)
+        for process in processes:
+            self._kill(process)
+
+    def stats(self):
+        """
+        the queue depth and runtime statistics of the jobs so far.
+
+        Outputs:
+            a dict with queued, running, finished, failed, timed_out and retried job counts,
+            cpus and memory in use, and total, mean and max seconds of the finished jobs
+        """
+        with self.condition:
+            seconds = [result.seconds for result in self.results]
+            return {
+                "queued": len(self.waiting) + self.submitted,
+                "running": len(self.processes),
+                "finished": len(self.results),
+                "failed": sum(not result.ok for result in self.results),
+                "timed_out": sum(result.timed_out for result in self.results),
+                "retried": sum(result.attempts > 1 for result in self.results),
+                "cpus": self.running_cpus,
+                "memory": self.running_memory,
+                "seconds_total": sum(seconds),
+                "seconds_mean": sum(seconds) / len(seconds) if seconds else 0.0,
+                "seconds_max": max(seconds, default=0.0),
+            }
+
+    def summary(self):
+        "a one line summary of stats"
+        stats = self.stats()
+        return (f"{stats['finished']} jobs, {stats['failed']} failed, {stats['timed_out']} timed out, "
+                f"{stats['retried']} retried, {stats['seconds_mean']:.1f} s mean, {stats['seconds_max']:.1f} s max")
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""
+Functions for finding blurred and badly exposed photos before they are aligned.
+
+    Motion-blurred or badly exposed frames make matching slower and alignment worse. Every photo is
+    measured on a small grayscale version of it (its smallest proxy if the color stage wrote one, see
+    photogramkit.proxies, or every n-th row and column of the photo), by a pool of processes:
+
+        sharpness: the variance of the Laplacian, low for blurred photos
+        brightness: the mean gray level, from 0 to 1
+        dark, bright: the fractions of pixels clipped to black or white
+
+    All of them depend on the flower, the camera and the backdrop, so a photo is only compared with
+    the other photos of its camera ring. A photo whose sharpness is more than threshold robust
+    standard deviations (from the median and the median absolute deviation) below the median of its
+    ring, whose brightness is that far from the median, or with that many more clipped pixels than
+    the ring, is excluded. At most MAX_EXCLUDED of a ring is excluded, the worst photos first: a ring
+    that bad is left for the preview or the alignment to judge. Rings with fewer than MIN_RING_PHOTOS
+    photos are not screened.
+
+    The measures and the reason of every exclusion are written to quality_report.csv in the project
+    folder of every flower (see photogramkit.build):
+
+    ./3d-models/species/2024_site_accession_replicate
+    ├── project_config.json
+    └── quality_report.csv
+"""
+
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from photogramkit import proxies
+
+try:
+    import tifffile
+except ImportError: # only needed to screen TIFF photos
+    tifffile = None
+
+try:
+    from PIL import Image
+except ImportError: # only needed to screen JPEG and PNG photos
+    Image = None
+
+
+# name of the quality report in every project folder
+REPORT_FILENAME = "quality_report.csv"
+
+# columns of the quality report
+REPORT_FIELDS = ["photo", "camera", "sharpness", "brightness", "dark", "bright", "sharpness_score",
+                 "brightness_score", "dark_score", "bright_score", "kept", "reason"]
+
+# pixels of the long side of the images measured, at least
+SCREEN_SIZE = 512
+
+# robust standard deviations from the median of a camera ring that exclude a photo
+DEFAULT_THRESHOLD = 3.0
+
+# camera rings with fewer photos are not screened
+MIN_RING_PHOTOS = 5
+
+# gray levels this close to 0 or 1 are clipped
+CLIP_LEVEL = 0.02
+
+# fraction of the photos of a camera ring that can be excluded at most
+MAX_EXCLUDED = 0.2
+
+# smallest spreads of log sharpness, brightness and clipped fractions, so rings of near identical photos exclude nothing
+MIN_SHARPNESS_SPREAD = 0.05
+MIN_BRIGHTNESS_SPREAD = 0.01
+MIN_CLIPPED_SPREAD = 0.02
+
+# weights of the red, green and blue channels in the gray level
+LUMINANCE = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+
+def preview_path(photo_path):
+    "the smallest proxy of a photo, or the photo itself if it has none"
+    for factor in sorted(proxies.PROXY_FACTORS, reverse=True):
+        proxy = proxies.proxy_path(photo_path, factor)
+        if os.path.exists(proxy):
+            return proxy
+    return photo_path
+
+
+def read_preview(photo_path):
+    """
+    read a small grayscale version of a photo as a float32 array in [0, 1]. uncompressed TIFFs are
+    memory-mapped and JPEGs are decoded at a reduced size, so the whole photo is not read.
+    """
+    path = preview_path(photo_path)
+    if os.path.splitext(path)[1].lower() in (".tif", ".tiff"):
+        if tifffile is None:
+            raise ImportError("screening TIFF photos needs tifffile: pip install tifffile")
+        try:
+            image = tifffile.memmap(path, mode="r")
+        except ValueError: # compressed or tiled
+            image = tifffile.imread(path)
+    else:
+        if Image is None:
+            raise ImportError("screening JPEG and PNG photos needs Pillow: pip install pillow")
+        with Image.open(path) as pil_image:
+            # JPEGs are decoded at 1/2, 1/4 or 1/8 of their size, no smaller than requested
+            pil_image.draft("RGB", (SCREEN_SIZE, SCREEN_SIZE))
+            image = np.asarray(pil_image)
+
+    step = max(1, min(image.shape[:2]) // SCREEN_SIZE)
+    small = np.asarray(image[::step, ::step])
+    scale = float(np.iinfo(small.dtype).max) if np.issubdtype(small.dtype, np.integer) else 1.0
+    small = small.astype(np.float32) / scale
+    if small.ndim == 2:
+        return small
+    if small.shape[2] < 3:
+        return small[..., 0]
+    return small[..., :3] @ LUMINANCE
+
+
+def measure(gray):
+    "the sharpness, brightness and clipped fractions of a grayscale image in [0, 1], as a dict"
+    laplacian = (4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1] - gray[1:-1, :-2] - gray[1:-1, 2:])
+    return {
+        "sharpness": float(laplacian.var()),
+        "brightness": float(gray.mean()),
+        "dark": float(np.count_nonzero(gray <= CLIP_LEVEL) / gray.size),
+        "bright": float(np.count_nonzero(gray >= 1 - CLIP_LEVEL) / gray.size),
+    }
+
+
+def measure_photo(photo_path):
+    "measure one photo, runs in a worker process. returns (photo_path, measures or None, error or None)"
+    try:
+        return photo_path, measure(read_preview(photo_path)), None
+    except (OSError, ValueError, ImportError) as error:
+        return photo_path, None, repr(error)
+
+
+def measure_photos(photo_files, jobs=None):
+    """
+    measure photos in a pool of processes.
+
+    Parameters:
+        photo_files: a list of photo paths
+        jobs: the number of processes, default is one per CPU core
+
+    Outputs:
+        measurements: a dict of {photo path: measures dict}, photos that cannot be read have
+                      {"error": message} instead
+    """
+    jobs = min(jobs or os.cpu_count() or 1, len(photo_files))
+    if jobs <= 1:
+        results = list(map(measure_photo, photo_files))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(measure_photo, photo_files, chunksize=max(1, len(photo_files) // (jobs * 4))))
+
+    return {photo_path: measures if measures is not None else {"error": error}
+            for photo_path, measures, error in results}
+
+
+def robust_scores(values, min_spread):
+    "how many robust standard deviations every value is from the median"
+    median = np.median(values)
+    spread = max(1.4826 * np.median(np.abs(values - median)), min_spread)
+    return (values - median) / spread
+
+
+def select_photos(photo_files, measurements, threshold=DEFAULT_THRESHOLD):
+    """
+    choose the photos of one flower to keep, comparing every photo with its camera ring.
+
+    Parameters:
+        photo_files: the photos of the flower, in camera folders
+        measurements: a dict of measures from measure_photos
+        threshold: robust standard deviations from the median of a ring that exclude a photo
+
+    Outputs:
+        rows: a list of dict, one per photo in the order of photo_files, with the REPORT_FIELDS
+    """
+    rows = []
+    for photo_path in photo_files:
+        measures = measurements.get(photo_path) or {"error": "not measured"}
+        rows.append(dict({key: measures.get(key) for key in ("sharpness", "brightness", "dark", "bright")},
+                         photo=photo_path, camera=os.path.basename(os.path.dirname(photo_path)),
+                         sharpness_score=None, brightness_score=None, dark_score=None, bright_score=None,
+                         kept=True, reason=measures.get("error", "")))
+
+    # photos that cannot be read are kept, Metashape reports them if it cannot read them either
+    rings = {}
+    for row in rows:
+        if row["sharpness"] is not None:
+            rings.setdefault(row["camera"], []).append(row)
+
+    for ring in rings.values():
+        if len(ring) < MIN_RING_PHOTOS:
+            continue
+        sharpness_scores = robust_scores(np.log([row["sharpness"] + 1e-12 for row in ring]), MIN_SHARPNESS_SPREAD)
+        brightness_scores = robust_scores(np.array([row["brightness"] for row in ring]), MIN_BRIGHTNESS_SPREAD)
+        dark_scores = robust_scores(np.array([row["dark"] for row in ring]), MIN_CLIPPED_SPREAD)
+        bright_scores = robust_scores(np.array([row["bright"] for row in ring]), MIN_CLIPPED_SPREAD)
+
+        # (how far past the threshold, row) of every photo to exclude
+        excluded = []
+        for row, scores in zip(ring, zip(sharpness_scores, brightness_scores, dark_scores, bright_scores)):
+            sharpness_score, brightness_score, dark_score, bright_score = (round(float(score), 2) for score in scores)
+            row.update(sharpness_score=sharpness_score, brightness_score=brightness_score, dark_score=dark_score,
+                       bright_score=bright_score)
+            reasons = []
+            if sharpness_score < -threshold:
+                reasons.append("blurred")
+            if brightness_score < -threshold:
+                reasons.append("underexposed")
+            elif brightness_score > threshold:
+                reasons.append("overexposed")
+            # only clipping beyond what the backdrop clips in every photo of the ring
+            if dark_score > threshold or bright_score > threshold:
+                reasons.append("clipped")
+            if reasons:
+                row["reason"] = ", ".join(reasons)
+                excluded.append((max(-sharpness_score, abs(brightness_score), dark_score, bright_score), row))
+
+        # the worst photos are excluded, the others are kept and say why they could have been
+        excluded.sort(key=lambda item: item[0], reverse=True)
+        max_excluded = int(MAX_EXCLUDED * len(ring))
+        for rank, (_, row) in enumerate(excluded):
+            if rank < max_excluded:
+                row["kept"] = False
+            else:
+                row["reason"] += f" (kept, at most {MAX_EXCLUDED:.0%} of a ring are excluded)"
+    return rows
+
+
+def write_report(rows, report_path):
+    "write the quality report of one flower"
+    with open(report_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: round(value, 6) if isinstance(value, float) else value for key, value in row.items()})
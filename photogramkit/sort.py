@@ -33,11 +33,147 @@ import argparse
 from datetime import datetime, timedelta # convert time strings into timestamps
 import glob # to sort CR3 files
 import os
-import shutil # to copy photos
+import json
 from exiftool import ExifTool # only need the ExifTool Class within the exiftool package
+from photogramkit import dedupe
+from photogramkit import exif
+from photogramkit import group
+from photogramkit import place
+from photogramkit import plan
+from photogramkit import transfer
+from photogramkit.index import MetadataIndex, INDEX_FILENAME
 
 
-def extract_time_for_photos_in_one_camera(date_folder, camera, img_format):
+# the only tags needed to sort photos. requesting them explicitly is much faster than
+# pulling every tag with get_metadata
+EXIF_TAGS = ["EXIF:DateTimeOriginal", "EXIF:SubSecTimeOriginal", "EXIF:SerialNumber", "MakerNotes:SerialNumber"]
+
+# number of photos sent to exiftool in one request
+DEFAULT_BATCH_SIZE = 500
+
+# pause between two shooting sessions
+MAX_TIME_DIFF = timedelta(minutes=3)
+
+# sessions with at least this many photos on one camera are flowers, smaller ones are color profiles or name labels
+MIN_FLOWER_PHOTOS = 6
+
+
+class LazyExifTool:
+    """
+    an ExifTool that is only created and started when the first photo is sent to it,
+    so runs where the built-in reader parses every photo do not need the exiftool binary at all.
+    """
+
+    def __init__(self):
+        self.et = None
+
+    def get_tags_batch(self, tags, filenames):
+        "start exiftool if not running yet, then same as ExifTool.get_tags_batch"
+        if self.et is None:
+            self.et = ExifTool()
+            self.et.start()
+        return self.et.get_tags_batch(tags, filenames)
+
+    def terminate(self):
+        "stop exiftool if it was started"
+        if self.et is not None:
+            self.et.terminate()
+            self.et = None
+
+
+def read_capture_times(et, photo_dirs, batch_size=DEFAULT_BATCH_SIZE, fast_reader=True):
+    """
+    read the capture time tags of many photos.
+    each photo is first read with the built-in reader in photogramkit.exif, which only maps a few KB of headers.
+    photos it cannot parse are sent to exiftool in batches of batch_size paths, requesting only the tags in EXIF_TAGS.
+
+    Parameters:
+        et: a running ExifTool, or a LazyExifTool that starts exiftool only if some photo needs it
+        photo_dirs: a list of photo directories
+        batch_size: the number of photos sent to exiftool at once
+        fast_reader: if False, read every photo with exiftool
+
+    Outputs:
+        capture_times: a dict {photo_dir: metadata}
+        where metadata is a dict with capture_time (DateTimeOriginal), subsec_time (SubSecTimeOriginal),
+        serial (camera serial number) and format (file extension). a missing tag is None
+    """
+    capture_times = {}
+    to_exiftool = []
+
+    # read the photos the built-in reader understands
+    for photo_dir in photo_dirs:
+        metadata = exif.read_exif_dates(photo_dir) if fast_reader else None
+        if metadata is None:
+            to_exiftool.append(photo_dir)
+        else:
+            metadata["format"] = os.path.splitext(photo_dir)[1].lstrip(".").upper()
+            capture_times[photo_dir] = metadata
+
+    # fall back to exiftool for the rest
+    for start in range(0, len(to_exiftool), batch_size):
+        batch = to_exiftool[start:start + batch_size]
+
+        # exiftool answers with one dict per readable file, keyed by SourceFile
+        results = et.get_tags_batch(EXIF_TAGS, batch)
+        by_source = {os.path.normpath(r["SourceFile"]): r for r in results}
+
+        for photo_dir in batch:
+            metadata = by_source.get(os.path.normpath(photo_dir), {})
+            serial = metadata.get("EXIF:SerialNumber", metadata.get("MakerNotes:SerialNumber"))
+            subsec_time = metadata.get("EXIF:SubSecTimeOriginal")
+            capture_times[photo_dir] = {
+                "capture_time": metadata.get("EXIF:DateTimeOriginal"),
+                # -n can turn these into numbers, keep them as text
+                "subsec_time": None if subsec_time is None else str(subsec_time),
+                "serial": None if serial is None else str(serial),
+                "format": os.path.splitext(photo_dir)[1].lstrip(".").upper(),
+            }
+
+    return capture_times
+
+
+def read_capture_times_indexed(et, photo_dirs, index=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    same as read_capture_times, but photos already in the metadata index are not read again.
+    newly read photos are added to the index.
+
+    Parameters:
+        et: a running ExifTool or a LazyExifTool
+        photo_dirs: a list of photo directories
+        index: a MetadataIndex. if None, every photo is read
+        batch_size: the number of photos sent to exiftool at once
+
+    Outputs:
+        capture_times: a dict {photo_dir: metadata}, see read_capture_times
+    """
+    if index is None:
+        return read_capture_times(et, photo_dirs, batch_size=batch_size)
+
+    capture_times = {}
+    stats = {}
+    to_read = []
+
+    # look up every photo, unchanged photos never reach exiftool
+    for photo_dir in photo_dirs:
+        stats[photo_dir] = os.stat(photo_dir)
+        metadata = index.lookup(photo_dir, stat=stats[photo_dir])
+        if metadata is None:
+            to_read.append(photo_dir)
+        else:
+            capture_times[photo_dir] = metadata
+
+    # read new or changed photos and remember them
+    for photo_dir, metadata in read_capture_times(et, to_read, batch_size=batch_size).items():
+        capture_times[photo_dir] = metadata
+        if metadata["capture_time"] is not None:
+            index.store(photo_dir, metadata, stat=stats[photo_dir])
+    index.commit()
+
+    return capture_times
+
+
+def extract_time_for_photos_in_one_camera(date_folder, camera, img_format, et=None, batch_size=DEFAULT_BATCH_SIZE, index=None):
     """
     extract creation times for all the photos in one *camera folder*.
     suppose your input folder has a structure like this:
@@ -54,11 +190,22 @@ def extract_time_for_photos_in_one_camera(date_folder, camera, img_format):
     Parameters:
         date_folder: a directory of date folder (like the 070324 and 070424 folders above)
         camera: a string of bottom, middle or top
+        et: a running ExifTool or a LazyExifTool shared by the whole run. if None, one is created for this camera
+        batch_size: the number of photos sent to exiftool at once
+        index: a MetadataIndex. photos already in it are not read again
 
     Outputs:
         timestamps: a list of tuple 
         where in each tuple there are two elements (photo name and timestamp)
     """
+    # use an exiftool for this camera only if the caller did not share one
+    if et is None:
+        et = LazyExifTool()
+        try:
+            return extract_time_for_photos_in_one_camera(date_folder, camera, img_format, et=et,
+                                                         batch_size=batch_size, index=index)
+        finally:
+            et.terminate()
 
     # Get camera folder
     camera_folder = os.path.join(date_folder, camera)
@@ -66,87 +213,59 @@ def extract_time_for_photos_in_one_camera(date_folder, camera, img_format):
     # Use glob to directly get only image files, sort photos
     photo_dirs = sorted(glob.glob(os.path.join(camera_folder, f"*.{img_format}")))
 
+    # read DateTimeOriginal (and SubSecTimeOriginal) for all photos in batches
+    capture_times = read_capture_times_indexed(et, photo_dirs, index=index, batch_size=batch_size)
+
     # Initialize a list of tuple (photo_name, timestamp)
     timestamps = []
 
-    # iterate through each photo, extract datetime, 
+    # iterate through each photo, format its datetime, 
     # and store the results into a tuple (photo_name, timestamp)
-    with ExifTool() as et:
-        for photo_dir in photo_dirs:
-            # extract meta
-            metadata = et.get_metadata(photo_dir)
-            dt_orig = metadata.get("EXIF:DateTimeOriginal")
-            #subsec_time_origi = metadata.get("EXIF:SubSecTimeOriginal")
-            #precise_timestamp = f"{dt_orig}.{subsec_time_origi}"
-
-            # format the precise timestamp
-            # precise_formatted = datetime.strptime(precise_timestamp, '%Y:%m:%d %H:%M:%S.%f')
-            dt_format = datetime.strptime(dt_orig, '%Y:%m:%d %H:%M:%S')
-
-            # add to the list
-            # timestamps.append((os.path.basename(photo_dir),precise_formatted))
-            timestamps.append((os.path.basename(photo_dir),dt_format))
+    for photo_dir in photo_dirs:
+        # format the precise timestamp (with sub-second time when the camera records it)
+        precise_formatted = parse_capture_time(capture_times[photo_dir]["capture_time"],
+                                               capture_times[photo_dir]["subsec_time"])
+
+        # add to the list
+        timestamps.append((os.path.basename(photo_dir),precise_formatted))
 
     return timestamps
 
 
-def group_photos_by_timestamp(timestamps, max_time_diff=timedelta(minutes=3)):
+def parse_capture_time(dt_orig, subsec_time_orig=None):
     """
-    divide photos in the same camera folder into groups based on timestamp.
+    convert DateTimeOriginal and SubSecTimeOriginal into a datetime.
 
     Parameters:
-        timestamps: a list of tuples from extract_time_for_photos_in_one_camera function.
-        max_time_diff: a time
+        dt_orig: a string like '2024:07:04 10:31:05'
+        subsec_time_orig: the fraction of the second as digits, like '07' for 0.07 s, or None
 
     Outputs:
-        groups: a list of lists 
-        where each list is a group of images that have time differences smaller than max_time_diff.
-                For example:
-                    [[img1], [img2, img3], [img4, img5, img6, img7, img8]]
-
+        a datetime with microsecond precision
     """
+    dt_format = datetime.strptime(dt_orig, '%Y:%m:%d %H:%M:%S')
 
-    # create an empty list to store the sorted photos
-    groups = []
+    # keep only the digits, %f would accept at most 6
+    subsec_digits = "".join(ch for ch in str(subsec_time_orig or "") if ch.isdigit())[:6]
+    if subsec_digits:
+        dt_format = dt_format.replace(microsecond=int(subsec_digits.ljust(6, "0")))
 
-    # put photos that have similar timestamps into the same group
-    current_group = []
+    return dt_format
 
-    # iterate through each photo
-    for idx, (photo, timestamp) in enumerate(timestamps):
-        # put the first photo into the first group
-        if idx == 0:
-            current_group.append(photo)
-        # for the rest of the photos, 
-        # check timestamp to decide if put this photo into the current group or a new group
-        else:
-            # get the timestamp of the previous photo
-            prev_timestamp = timestamps[idx-1][1]
-
-            # If time difference is within threshold, add to current group
-            if timestamp - prev_timestamp <= max_time_diff:
-                current_group.append(photo)
-            else:
-                groups.append(current_group)  # Store completed group
-                current_group = [photo]  # Start new group
 
-    # Append the last group if not empty
-    if current_group:
-        groups.append(current_group)
-
-    return groups
-
-
-def sort_photos(groups, camera, date_folder, sorted_folder):
+def sort_photos(sessions, date_folder, sorted_folder, placement="auto", executor=None):
     """
-    sort photos based on the groups information where assign consecutive small groups (fewer than 6 images)
-    to the colorprofile folder and assign consecutive big groups (more than 6 images) to the camera folder.
+    sort photos based on the sessions information where assign small sessions (fewer than 6 images on every camera)
+    to the colorprofile folder and assign big sessions (6 or more images on some camera) to a flower folder.
+    same as planning the date with plan.plan_sessions and executing it with plan.execute_plan.
 
     Parameters:
-        groups: a list of list generated by group_photos_by_timestamp function
-        camera: a string of bottom, middle and top
+        sessions: a list of dict {camera: [photo names]} generated by group.group_sessions function
         date_folder: a directory of date folder (like the 070324 and 070424 folders above)
         sorted_folder: a directory of output folder
+        placement: how photos are placed in the output folder, one of place.PLACEMENTS.
+                   auto links photos when input and output are on the same filesystem and copies them otherwise
+        executor: a transfer.CopyExecutor placing photos in parallel. if None, photos are placed one by one with placement
 
     Outputs:
         a sorted photo folder. For example:
@@ -160,133 +279,192 @@ def sort_photos(groups, camera, date_folder, sorted_folder):
                 ├── flower1
                 └── flower2
     """
-    # get the number of groups from the last function
-    num_groups = len(groups)
-
-    # I want to create a bunch of flower models to store photos from the same flower
-    # In each flower model, there are three folders
-    # cameras (bottom, middle or top)
-    # For each date, there is a color profile folder:
-    # which store photos that might contain color profiles or sample labels
-
-    # set flower folder index (flower1, flower2, flower3 for different flowers)
-    flower_idx = 1
-
-    # set group index (from 0, 1, 2, to the num_groups)
-    group_idx = 0
-
-    # iterate each group in groups
-    while group_idx < num_groups:
-        # create a new flower folder with its two subfolders
-        flower_folder = os.path.join(sorted_folder, f"flower{flower_idx}")
-        colorprofiles_folder = os.path.join(sorted_folder, "colorprofiles_namelabels", f"flower{flower_idx}", camera)
-        camera_folder = os.path.join(flower_folder, camera)
-
-        # create if not exist
-        os.makedirs(colorprofiles_folder, exist_ok=True)
-        os.makedirs(camera_folder, exist_ok=True)
-
-        # In each group, assign consecutive small groups (fewer than 6 images) to the colorprofile folder
-        group = groups[group_idx]
-
-        if len(group) < 6:
-            # copy photo to the colorprofile folder
-            for photo in group:
-                photo_path = os.path.join(date_folder, camera, photo)
-                shutil.copy(photo_path, colorprofiles_folder)
-
-        # if the next group is large (6 or more images), assign it to the camera folder.
-        else:
-            # copy photo to the camera_folder
-            for photo in group:
-                photo_path = os.path.join(date_folder, camera, photo)
-                shutil.copy(photo_path, camera_folder)
+    date = os.path.basename(os.path.normpath(date_folder))
+    sort_plan = plan.plan_sessions(sessions, date, date_folder, sorted_folder, MIN_FLOWER_PHOTOS)
+    plan.execute_plan(sort_plan, placement=placement, executor=executor)
+
 
-            # move to the next flower
-            flower_idx += 1
+def write_grouping(sorted_folder, max_gap, adaptive, offsets, sessions):
+    """
+    write how the photos of one date were grouped to grouping.json in the sorted date folder.
 
-        # move to the next group
-        group_idx += 1
+    Parameters:
+        sorted_folder: a directory of output date folder
+        max_gap: the session break threshold in seconds
+        adaptive: True if max_gap was picked from the gaps between photos
+        offsets: a dict {camera: clock offset in seconds}
+        sessions: a list of dict {camera: [photo names]}
+    """
+    os.makedirs(sorted_folder, exist_ok=True)
+    grouping = {
+        "max_time_diff_seconds": max_gap,
+        "threshold": "adaptive" if adaptive else "fixed",
+        "clock_offsets_seconds": offsets,
+        "sessions": [{camera: len(photos) for camera, photos in session.items()} for session in sessions],
+    }
+    with open(os.path.join(sorted_folder, "grouping.json"), "w") as f:
+        json.dump(grouping, f, indent=2)
 
 
-def check_bugs(sorted_folder, cameras):
+def check_bugs(bugs, output_dir):
 
     """
     check bugs. sometimes if the number of consecutive flower images is smaller than 6, the flower images will be
-    falsely copied to the colorprofile folder rather than the camera folder. so here after sorting photos, check if each
-    flower has three camera folders (bottom, middle, top)
+    falsely copied to the colorprofile folder rather than the camera folder. the sort plan is checked for flowers
+    without all camera folders (bottom, middle, top) by plan.validate_plan, and they are logged here.
 
     Parameters:
-        sorted_folder: a directory of output directory
+        bugs: a dict {date: [messages]} from plan.validate_plan
+        output_dir: a directory of output directory
 
     Outputs:
-        if there is an error, will write flower ID to the bug.txt which located within the output folder
+        if there is an error, will write flower ID to the bug.txt which located within the output date folder
 
     """
+    for date, messages in bugs.items():
+        # Create or open the bug.txt file to log missing folders
+        bug_file_path = os.path.join(output_dir, date, 'bug.txt')
 
-    # Create or open the bug.txt file to log missing folders
-    bug_file_path = os.path.join(sorted_folder, 'bug.txt')
-
-    # Ensure the directory exists
-    os.makedirs(os.path.dirname(bug_file_path), exist_ok=True)
-
-    with open(bug_file_path, 'a') as bug_file:
-
-        subfolders = os.listdir(sorted_folder)
+        # Ensure the directory exists
+        os.makedirs(os.path.dirname(bug_file_path), exist_ok=True)
 
-        # iterate each subfolder
-        for subfolder in subfolders:
-            subfolder_dir = os.path.join(sorted_folder, subfolder)
+        with open(bug_file_path, 'a') as bug_file:
+            for message in messages:
+                bug_file.write(f"{os.path.join(output_dir, date)}: {message}\n")
 
-            # go to flower folder
-            if subfolder.startswith("flower"):
-                # Check for the presence of the cameras
-                missing_cameras = []
-                required_cameras = cameras
 
-                # Check each required camera
-                for camera in required_cameras:
-                    if not os.path.isdir(os.path.join(subfolder_dir, camera)):
-                        missing_cameras.append(camera)
-
-                    # If any required subfolder is missing, log the issue in bug.txt
-                    if missing_cameras:
-                        bug_file.write(f"{subfolder_dir} is missing: {', '.join(missing_cameras)} camera\n. Please go to species's corresponding colorprofile_namelabels to check.\n")
-
-
-def run_sort(input_dir, output_dir, img_format):
+def run_sort(input_dir, output_dir, img_format, batch_size=DEFAULT_BATCH_SIZE, rebuild_index=False, placement="auto",
+             jobs=transfer.DEFAULT_JOBS, per_device=transfer.DEFAULT_PER_DEVICE, verify=False, max_time_diff=MAX_TIME_DIFF,
+             dry_run=False, plan_path=None, duplicates="skip"):
     """
-    combine all the functions above: extract_time_for_photos_in_one_camera, group_photos_by_timestamp, sort_photos
+    combine all the functions above: extract_time_for_photos_in_one_camera, group.group_sessions, sort_photos
+
+    the whole run is planned first (see photogramkit.plan), the plan is checked, and only then are photos placed,
+    all at once. the plan is written to plan_path (.json or .csv) if given. with dry_run, nothing is placed
+    and the plan is written to plan_path, or output_dir/sort_plan.json. the metadata index is only read and
+    the duplicates are listed next to the plan, so nothing else is written.
+
+    photos are read with the built-in reader in photogramkit.exif, and one exiftool process,
+    started only if some photo needs it, is shared by every camera folder.
+    photo metadata is cached in a MetadataIndex in output_dir, so photos that did not change
+    since the last run are not read again. rebuild_index=True starts from an empty index.
+    photos are placed in output_dir with the given placement mode (see photogramkit.place) by jobs threads,
+    reading at most per_device photos from one device at once. with verify, every placed photo is hashed
+    and the hashes are written to output_dir/manifest.blake2b.
+    sessions are separated by pauses longer than max_time_diff. if max_time_diff is None, the pause is picked
+    for each date from the gaps between photos. the pause and clock offsets used are written to <date>/grouping.json.
+    photos with the same content as another photo of the run, or as a photo placed by an earlier run, are
+    skipped, linked to their first copy, or kept, depending on duplicates (see photogramkit.dedupe),
+    and listed in output_dir/duplicates.csv.
     """
     # get dates
-    dates = [d for d in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, d)) and not d.startswith('.')]
+    dates = sorted(d for d in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, d)) and not d.startswith('.'))
 
-     # iterate each date folders
-    for date in dates:
-        # get date folder directory
-        date_folder = os.path.join(input_dir, date)
+    # open the metadata index in the output folder, a dry run leaves it as it is
+    index = MetadataIndex(os.path.join(output_dir, INDEX_FILENAME), rebuild=rebuild_index, read_only=dry_run)
+    if dry_run and plan_path is None:
+        plan_path = os.path.join(output_dir, "sort_plan.json")
 
-        # define output directory
-        sorted_folder = os.path.join(output_dir, date)
+    # one exiftool for the whole run, started on first use
+    et = LazyExifTool()
 
-        # get camera folders
-        cameras = [c for c in os.listdir(date_folder) if os.path.isdir(os.path.join(date_folder, c)) and not c.startswith('.')]
+    # plan of the whole run, grouping information and cameras of each date
+    sort_plan = []
+    groupings = {}
+    cameras_by_date = {}
 
-        # iterate each camera in each date folder
-        for camera in cameras:
+    try:
+        # iterate each date folders
+        for date in dates:
+            # get date folder directory
+            date_folder = os.path.join(input_dir, date)
 
-            # get timestamps of all the photos in each camera
-            timestamps = extract_time_for_photos_in_one_camera(date_folder = date_folder, camera = camera, img_format=img_format)
-
-            # group photos
-            groups = group_photos_by_timestamp(timestamps, max_time_diff=timedelta(minutes=3))
+            # define output directory
+            sorted_folder = os.path.join(output_dir, date)
 
-            # sort photos
-            sort_photos(groups, camera = camera, date_folder = date_folder,
-                        sorted_folder=sorted_folder)
+            # get camera folders
+            cameras = [c for c in os.listdir(date_folder) if os.path.isdir(os.path.join(date_folder, c)) and not c.startswith('.')]
+            cameras_by_date[date] = cameras
 
-        # check bugs
-        check_bugs(sorted_folder, cameras)
+            # get timestamps of all the photos in each camera
+            timestamps_by_camera = {}
+            for camera in cameras:
+                timestamps_by_camera[camera] = extract_time_for_photos_in_one_camera(
+                    date_folder = date_folder, camera = camera, img_format=img_format,
+                    et=et, batch_size=batch_size, index=index)
+
+            # pick the session break threshold from the gaps between photos if not given
+            arrays = group.timestamps_to_arrays(timestamps_by_camera)
+            if max_time_diff is None:
+                max_gap = group.adaptive_gap_threshold(group.camera_gaps(arrays), default=MAX_TIME_DIFF.total_seconds())
+                print(f"{date}: sessions are separated by pauses longer than {max_gap:.1f} s")
+            else:
+                max_gap = max_time_diff.total_seconds()
+
+            # group photos of all cameras together, correcting for the clock offset of each camera
+            offsets = group.estimate_clock_offsets(arrays, max_gap)
+            for camera, offset in offsets.items():
+                if offset != 0:
+                    print(f"{date}: clock of camera {camera} is {offset:+.1f} s off")
+            sessions = group.group_sessions(arrays, offsets, max_gap)
+            groupings[sorted_folder] = (max_gap, max_time_diff is None, offsets, sessions)
+
+            # plan where the photos go
+            sort_plan.extend(plan.plan_sessions(sessions, date, date_folder, sorted_folder, MIN_FLOWER_PHOTOS))
+
+        # forget photos that were deleted since they were indexed
+        index.prune()
+
+        # skip or link photos that are already in the plan or were placed before
+        found = dedupe.find_duplicates(sort_plan, index)
+        if found:
+            sort_plan = dedupe.apply_duplicates(sort_plan, found, action=duplicates)
+            report_path = os.path.join(os.path.dirname(os.path.abspath(plan_path)) if dry_run else output_dir,
+                                       dedupe.REPORT_FILENAME)
+            os.makedirs(os.path.dirname(report_path), exist_ok=True)
+            dedupe.write_report(found, duplicates, report_path)
+            print(f"Found {len(found)} duplicate photos ({duplicates}), listed in {report_path}")
+
+        # check the plan before any photo is placed
+        errors, bugs = plan.validate_plan(sort_plan, cameras_by_date)
+        for date, messages in bugs.items():
+            for message in messages:
+                print(f"{date}: {message}")
+
+        # write the plan
+        if plan_path is not None:
+            plan.write_plan(sort_plan, plan_path)
+            print(f"Sort plan with {len(sort_plan)} photos written to {plan_path}")
+
+        if errors:
+            raise ValueError("the sort plan cannot be executed:\n" + "\n".join(errors))
+        if dry_run:
+            return
+
+        # remember what is placed, so later runs find duplicates of it
+        dedupe.record_placed(sort_plan, index)
+    finally:
+        et.terminate()
+        index.close()
+
+    # place all photos in parallel
+    with transfer.CopyExecutor(placement=placement, jobs=jobs, per_device=per_device, verify=verify) as executor:
+        plan.execute_plan(sort_plan, executor=executor)
+        failures = executor.wait()
+    executor.report()
+    if verify:
+        executor.write_manifest(os.path.join(output_dir, transfer.MANIFEST_FILENAME))
+
+    # record how the photos were grouped, and check bugs
+    for sorted_folder, grouping in groupings.items():
+        write_grouping(sorted_folder, *grouping)
+    check_bugs(bugs, output_dir)
+
+    # report photos that could not be placed
+    if failures:
+        for src, dst, error in failures:
+            print(f"Failed to place {src} at {dst}: {error}")
+        raise failures[0][2]
 
 
 def parse_command_line():
@@ -318,12 +496,113 @@ def parse_command_line():
         choices=["CR3", "JPEG", "PNG", "TIFF", "DNG"],  # restrict to valid options
         required = False)
 
+    # add exiftool batch size
+    parser.add_argument(
+        "--batch-size",
+        help=f"number of photos sent to exiftool at once. Default is {DEFAULT_BATCH_SIZE}",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        required = False)
+
+    # add rebuild index
+    parser.add_argument(
+        "--rebuild-index",
+        help="ignore the metadata index from earlier runs and read every photo again",
+        action="store_true")
+
+    # add placement mode
+    parser.add_argument(
+        "--placement",
+        help="how photos are placed in the output folder. auto reflinks photos where the filesystem supports it "
+             "and copies them otherwise, hardlink and symlink share the photos with the input folder. Default is auto",
+        default="auto",
+        choices=place.PLACEMENTS,
+        required = False)
+
+    # add parallel placement options
+    parser.add_argument(
+        "--jobs",
+        help=f"number of photos placed in parallel. Default is {transfer.DEFAULT_JOBS}",
+        type=int,
+        default=transfer.DEFAULT_JOBS,
+        required = False)
+    parser.add_argument(
+        "--per-device",
+        help=f"maximum number of photos read from one device at once. Default is {transfer.DEFAULT_PER_DEVICE}",
+        type=int,
+        default=transfer.DEFAULT_PER_DEVICE,
+        required = False)
+    parser.add_argument(
+        "--verify",
+        help="hash every placed photo with blake2b, compare it with its source and write manifest.blake2b",
+        action="store_true")
+
+    # add session break threshold
+    parser.add_argument(
+        "--max-time-diff",
+        help="pause in seconds that separates two shooting sessions, or auto to pick it from the gaps between photos. "
+             f"Default is {MAX_TIME_DIFF.total_seconds():.0f}",
+        type=parse_max_time_diff,
+        default=MAX_TIME_DIFF,
+        required = False)
+
+    # add dry run and plan output
+    parser.add_argument(
+        "--dry-run",
+        help="only plan the sort and write the plan, do not place any photo",
+        action="store_true")
+    parser.add_argument(
+        "--plan",
+        help="write the sort plan to this .json or .csv file. Default with --dry-run is <output>/sort_plan.json",
+        required = False)
+
+    # add duplicate handling
+    parser.add_argument(
+        "--duplicates",
+        help="what to do with photos that have the same content as a photo sorted before: skip them, link them "
+             "to the first copy, or keep them. Default is skip",
+        default="skip",
+        choices=dedupe.DUPLICATE_ACTIONS,
+        required = False)
+
+    # add watch mode
+    parser.add_argument(
+        "--watch",
+        help="keep polling the input folder and sort photos while they are copied from the SD cards, until Ctrl-C",
+        action="store_true")
+    parser.add_argument(
+        "--interval",
+        help="seconds between two polls of the input folder with --watch. Default is 10",
+        type=float,
+        default=10,
+        required = False)
+    parser.add_argument(
+        "--idle-exit",
+        help="with --watch, stop after this many seconds without new photos. Default is 0 (never)",
+        type=float,
+        default=0,
+        required = False)
+
     # parse args
     args = parser.parse_args()
 
+    # watch mode places sessions as they close, there is no whole plan to write
+    if args.watch and (args.dry_run or args.plan is not None):
+        parser.error("--watch cannot be combined with --dry-run or --plan")
+
     return args
 
 
+def parse_max_time_diff(value):
+    "parse the --max-time-diff argument: seconds, or auto (returned as None)"
+    if value == "auto":
+        return None
+    try:
+        return timedelta(seconds=float(value))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected seconds or auto, got {value}")
+
+
 def main():
     "run main function on parsed args"
 
@@ -333,8 +612,19 @@ def main():
     # get dates
     dates = os.listdir(args.input)
 
+    # sort photos while they arrive
+    if args.watch:
+        from photogramkit import watch # watch imports this module
+        watch.run_watch(args.input, args.output, args.format, batch_size=args.batch_size,
+                        rebuild_index=args.rebuild_index, placement=args.placement, jobs=args.jobs,
+                        per_device=args.per_device, verify=args.verify, max_time_diff=args.max_time_diff,
+                        duplicates=args.duplicates, interval=args.interval, idle_exit=args.idle_exit)
+        return
+
     # run sort
-    run_sort(args.input, args.output, args.format)
+    run_sort(args.input, args.output, args.format, batch_size=args.batch_size, rebuild_index=args.rebuild_index,
+             placement=args.placement, jobs=args.jobs, per_device=args.per_device, verify=args.verify,
+             max_time_diff=args.max_time_diff, dry_run=args.dry_run, plan_path=args.plan, duplicates=args.duplicates)
 
 
 if __name__ == "__main__":
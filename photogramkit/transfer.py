@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+A parallel engine for placing sorted photos, with a concurrency limit per source device.
+
+    Photos are placed by a thread pool (see photogramkit.place for the placement modes).
+    At most per_device photos are read from the same device at once, so two card readers
+    stream in parallel while a single SD card is not thrashed by many readers. Photos wait
+    in one queue per device and are only handed to the pool when their device has room, so
+    a worker thread never sits idle waiting for a busy card while another card has photos.
+
+    With verify, every placed photo is hashed (blake2b) and compared with its source, and
+    the hashes can be written to a manifest that `b2sum -c` understands:
+
+    ./photos-organized
+    ├── manifest.blake2b
+    ├── 070324
+    └── 070424
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from photogramkit import place
+
+
+# name of the manifest file in the output folder
+MANIFEST_FILENAME = "manifest.blake2b"
+
+# bytes read at once while hashing
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# default number of worker threads and transfers per source device
+DEFAULT_JOBS = 8
+DEFAULT_PER_DEVICE = 2
+
+
+def hash_file(path):
+    "return the blake2b hex digest of a file, reading it in chunks"
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def device_of(path):
+    "return the id of the device path is stored on"
+    return os.stat(path).st_dev
+
+
+class CopyExecutor:
+    """
+    place photos in parallel with a limit on concurrent transfers per source device.
+
+    Parameters:
+        placement: one of place.PLACEMENTS
+        jobs: the number of worker threads
+        per_device: the maximum number of photos read from one device at once
+        verify: if True, hash every placed photo and compare it with its source
+
+    Use as a context manager, submit photos, then call wait:
+
+        with CopyExecutor(placement="copy", verify=True) as executor:
+            executor.submit(src, dst)
+            failures = executor.wait()
+    """
+
+    def __init__(self, placement="auto", jobs=DEFAULT_JOBS, per_device=DEFAULT_PER_DEVICE, verify=False):
+        self.placement = placement
+        self.per_device = per_device
+        self.verify = verify
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+
+        # photos waiting for their source device as (future, src, dst), and the number being placed, per device
+        self.device_queues = {}
+        self.device_running = {}
+        self.lock = threading.Lock()
+
+        # submitted transfers as (future, src, dst)
+        self.pending = []
+
+        # finished transfers as (dst, digest, size, mode), digest is None without verify
+        self.results = []
+        self.start_time = None
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # photos still waiting for their device are not started anymore
+        with self.lock:
+            for queue in self.device_queues.values():
+                for future, _, _ in queue:
+                    future.cancel()
+                queue.clear()
+        self.pool.shutdown(wait=True)
+
+    def submit(self, src, dst):
+        "queue the photo src to be placed at dst, its folder must exist"
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        future = Future()
+        self.pending.append((future, src, dst))
+
+        try:
+            device = device_of(src)
+        except OSError as error:
+            future.set_exception(error)
+            return
+
+        with self.lock:
+            self.device_queues.setdefault(device, deque()).append((future, src, dst))
+            self._dispatch(device)
+
+    def wait(self):
+        """
+        wait for all submitted photos.
+
+        Outputs:
+            failures: a list of tuple (src, dst, exception) for photos that could not be placed
+        """
+        failures = []
+        for future, src, dst in self.pending:
+            try:
+                future.result()
+            except Exception as error:
+                failures.append((src, dst, error))
+        self.pending = []
+
+        if self.start_time is not None:
+            self.elapsed += time.perf_counter() - self.start_time
+            self.start_time = None
+
+        return failures
+
+    def _dispatch(self, device):
+        "hand the photos of device to the pool until per_device of them are being placed, call with the lock held"
+        queue = self.device_queues[device]
+        while queue and self.device_running.get(device, 0) < self.per_device:
+            future, src, dst = queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.device_running[device] = self.device_running.get(device, 0) + 1
+            self.pool.submit(self._run, device, future, src, dst)
+
+    def _run(self, device, future, src, dst):
+        "place one photo and start the next one from the same device, runs in a worker thread"
+        try:
+            future.set_result(self._place(src, dst))
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            with self.lock:
+                self.device_running[device] -= 1
+                self._dispatch(device)
+
+    def _place(self, src, dst):
+        "place one photo"
+        size = os.stat(src).st_size
+
+        # a moved source is gone afterwards, so hash it first
+        source_digest = hash_file(src) if self.verify and self.placement == "move" else None
+
+        mode = place.place_file(src, dst, self.placement)
+
+        digest = None
+        if self.verify:
+            digest = hash_file(dst)
+            # links share the data with their source, only copies can differ
+            if mode in ("copy", "reflink"):
+                source_digest = hash_file(src)
+            if source_digest is not None and source_digest != digest:
+                raise OSError(f"checksum mismatch after {mode}: {src} -> {dst}")
+
+        with self.lock:
+            self.results.append((dst, digest, size, mode))
+
+    def write_manifest(self, manifest_path):
+        "write the blake2b hashes of all verified photos, with paths relative to the manifest folder"
+        manifest_folder = os.path.dirname(os.path.abspath(manifest_path))
+        with open(manifest_path, "w") as manifest:
+            for dst, digest, _, _ in sorted(self.results):
+                if digest is not None:
+                    manifest.write(f"{digest}  {os.path.relpath(os.path.abspath(dst), manifest_folder)}\n")
+
+    def report(self):
+        "print the number of placed photos and the throughput in MB/s and files/s"
+        n_files = len(self.results)
+        megabytes = sum(size for _, _, size, _ in self.results) / 1e6
+        seconds = max(self.elapsed, 1e-9)
+
+        modes = {}
+        for _, _, _, mode in self.results:
+            modes[mode] = modes.get(mode, 0) + 1
+        modes = "".join(f", {mode}: {count}" for mode, count in sorted(modes.items()))
+
+        print(f"Placed {n_files} photos ({megabytes:.1f} MB) in {self.elapsed:.1f} s: "
+              f"{megabytes / seconds:.1f} MB/s, {n_files / seconds:.1f} files/s{modes}")
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+
+"""
+Sort photos while they are still being offloaded from the SD cards.
+
+    The input folder is polled every few seconds (no inotify, so it also works on network shares).
+    A photo is read once its size and modification time did not change between two polls, and
+    only new photos are read. The photos of each date are grouped again after every poll (see
+    photogramkit.group), and a session is closed once every camera of the date has a photo taken
+    more than max_time_diff after it ends. Closed sessions are placed in their flowerN folders
+    right away, so sorting overlaps with capture instead of coming after it. Duplicates of photos
+    placed before are found in every batch like in photogramkit.sort (see photogramkit.dedupe).
+
+    What was placed is remembered in the output folder, so a stopped watch can be restarted:
+
+    ./photos-organized
+    ├── .photogramkit_watch.json
+    ├── 070324
+    └── 070424
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+from photogramkit import dedupe
+from photogramkit import group
+from photogramkit import plan
+from photogramkit import sort
+from photogramkit import transfer
+from photogramkit.index import MetadataIndex, INDEX_FILENAME
+
+
+# name of the file keeping what was placed, in the output folder
+STATE_FILENAME = ".photogramkit_watch.json"
+
+# seconds between two polls of the input folder
+DEFAULT_INTERVAL = 10
+
+
+def scan_photos(input_dir, img_format):
+    """
+    list the photos of all date and camera folders without opening them.
+
+    Parameters:
+        input_dir: a directory of input folder (date folders containing camera folders)
+        img_format: the photo extension, like CR3
+
+    Outputs:
+        photos: a dict {photo_dir: (size, mtime_ns)}
+        cameras_by_date: a dict {date: [camera names]}
+    """
+    photos = {}
+    cameras_by_date = {}
+
+    for date_entry in os.scandir(input_dir):
+        if not date_entry.is_dir() or date_entry.name.startswith('.'):
+            continue
+        cameras_by_date[date_entry.name] = []
+
+        for camera_entry in os.scandir(date_entry.path):
+            if not camera_entry.is_dir() or camera_entry.name.startswith('.'):
+                continue
+            cameras_by_date[date_entry.name].append(camera_entry.name)
+
+            for photo_entry in os.scandir(camera_entry.path):
+                if photo_entry.name.startswith('.') or not photo_entry.name.endswith(f".{img_format}"):
+                    continue
+                try:
+                    stat = photo_entry.stat()
+                except FileNotFoundError: # removed while scanning
+                    continue
+                photos[photo_entry.path] = (stat.st_size, stat.st_mtime_ns)
+
+    return photos, cameras_by_date
+
+
+class SortWatcher:
+    """
+    sort the photos of an input folder that is still being filled.
+
+    Parameters:
+        input_dir: a directory of input folder
+        output_dir: a directory of output folder
+        img_format: the photo extension, like CR3
+        executor: a transfer.CopyExecutor placing the photos
+        index: a MetadataIndex. photos already in it are not read again
+        et: a LazyExifTool for photos the built-in reader cannot parse
+        batch_size: the number of photos sent to exiftool at once
+        max_time_diff: a timedelta, or None to pick it for each date from the gaps between photos.
+                       an adaptive pause is kept fixed once a session of the date was placed
+        duplicates: what to do with duplicates, one of dedupe.DUPLICATE_ACTIONS
+
+    Call poll to read new photos, then commit to place closed sessions:
+
+        watcher.poll()
+        watcher.commit()
+    """
+
+    def __init__(self, input_dir, output_dir, img_format, executor, index=None, et=None,
+                 batch_size=sort.DEFAULT_BATCH_SIZE, max_time_diff=sort.MAX_TIME_DIFF, duplicates="skip"):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.img_format = img_format
+        self.executor = executor
+        self.index = index
+        self.et = et if et is not None else sort.LazyExifTool()
+        self.batch_size = batch_size
+        self.max_time_diff = max_time_diff
+        self.duplicates = duplicates
+
+        # (size, mtime_ns) of every photo at the last poll, and photos already read
+        self.last_seen = {}
+        self.read = set()
+
+        # {date: {camera: {photo name: datetime}}} and {date: [camera names]}
+        self.timestamps = {}
+        self.cameras_by_date = {}
+
+        # dates with photos that were not committed yet
+        self.changed_dates = set()
+
+        # {date: {"max_gap": seconds, "placed": {source: [destination, capture time]}, "flowers": [flower names],
+        #         "duplicates": {source: [destination, original source, original destination]}}}
+        self.state_path = os.path.join(output_dir, STATE_FILENAME)
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+        # placed photos keep their place after a restart, even if they were moved away from the input folder
+        for date, date_state in self.state.items():
+            for source, (_, capture_time) in date_state["placed"].items():
+                camera_folder, name = os.path.split(source)
+                camera = os.path.basename(camera_folder)
+                self.timestamps.setdefault(date, {}).setdefault(camera, {})[name] = datetime.fromisoformat(capture_time)
+                self.read.add(source)
+
+    def poll(self, final=False):
+        """
+        read the photos that appeared since the last poll.
+
+        Parameters:
+            final: if True, also read photos that only appeared in this poll
+
+        Outputs:
+            the number of newly read photos
+        """
+        photos, cameras_by_date = scan_photos(self.input_dir, self.img_format)
+        self.cameras_by_date = cameras_by_date
+
+        # a photo is complete once it stopped changing between two polls
+        stable = [photo_dir for photo_dir, signature in photos.items()
+                  if photo_dir not in self.read and (final or self.last_seen.get(photo_dir) == signature)]
+        self.last_seen = photos
+        if not stable:
+            return 0
+
+        capture_times = sort.read_capture_times_indexed(self.et, sorted(stable), index=self.index,
+                                                        batch_size=self.batch_size)
+        for photo_dir, metadata in capture_times.items():
+            self.read.add(photo_dir)
+            if metadata["capture_time"] is None:
+                print(f"{photo_dir} has no capture time and is not sorted")
+                continue
+
+            camera_folder, name = os.path.split(photo_dir)
+            date_folder, camera = os.path.split(camera_folder)
+            date = os.path.basename(date_folder)
+            self.timestamps.setdefault(date, {}).setdefault(camera, {})[name] = sort.parse_capture_time(
+                metadata["capture_time"], metadata["subsec_time"])
+            self.changed_dates.add(date)
+
+        return len(capture_times)
+
+    def commit(self, final=False):
+        """
+        place the photos of closed sessions that were not placed yet.
+
+        Parameters:
+            final: if True, place every session, closed or not
+
+        Outputs:
+            the number of photos submitted to the executor
+        """
+        n_submitted = 0
+        n_duplicates = sum(len(date_state.get("duplicates", {})) for date_state in self.state.values())
+        for date in sorted(self.changed_dates):
+            n_submitted += self._commit_date(date, final)
+        self._save_state()
+        if sum(len(date_state.get("duplicates", {})) for date_state in self.state.values()) != n_duplicates:
+            self._write_duplicates()
+        return n_submitted
+
+    def _commit_date(self, date, final):
+        "place the closed sessions of one date, returns the number of photos submitted"
+        date_folder = os.path.join(self.input_dir, date)
+        sorted_folder = os.path.join(self.output_dir, date)
+        date_state = self.state.setdefault(date, {"max_gap": None, "placed": {}, "flowers": []})
+        date_state.setdefault("duplicates", {})
+
+        timestamps_by_camera = {camera: sorted(photos.items())
+                                for camera, photos in self.timestamps.get(date, {}).items()}
+        arrays = group.timestamps_to_arrays(timestamps_by_camera)
+
+        # pick the session break threshold, then keep it so placed sessions do not change
+        if date_state["max_gap"] is not None:
+            max_gap = date_state["max_gap"]
+        elif self.max_time_diff is None:
+            max_gap = group.adaptive_gap_threshold(group.camera_gaps(arrays), default=sort.MAX_TIME_DIFF.total_seconds())
+        else:
+            max_gap = self.max_time_diff.total_seconds()
+
+        offsets = group.estimate_clock_offsets(arrays, max_gap)
+        sessions = group.group_sessions(arrays, offsets, max_gap)
+
+        n_closed = len(sessions) if final else closed_sessions(arrays, offsets, sessions, max_gap,
+                                                               self.cameras_by_date.get(date, []))
+        if n_closed == 0:
+            return 0
+
+        # plan every closed session again, so flower numbers stay the same, and only place what is new
+        closed_plan = plan.plan_sessions(sessions[:n_closed], date, date_folder, sorted_folder, sort.MIN_FLOWER_PHOTOS)
+        new_entries = []
+        for entry in closed_plan:
+            placed = date_state["placed"].get(entry["source"])
+            if placed is None:
+                # skipped duplicates are not placed again
+                if entry["source"] not in date_state["duplicates"]:
+                    new_entries.append(entry)
+            elif os.path.normpath(placed[0]) != os.path.normpath(entry["destination"]):
+                print(f"{date}: {entry['source']} was placed at {placed[0]} but now belongs at {entry['destination']}")
+
+        if not new_entries:
+            return 0
+
+        # skip or link photos that are already in the batch or were placed before
+        found = dedupe.find_duplicates(new_entries, self.index)
+        if found:
+            new_entries = dedupe.apply_duplicates(new_entries, found, action=self.duplicates)
+            print(f"{date}: found {len(found)} duplicate photos ({self.duplicates})")
+
+        errors, _ = plan.validate_plan(new_entries, self.cameras_by_date)
+        if errors:
+            raise ValueError("the sort plan cannot be executed:\n" + "\n".join(errors))
+
+        # remember what is placed, so later batches find duplicates of it
+        if self.index is not None:
+            dedupe.record_placed(new_entries, self.index)
+
+        plan.execute_plan(new_entries, executor=self.executor)
+        failures = self.executor.wait()
+        failed = {src for src, _, _ in failures}
+        for src, dst, error in failures:
+            print(f"Failed to place {src} at {dst}: {error}")
+
+        placed_sources = set()
+        for entry in new_entries:
+            if entry["source"] not in failed:
+                capture_time = self.timestamps[date][entry["camera"]][os.path.basename(entry["source"])]
+                date_state["placed"][entry["source"]] = [entry["destination"], capture_time.isoformat()]
+                placed_sources.add(entry["source"])
+        for entry, original in found:
+            if entry["source"] in placed_sources or self.duplicates == "skip":
+                date_state["duplicates"][entry["source"]] = [entry["destination"], original["source"],
+                                                             original["destination"]]
+        date_state["max_gap"] = max_gap
+
+        # check flowers once they are first placed
+        new_flowers = {entry["flower"] for entry in new_entries if entry["role"] == "flower"}
+        new_flowers -= set(date_state["flowers"])
+        _, bugs = plan.validate_plan([entry for entry in closed_plan if entry["flower"] in new_flowers],
+                                     self.cameras_by_date)
+        for message in bugs.get(date, []):
+            print(f"{date}: {message}")
+        sort.check_bugs(bugs, self.output_dir)
+        date_state["flowers"] = sorted(set(date_state["flowers"]) | new_flowers)
+
+        sort.write_grouping(sorted_folder, max_gap, self.max_time_diff is None, offsets, sessions[:n_closed])
+        print(f"{date}: placed {len(new_entries) - len(failures)} photos of {n_closed} closed sessions")
+
+        # dates are committed again only when they get new photos, unless something is still open
+        if n_closed == len(sessions) and not failures:
+            self.changed_dates.discard(date)
+        return len(new_entries)
+
+    def _save_state(self):
+        "write what was placed to the state file"
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.state_path, "w") as f:
+            json.dump(self.state, f, indent=1)
+
+    def _write_duplicates(self):
+        "list the duplicates found by every batch in duplicates.csv in the output folder"
+        found = [({"source": source, "destination": destination},
+                  {"source": original_source, "destination": original_destination})
+                 for date_state in self.state.values()
+                 for source, (destination, original_source, original_destination)
+                 in sorted(date_state.get("duplicates", {}).items())]
+        dedupe.write_report(found, self.duplicates, os.path.join(self.output_dir, dedupe.REPORT_FILENAME))
+
+
+def closed_sessions(arrays, offsets, sessions, max_gap, cameras):
+    """
+    count the sessions that cannot grow anymore: every camera has a photo taken more than max_gap
+    after the session ended. photos arrive in capture order on each card, so later photos
+    can only add to the open sessions at the end.
+
+    Parameters:
+        arrays: a dict from group.timestamps_to_arrays
+        offsets: a dict from group.estimate_clock_offsets
+        sessions: a list from group.group_sessions
+        max_gap: the pause in seconds that separates two sessions
+        cameras: all camera names of the date, a camera without photos yet keeps every session open
+
+    Outputs:
+        the number of closed sessions at the start of sessions
+    """
+    if any(camera not in arrays or len(arrays[camera][1]) == 0 for camera in cameras):
+        return 0
+
+    # the latest clock-corrected capture time of every camera
+    latest = min(arrays[camera][1][-1] - offsets.get(camera, 0.0) for camera in arrays)
+
+    # corrected capture time of every photo
+    corrected = {camera: dict(zip(names, seconds - offsets.get(camera, 0.0)))
+                 for camera, (names, seconds) in arrays.items()}
+
+    n_closed = 0
+    for session in sessions:
+        session_end = max(corrected[camera][photos[-1]] for camera, photos in session.items())
+        if session_end + max_gap >= latest:
+            break
+        n_closed += 1
+    return n_closed
+
+
+def run_watch(input_dir, output_dir, img_format, batch_size=sort.DEFAULT_BATCH_SIZE, rebuild_index=False,
+              placement="auto", jobs=transfer.DEFAULT_JOBS, per_device=transfer.DEFAULT_PER_DEVICE, verify=False,
+              max_time_diff=sort.MAX_TIME_DIFF, duplicates="skip", interval=DEFAULT_INTERVAL, idle_exit=0):
+    """
+    watch input_dir and sort photos into output_dir while they arrive, until Ctrl-C,
+    or until no new photo arrived for idle_exit seconds (0 watches forever).
+    when stopping, the sessions that are still open are placed as well.
+    the other parameters are the same as for sort.run_sort.
+    """
+    index = MetadataIndex(os.path.join(output_dir, INDEX_FILENAME), rebuild=rebuild_index)
+    et = sort.LazyExifTool()
+
+    try:
+        with transfer.CopyExecutor(placement=placement, jobs=jobs, per_device=per_device, verify=verify) as executor:
+            watcher = SortWatcher(input_dir, output_dir, img_format, executor, index=index, et=et,
+                                  batch_size=batch_size, max_time_diff=max_time_diff, duplicates=duplicates)
+            print(f"Watching {input_dir} every {interval} s, press Ctrl-C to stop")
+
+            last_photo = time.monotonic()
+            try:
+                while True:
+                    if watcher.poll():
+                        last_photo = time.monotonic()
+                    watcher.commit()
+                    if verify:
+                        executor.write_manifest(os.path.join(output_dir, transfer.MANIFEST_FILENAME))
+
+                    if idle_exit and time.monotonic() - last_photo > idle_exit:
+                        print(f"No new photo for {idle_exit} s")
+                        break
+                    time.sleep(interval)
+            except KeyboardInterrupt:
+                print("Stopping")
+
+            # place whatever is left
+            watcher.poll(final=True)
+            watcher.commit(final=True)
+        executor.report()
+        if verify:
+            executor.write_manifest(os.path.join(output_dir, transfer.MANIFEST_FILENAME))
+    finally:
+        et.terminate()
+        index.close()
@@ -22,6 +22,7 @@ setup(
 		]
 	},
 	install_requires=[
-        'pyexiftool==0.4.13'
+        'pyexiftool==0.4.13',
+        'numpy'
     ]
 	)
\ No newline at end of file
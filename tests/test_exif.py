@@ -0,0 +1,151 @@
+"""
+Tests for photogramkit.exif, on small photos built byte by byte.
+
+    python -m pytest tests
+"""
+
+import struct
+
+import pytest
+
+from photogramkit import exif
+
+
+def tiff_structure(endian, exif_tags, ifd0_tags=None, exif_ifd_first=False):
+    """
+    a TIFF structure with ASCII tags, IFD0 pointing to an EXIF IFD, or only the EXIF IFD if exif_ifd_first.
+    values of up to 4 bytes are stored in their entry, longer ones after the IFDs.
+    """
+    def ifd(tags, offset, extra_entries=()):
+        "an IFD at offset followed by its long values, as bytes"
+        entries = sorted([(tag, exif.TYPE_ASCII, value.encode() + b"\x00") for tag, value in tags.items()]
+                         + list(extra_entries))
+        values_offset = offset + 2 + 12 * len(entries) + 4
+        body, values = struct.pack(endian + "H", len(entries)), b""
+        for tag, field_type, value in entries:
+            if field_type != exif.TYPE_ASCII:
+                body += struct.pack(endian + "HHII", tag, field_type, 1, value)
+            elif len(value) <= 4:
+                body += struct.pack(endian + "HHI", tag, field_type, len(value)) + value.ljust(4, b"\x00")
+            else:
+                body += struct.pack(endian + "HHII", tag, field_type, len(value), values_offset + len(values))
+                values += value
+        return body + struct.pack(endian + "I", 0) + values
+
+    header = (b"II" if endian == "<" else b"MM") + struct.pack(endian + "HI", 42, 8)
+    if exif_ifd_first:
+        return header + ifd(exif_tags, 8)
+
+    # IFD0 has one more entry, the pointer to the EXIF IFD, and its values come before the EXIF IFD
+    ifd0_size = len(ifd(ifd0_tags or {}, 8, [(exif.TAG_EXIF_IFD, 4, 0)]))
+    ifd0 = ifd(ifd0_tags or {}, 8, [(exif.TAG_EXIF_IFD, 4, 8 + ifd0_size)])
+    return header + ifd0 + ifd(exif_tags, 8 + ifd0_size)
+
+
+def jpeg(tiff, segments_before=()):
+    "a JPEG with other segments, then the APP1 Exif segment, then the start of the scan"
+    data = b"\xff\xd8"
+    for marker, payload in segments_before:
+        data += bytes([0xff, marker]) + struct.pack(">H", len(payload) + 2) + payload
+    app1 = b"Exif\x00\x00" + tiff
+    return data + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 + b"\xff\xda\x00\x02" + b"\x00" * 64
+
+
+def png_chunk(chunk_type, data):
+    "a PNG chunk, the crc is not checked by the reader"
+    return struct.pack(">I4s", len(data), chunk_type) + data + b"\x00\x00\x00\x00"
+
+
+def png(tiff):
+    "a PNG with its eXIf chunk after IHDR"
+    return (b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", b"\x00" * 13) + png_chunk(b"eXIf", tiff)
+            + png_chunk(b"IEND", b""))
+
+
+def box(box_type, payload):
+    "an ISO base media box"
+    return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+
+def cr3(cmt2):
+    "a CR3 with the EXIF IFD in the CMT2 box of Canon's uuid box"
+    canon = box(b"uuid", exif.CANON_CR3_UUID + box(b"CMT1", b"\x00" * 16) + box(b"CMT2", cmt2))
+    return (box(b"ftyp", b"crx " + b"\x00" * 4) + box(b"moov", box(b"mvhd", b"\x00" * 16) + canon)
+            + box(b"mdat", b"\x00" * 64))
+
+
+EXIF_TAGS = {exif.TAG_DATETIME_ORIGINAL: "2024:07:04 10:31:05", exif.TAG_SUBSEC_TIME_ORIGINAL: "07",
+             exif.TAG_BODY_SERIAL_NUMBER: "123456789012"}
+EXPECTED = {"capture_time": "2024:07:04 10:31:05", "subsec_time": "07", "serial": "123456789012"}
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_tiff(tmp_path, endian):
+    path = write(tmp_path, "IMG_0001.tif", tiff_structure(endian, EXIF_TAGS))
+    assert exif.read_exif_dates(path) == EXPECTED
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_dng_camera_serial_in_ifd0(tmp_path, endian):
+    tags = {exif.TAG_DATETIME_ORIGINAL: "2024:07:04 10:31:05", exif.TAG_SUBSEC_TIME_ORIGINAL: "512"}
+    path = write(tmp_path, "IMG_0001.dng",
+                 tiff_structure(endian, tags, ifd0_tags={exif.TAG_CAMERA_SERIAL_NUMBER: "DNG42"}))
+    assert exif.read_exif_dates(path) == {"capture_time": "2024:07:04 10:31:05", "subsec_time": "512",
+                                          "serial": "DNG42"}
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_jpeg_app1(tmp_path, endian):
+    # an APP0 JFIF segment comes first in most JPEGs
+    data = jpeg(tiff_structure(endian, EXIF_TAGS), segments_before=[(0xe0, b"JFIF\x00" + b"\x00" * 9)])
+    path = write(tmp_path, "IMG_0001.jpg", data)
+    assert exif.read_exif_dates(path) == EXPECTED
+
+
+def test_jpeg_without_exif(tmp_path):
+    data = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00" + b"\x00" * 9 + b"\xff\xda\x00\x02" + b"\x00" * 64
+    assert exif.read_exif_dates(write(tmp_path, "IMG_0001.jpg", data)) is None
+
+
+def test_png_exif_chunk(tmp_path):
+    path = write(tmp_path, "IMG_0001.png", png(tiff_structure(">", EXIF_TAGS)))
+    assert exif.read_exif_dates(path) == EXPECTED
+
+
+def test_cr3_cmt2(tmp_path):
+    path = write(tmp_path, "IMG_0001.CR3", cr3(tiff_structure("<", EXIF_TAGS, exif_ifd_first=True)))
+    assert exif.read_exif_dates(path) == EXPECTED
+
+
+def test_missing_subsec_and_serial(tmp_path):
+    path = write(tmp_path, "IMG_0001.tif", tiff_structure("<", {exif.TAG_DATETIME_ORIGINAL: "2024:07:04 10:31:05"}))
+    assert exif.read_exif_dates(path) == {"capture_time": "2024:07:04 10:31:05", "subsec_time": None,
+                                          "serial": None}
+
+
+def test_no_capture_time(tmp_path):
+    path = write(tmp_path, "IMG_0001.tif", tiff_structure("<", {exif.TAG_BODY_SERIAL_NUMBER: "123456789012"}))
+    assert exif.read_exif_dates(path) is None
+
+
+@pytest.mark.parametrize("name, data", [
+    ("empty.CR3", b""),
+    ("text.CR3", b"not a photo at all"),
+    ("truncated.tif", tiff_structure("<", EXIF_TAGS)[:40]),
+    ("truncated.jpg", jpeg(tiff_structure(">", EXIF_TAGS))[:30]),
+    ("truncated.CR3", cr3(tiff_structure("<", EXIF_TAGS, exif_ifd_first=True))[:60]),
+])
+def test_unreadable_photos_fall_back_to_exiftool(tmp_path, name, data):
+    # None makes the caller ask exiftool
+    assert exif.read_exif_dates(write(tmp_path, name, data)) is None
+
+
+def test_implausible_ifd_is_rejected(tmp_path):
+    data = b"II" + struct.pack("<HI", 42, 8) + struct.pack("<H", exif.MAX_IFD_ENTRIES + 1) + b"\x00" * 64
+    assert exif.read_exif_dates(write(tmp_path, "IMG_0001.tif", data)) is None
@@ -0,0 +1,107 @@
+"""
+Tests for photogramkit.group, on synthetic capture times.
+
+    python -m pytest tests
+"""
+
+import datetime
+
+import numpy as np
+import pytest
+
+from photogramkit import group
+
+
+START = datetime.datetime(2024, 7, 4, 10, 0, 0)
+
+
+def burst_times(session_starts, photos_per_session=10, interval=1.5):
+    "capture times in seconds of bursts of photos_per_session photos starting at session_starts"
+    return np.concatenate([start + interval * np.arange(photos_per_session) for start in session_starts])
+
+
+def camera(seconds, prefix="IMG"):
+    "a timestamps list like extract_time_for_photos_in_one_camera returns"
+    return [(f"{prefix}_{i:04d}.CR3", START + datetime.timedelta(seconds=float(second)))
+            for i, second in enumerate(seconds)]
+
+
+# four flowers, a few minutes apart
+SESSION_STARTS = [0.0, 300.0, 540.0, 1020.0]
+
+
+def test_two_camera_offset_recovery():
+    reference = burst_times(SESSION_STARTS)
+    # the second camera is 37.25 s ahead and missed the third flower
+    ahead = burst_times([start + 37.25 for start in SESSION_STARTS if start != 540.0])
+    arrays = group.timestamps_to_arrays({"bottom": camera(reference), "top": camera(ahead)})
+
+    offsets = group.estimate_clock_offsets(arrays, max_gap=60.0)
+
+    assert offsets["bottom"] == 0.0
+    assert offsets["top"] == pytest.approx(37.25)
+
+
+def test_sessions_are_cut_on_all_cameras_together():
+    reference = burst_times(SESSION_STARTS)
+    ahead = burst_times([start + 37.25 for start in SESSION_STARTS if start != 540.0])
+    arrays = group.timestamps_to_arrays({"bottom": camera(reference), "top": camera(ahead)})
+
+    sessions = group.group_sessions(arrays, group.estimate_clock_offsets(arrays, 60.0), max_gap=60.0)
+
+    assert len(sessions) == 4
+    assert [sorted(session) for session in sessions] == [["bottom", "top"], ["bottom", "top"], ["bottom"],
+                                                         ["bottom", "top"]]
+    assert sessions[3]["top"] == [f"IMG_{i:04d}.CR3" for i in range(20, 30)]
+
+
+def test_photos_are_sorted_by_capture_time():
+    # the file counter rolled over in the middle of the burst
+    timestamps = camera([5.0, 6.0, 0.0, 1.0])
+    arrays = group.timestamps_to_arrays({"bottom": timestamps})
+    assert list(arrays["bottom"][0]) == ["IMG_0002.CR3", "IMG_0003.CR3", "IMG_0000.CR3", "IMG_0001.CR3"]
+
+    arrays = group.timestamps_to_arrays({"bottom": timestamps}, sort_by_time=False)
+    assert list(arrays["bottom"][0]) == ["IMG_0000.CR3", "IMG_0001.CR3", "IMG_0002.CR3", "IMG_0003.CR3"]
+
+
+def test_no_photos():
+    arrays = group.timestamps_to_arrays({})
+    assert group.estimate_clock_offsets(arrays, 60.0) == {}
+    assert group.group_sessions(arrays, {}, 60.0) == []
+
+
+def test_otsu_split_separates_bursts_from_pauses():
+    rng = np.random.default_rng(0)
+    # bursts of 0.5 to 3 s between photos, pauses of 2 to 10 min between flowers
+    bursts = rng.uniform(0.5, 3.0, 500)
+    pauses = rng.uniform(120.0, 600.0, 12)
+    gaps = rng.permutation(np.concatenate([bursts, pauses]))
+
+    threshold = group.adaptive_gap_threshold(gaps, default=30.0)
+
+    assert bursts.max() < threshold < pauses.min()
+    assert threshold != 30.0
+
+
+def test_gaps_from_cameras():
+    arrays = group.timestamps_to_arrays({"bottom": camera(burst_times(SESSION_STARTS)),
+                                         "top": camera(burst_times(SESSION_STARTS[:1]))})
+    gaps = group.camera_gaps(arrays)
+
+    assert len(gaps) == 39 + 9
+    assert 1.5 < group.adaptive_gap_threshold(gaps, default=30.0) < 240.0 - 13.5
+
+
+@pytest.mark.parametrize("gaps", [
+    # a single flower, all gaps inside one burst
+    np.random.default_rng(1).uniform(0.5, 3.0, 200),
+    # a spread of gaps without an empty band between bursts and pauses
+    np.geomspace(0.5, 600.0, 200),
+    # photos taken in the same second, without sub-second time
+    np.zeros(50),
+    np.array([4.0]),
+    np.empty(0),
+])
+def test_unimodal_gaps_use_the_default(gaps):
+    assert group.adaptive_gap_threshold(gaps, default=30.0) == 30.0
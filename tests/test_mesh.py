@@ -0,0 +1,69 @@
+"""
+Tests for photogramkit.mesh, on small models written with mesh.write_ply.
+
+    python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+from photogramkit import mesh
+
+
+def grid_model(path, n=20):
+    "a colored n x n grid of vertices in the z=0 plane, two triangles per square"
+    x, y = np.meshgrid(np.arange(n, dtype=np.float64), np.arange(n, dtype=np.float64), indexing="ij")
+    positions = np.stack([x.ravel(), y.ravel(), np.zeros(n * n)], axis=1)
+    colors = np.full((n * n, 3), 200.0)
+    index = np.arange(n * n).reshape(n, n)
+    corners = index[:-1, :-1].ravel(), index[1:, :-1].ravel(), index[:-1, 1:].ravel(), index[1:, 1:].ravel()
+    faces = np.concatenate([np.stack([corners[0], corners[1], corners[2]], axis=1),
+                            np.stack([corners[1], corners[3], corners[2]], axis=1)])
+    mesh.write_ply(str(path), positions, faces, colors)
+    return positions, faces
+
+
+def expected_faces(positions, faces, grid):
+    "the faces of a level of detail, made in memory the way mesh.make_lod made them before streaming"
+    lower, upper = positions.min(axis=0), positions.max(axis=0)
+    size = float((upper - lower).max()) / grid
+    dims = np.floor((upper - lower) / size).astype(np.int64) + 1
+    cube = np.minimum(((positions - lower) / size).astype(np.int64), dims - 1)
+    _, cluster = np.unique((cube[:, 0] * dims[1] + cube[:, 1]) * dims[2] + cube[:, 2], return_inverse=True)
+    clustered = cluster[faces]
+    clustered = clustered[(clustered[:, 0] != clustered[:, 1]) & (clustered[:, 1] != clustered[:, 2])
+                          & (clustered[:, 0] != clustered[:, 2])]
+    _, first = np.unique(np.sort(clustered, axis=1), axis=0, return_index=True)
+    clustered = clustered[np.sort(first)]
+    return np.cumsum(np.isin(np.arange(cluster.max() + 1), clustered)) - 1, clustered
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1000])
+def test_lod_faces_are_deduplicated_across_chunks(tmp_path, monkeypatch, chunk_size):
+    positions, faces = grid_model(tmp_path / "flower.ply")
+    # small chunks put copies of a merged triangle in different chunks
+    monkeypatch.setattr(mesh.chunks, "__defaults__", (chunk_size,))
+
+    rows = mesh.process_model(str(tmp_path / "flower.ply"), grids=[6])
+
+    renumber, clustered = expected_faces(positions, faces, 6)
+    lod = mesh.PlyMesh(str(tmp_path / "flower_lod1.ply"))
+    assert rows[1]["faces"] == len(clustered) == len(lod.faces)
+    np.testing.assert_array_equal(lod.faces["vertex_indices"], renumber[clustered])
+    assert rows[1]["vertices"] == len(lod.vertices) == renumber.max() + 1
+    assert np.all(lod.vertices["red"] == 200)
+    # the temporary face file is gone
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["flower.ply", "flower_lod1.ply"]
+
+
+def test_obj_models_are_skipped(tmp_path):
+    (tmp_path / "species" / "flower" / "preview").mkdir(parents=True)
+    grid_model(tmp_path / "species" / "flower" / "flower.ply", n=3)
+    grid_model(tmp_path / "species" / "flower" / "preview" / "flower.ply", n=3)
+    (tmp_path / "species" / "flower" / "flower_lod1.ply").write_bytes(b"")
+    (tmp_path / "species" / "flower" / "other.obj").write_text("v 0 0 0\n")
+
+    models, skipped = mesh.find_models(str(tmp_path))
+
+    assert models == [str(tmp_path / "species" / "flower" / "flower.ply")]
+    assert skipped == [str(tmp_path / "species" / "flower" / "other.obj")]
@@ -0,0 +1,38 @@
+"""
+Tests for photogramkit.place.
+
+    python -m pytest tests
+"""
+
+import os
+
+from photogramkit import place
+
+
+def test_auto_never_links(tmp_path):
+    src = tmp_path / "IMG_0001.CR3"
+    src.write_bytes(b"raw photo")
+    dst = str(tmp_path / "sorted.CR3")
+
+    # same filesystem: reflink where supported, a copy otherwise, never the same file
+    assert place.place_file(str(src), dst) in ("reflink", "copy")
+    assert not os.path.samefile(src, dst)
+    with open(dst, "ab") as f:
+        f.write(b" edited")
+    assert src.read_bytes() == b"raw photo"
+
+    # and again on a re-run
+    assert place.place_file(str(src), dst) in ("reflink", "copy")
+    assert open(dst, "rb").read() == b"raw photo"
+
+
+def test_hardlink_is_opt_in(tmp_path):
+    src = tmp_path / "IMG_0001.CR3"
+    src.write_bytes(b"raw photo")
+    dst = str(tmp_path / "sorted.CR3")
+
+    assert place.place_file(str(src), dst, "hardlink") == "hardlink"
+    assert os.path.samefile(src, dst)
+    # re-running finds the link in place
+    assert place.place_file(str(src), dst, "hardlink") == "hardlink"
+    assert os.path.samefile(src, dst)
@@ -0,0 +1,239 @@
+"""
+Tests for photogramkit.runner, with sh -c stubs in place of darktable-cli and Metashape.
+
+    python -m pytest tests
+"""
+
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+from photogramkit import runner
+
+
+def sh(script):
+    "a command running script with sh"
+    return ["sh", "-c", script]
+
+
+def wait_until(condition, timeout=10.0):
+    "wait until condition() is True, fail the test after timeout seconds"
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            pytest.fail("timed out waiting for the runner")
+        time.sleep(0.01)
+
+
+def is_alive(pid):
+    "True if the process exists and is not a zombie"
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.fixture(autouse=True)
+def short_kill_grace(monkeypatch):
+    "killed stubs exit right away, so the grace period only slows the tests down"
+    monkeypatch.setattr(runner, "KILL_GRACE", 1)
+
+
+def test_jobs_start_in_order_within_the_cpu_budget(tmp_path):
+    order = tmp_path / "order"
+    release = tmp_path / "release"
+    # each job records its start, then waits until the test lets it finish
+    wait_script = f"while [ ! -e {release} ]; do sleep 0.01; done"
+
+    with runner.JobRunner(cpus=3, memory=None) as job_runner:
+        first = job_runner.submit(runner.Job("first", sh(f"echo first >> {order}; {wait_script}"), cpus=1))
+        wait_until(lambda: job_runner.stats()["running"] == 1)
+
+        # needs the whole budget, so it waits for the first job
+        whole = job_runner.submit(runner.Job("whole", sh(f"echo whole >> {order}"), cpus=3))
+        wait_until(lambda: len(job_runner.waiting) == 1)
+
+        # fits next to the first job, but must not pass the job waiting before it
+        small = job_runner.submit(runner.Job("small", sh(f"echo small >> {order}"), cpus=1))
+        wait_until(lambda: len(job_runner.waiting) == 2)
+        time.sleep(0.2)
+        assert order.read_text().split() == ["first"]
+        assert job_runner.stats()["cpus"] == 1
+
+        release.touch()
+        results = [future.result(timeout=10) for future in (first, whole, small)]
+
+    assert order.read_text().split() == ["first", "whole", "small"]
+    assert all(result.ok for result in results)
+
+
+def test_jobs_share_the_cpu_budget(tmp_path):
+    running = tmp_path / "running"
+    peak = tmp_path / "peak"
+    # every job counts the jobs running next to it with a file per job
+    script = (f"mkdir -p {running}; touch {running}/$$; ls {running} | wc -l >> {peak}; "
+              f"sleep 0.2; rm {running}/$$")
+
+    with runner.JobRunner(cpus=2, memory=None) as job_runner:
+        futures = [job_runner.submit(runner.Job(f"job{i}", sh(script))) for i in range(6)]
+        results = [future.result(timeout=10) for future in futures]
+
+    assert all(result.ok for result in results)
+    assert max(int(line) for line in peak.read_text().split()) <= 2
+
+
+def test_timeout_kills_the_process_group_and_retries(tmp_path):
+    pids = tmp_path / "pids"
+    # the child sleep is in the process group of the job, and is killed with it
+    job = runner.Job("hangs", sh(f"sleep 30 & echo $! >> {pids}; wait"), timeout=0.3, retries=1)
+
+    start = time.monotonic()
+    with runner.JobRunner(cpus=1, memory=None, log_dir=str(tmp_path / "logs")) as job_runner:
+        result = job_runner.run(job)
+
+    assert time.monotonic() - start < 10
+    assert result.timed_out
+    assert not result.ok
+    assert result.attempts == 2
+    assert result.returncode < 0
+
+    children = [int(pid) for pid in pids.read_text().split()]
+    assert len(children) == 2
+    wait_until(lambda: not any(is_alive(pid) for pid in children))
+
+    log = open(result.log_path).read()
+    assert log.count("--- attempt") == 2
+    assert log.count("--- killed after 0.3 s") == 2
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        result.check()
+
+
+def test_timeout_kills_a_program_ignoring_sigterm(tmp_path):
+    job = runner.Job("stubborn", sh("trap '' TERM; sleep 30 & wait; sleep 30"), timeout=0.3)
+
+    start = time.monotonic()
+    with runner.JobRunner(cpus=1, memory=None) as job_runner:
+        result = job_runner.run(job)
+
+    # SIGTERM is ignored, SIGKILL after the grace period is not
+    assert time.monotonic() - start < runner.KILL_GRACE + 5
+    assert result.timed_out
+    assert result.returncode == -9
+
+
+def test_killed_by_a_signal_is_retried(tmp_path):
+    marker = tmp_path / "marker"
+    # killed like by the out-of-memory killer on the first attempt only
+    job = runner.Job("oom", sh(f"if [ -e {marker} ]; then echo done; exit 0; fi; touch {marker}; kill -KILL $$"),
+                     retries=2)
+
+    with runner.JobRunner(cpus=1, memory=None) as job_runner:
+        result = job_runner.run(job)
+
+    assert result.ok
+    assert result.attempts == 2
+    assert result.returncode == 0
+    assert b"done" in result.output
+
+
+def test_signal_deaths_stop_after_the_retries(tmp_path):
+    job = runner.Job("always_killed", sh("kill -KILL $$"), retries=2)
+
+    with runner.JobRunner(cpus=1, memory=None) as job_runner:
+        result = job_runner.run(job)
+
+    assert result.attempts == 3
+    assert result.returncode == -9
+    assert not result.timed_out
+    with pytest.raises(subprocess.CalledProcessError):
+        result.check()
+
+
+def test_error_exit_is_not_retried(tmp_path):
+    count = tmp_path / "count"
+    job = runner.Job("fails", sh(f"echo run >> {count}; echo bad input; exit 3"), retries=2)
+
+    with runner.JobRunner(cpus=1, memory=None) as job_runner:
+        result = job_runner.run(job)
+
+    assert result.attempts == 1
+    assert count.read_text().split() == ["run"]
+    assert result.returncode == 3
+    assert b"bad input" in result.output
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        result.check()
+    assert error.value.returncode == 3
+
+
+def test_log_files_and_stats(tmp_path):
+    log_dir = tmp_path / "logs"
+    marker = tmp_path / "marker"
+
+    with runner.JobRunner(cpus=2, memory=None, log_dir=str(log_dir)) as job_runner:
+        jobs = [
+            runner.Job("darktable 070424/flower1", sh("echo converted")),
+            runner.Job("metashape-fails", sh("echo broken >&2; exit 1")),
+            runner.Job("metashape-hangs", sh("sleep 30"), timeout=0.2),
+            runner.Job("metashape-oom", sh(f"[ -e {marker} ] || {{ touch {marker}; kill -KILL $$; }}"), retries=1),
+        ]
+        results = [future.result(timeout=20) for future in [job_runner.submit(job) for job in jobs]]
+        stats = job_runner.stats()
+        summary = job_runner.summary()
+
+    assert sorted(os.listdir(log_dir)) == ["darktable_070424_flower1.log", "metashape-fails.log",
+                                          "metashape-hangs.log", "metashape-oom.log"]
+    assert results[0].log_path == str(log_dir / "darktable_070424_flower1.log")
+    assert "converted" in (log_dir / "darktable_070424_flower1.log").read_text()
+    # errors go to the same log
+    assert "broken" in (log_dir / "metashape-fails.log").read_text()
+    # every attempt is in the log of a retried job
+    assert (log_dir / "metashape-oom.log").read_text().count("--- attempt") == 2
+
+    assert stats["queued"] == 0
+    assert stats["running"] == 0
+    assert stats["finished"] == 4
+    assert stats["failed"] == 2
+    assert stats["timed_out"] == 1
+    assert stats["retried"] == 1
+    assert stats["cpus"] == 0
+    assert stats["memory"] == 0
+    assert stats["seconds_max"] >= 0.2
+    assert stats["seconds_total"] == pytest.approx(sum(result.seconds for result in results))
+    assert stats["seconds_mean"] == pytest.approx(stats["seconds_total"] / 4)
+    assert summary.startswith("4 jobs, 2 failed, 1 timed out, 1 retried")
+
+
+def test_queued_jobs_are_counted(tmp_path):
+    release = tmp_path / "release"
+    wait_script = f"while [ ! -e {release} ]; do sleep 0.01; done"
+
+    with runner.JobRunner(cpus=1, memory=None) as job_runner:
+        futures = [job_runner.submit(runner.Job(f"job{i}", sh(wait_script))) for i in range(3)]
+        wait_until(lambda: job_runner.stats()["running"] == 1)
+        assert job_runner.stats()["queued"] == 2
+        release.touch()
+        for future in futures:
+            future.result(timeout=10)
+
+
+def test_stopped_runner_kills_running_jobs(tmp_path):
+    release = tmp_path / "release"
+    job_runner = runner.JobRunner(cpus=1, memory=None)
+    running = job_runner.submit(runner.Job("running", sh("sleep 30")))
+    waiting = job_runner.submit(runner.Job("waiting", sh(f"touch {release}")))
+    wait_until(lambda: job_runner.stats()["running"] == 1)
+
+    killer = threading.Thread(target=job_runner.kill_all)
+    killer.start()
+    killer.join(timeout=10)
+
+    assert running.result(timeout=10).returncode < 0
+    with pytest.raises(RuntimeError):
+        waiting.result(timeout=10)
+    assert not release.exists()
+    job_runner.executor.shutdown()
@@ -0,0 +1,79 @@
+"""
+Tests for photogramkit.transfer, with two fake card readers.
+
+    python -m pytest tests
+"""
+
+import os
+import threading
+import time
+
+from photogramkit import place, transfer
+
+
+def make_cards(tmp_path, n_photos):
+    "two card folders of n_photos photos each, the source photos of card A first"
+    sources = []
+    for card in ["A", "B"]:
+        os.makedirs(tmp_path / card)
+        for i in range(n_photos):
+            path = tmp_path / card / f"IMG_{i:04d}.CR3"
+            path.write_bytes(b"raw photo")
+            sources.append(str(path))
+    os.makedirs(tmp_path / "out")
+    return sources
+
+
+def test_devices_are_placed_in_parallel(tmp_path, monkeypatch):
+    sources = make_cards(tmp_path, 40)
+    lock = threading.Lock()
+    running = {"A": 0, "B": 0}
+    peak = {"A": 0, "B": 0}
+    overlaps = []
+    finished = []
+
+    # the card folder stands for the device, and placing a photo takes a while
+    monkeypatch.setattr(transfer, "device_of", lambda path: os.path.basename(os.path.dirname(path)))
+
+    def slow_place(src, dst, placement):
+        card = os.path.basename(os.path.dirname(src))
+        with lock:
+            running[card] += 1
+            peak[card] = max(peak[card], running[card])
+            overlaps.append(running["A"] > 0 and running["B"] > 0)
+        time.sleep(0.01)
+        with lock:
+            running[card] -= 1
+            finished.append(card)
+        return "copy"
+
+    monkeypatch.setattr(place, "place_file", slow_place)
+
+    with transfer.CopyExecutor(placement="copy", jobs=8, per_device=2) as executor:
+        # all photos of card A are submitted before the ones of card B, like plan.execute_plan does
+        for src in sources:
+            executor.submit(src, str(tmp_path / "out" / os.path.basename(src)))
+        failures = executor.wait()
+
+    assert failures == []
+    assert len(executor.results) == 80
+    assert peak == {"A": 2, "B": 2}
+    assert any(overlaps)
+    # card B does not wait for card A to be done
+    assert finished[:40].count("B") >= 10
+
+
+def test_failures_do_not_stop_the_device(tmp_path):
+    sources = make_cards(tmp_path, 3)
+    missing = str(tmp_path / "A" / "missing.CR3")
+
+    with transfer.CopyExecutor(placement="copy", jobs=2, per_device=1, verify=True) as executor:
+        executor.submit(missing, str(tmp_path / "out" / "missing.CR3"))
+        for src in sources:
+            card = os.path.basename(os.path.dirname(src))
+            executor.submit(src, str(tmp_path / "out" / f"{card}_{os.path.basename(src)}"))
+        failures = executor.wait()
+
+    assert [src for src, _, _ in failures] == [missing]
+    assert len(executor.results) == 6
+    assert len(os.listdir(tmp_path / "out")) == 6